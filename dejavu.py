@@ -7,6 +7,9 @@ import warnings
 import argparse
 
 from dejavu import Dejavu
+from dejavu.database import get_database
+from dejavu.database_sql import SQLDatabase
+from dejavu.fingerprint import FINGERPRINT_FORMATS
 from dejavu.recognize import FileRecognizer
 from dejavu.recognize import MicrophoneRecognizer
 from argparse import RawTextHelpFormatter
@@ -16,21 +19,51 @@ warnings.filterwarnings("ignore")
 DEFAULT_CONFIG_FILE = "dejavu.cnf"
 
 
-def init(configpath):
+def load_config(configpath):
     """
     Load config from a JSON file
     """
     try:
         with open(configpath) as f:
-            config = json.load(f)
+            return json.load(f)
     except IOError as err:
         print("Cannot open configuration: %s. Exiting" % (str(err)))
         sys.exit(1)
 
+
+def init(configpath, fingerprint_format=None):
+    config = load_config(configpath)
+    if fingerprint_format:
+        config["fingerprint_format"] = fingerprint_format
+
     # create a Dejavu instance
     return Dejavu(config)
 
 
+def migrate(configpath, fingerprint_format):
+    """
+    Switch the database to another fingerprint format. This works on the
+    database directly as a Dejavu instance refuses to start on a database
+    whose format differs from its configuration.
+    """
+    config = load_config(configpath)
+    db_cls = get_database(config.get("database_type", None))
+    db = db_cls(**config.get("database", {}))
+    db.migrate_fingerprint_format(fingerprint_format)
+
+
+def migrate_schema(configpath, schema):
+    """
+    Rewrite the fingerprints table into another schema, keeping all songs.
+    Like `migrate` this bypasses Dejavu, which refuses to start on a
+    database whose schema differs from its configuration.
+    """
+    config = load_config(configpath)
+    db_cls = get_database(config.get("database_type", None))
+    db = db_cls(**config.get("database", {}))
+    db.migrate_schema(schema)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description="Dejavu: Audio Fingerprinting library",
@@ -50,9 +83,24 @@ if __name__ == '__main__':
                              'Usage: \n'
                              '--recognize mic number_of_seconds \n'
                              '--recognize file path/to/file \n')
+    parser.add_argument('--migrate-format', nargs=1,
+                        choices=FINGERPRINT_FORMATS,
+                        help='Switch the database to another fingerprint\n'
+                             'format, dropping all songs so they can be\n'
+                             'fingerprinted again, e.g. with --fingerprint\n'
+                             'Usage: \n'
+                             '--migrate-format int64\n')
+    parser.add_argument('--migrate-schema', nargs=1,
+                        choices=SQLDatabase.SCHEMAS,
+                        help='Rewrite the fingerprints table into another\n'
+                             'schema, keeping all songs; set "schema" in the\n'
+                             '"database" configuration to match afterwards\n'
+                             'Usage: \n'
+                             '--migrate-schema normalized\n')
     args = parser.parse_args()
 
-    if not args.fingerprint and not args.recognize:
+    if (not args.fingerprint and not args.recognize
+            and not args.migrate_format and not args.migrate_schema):
         parser.print_help()
         sys.exit(0)
 
@@ -61,7 +109,22 @@ if __name__ == '__main__':
         config_file = DEFAULT_CONFIG_FILE
         # print "Using default config file: %s" % (config_file)
 
-    djv = init(config_file)
+    fingerprint_format = None
+    if args.migrate_format:
+        fingerprint_format = args.migrate_format[0]
+        print("Migrating database to %s fingerprints" % fingerprint_format)
+        migrate(config_file, fingerprint_format)
+        if not args.fingerprint:
+            sys.exit(0)
+
+    if args.migrate_schema:
+        print("Migrating fingerprints table to the %s schema"
+              % args.migrate_schema[0])
+        migrate_schema(config_file, args.migrate_schema[0])
+        if not args.fingerprint:
+            sys.exit(0)
+
+    djv = init(config_file, fingerprint_format)
     if args.fingerprint:
         # Fingerprint all files in a directory
         if len(args.fingerprint) == 2:
@@ -90,4 +153,5 @@ if __name__ == '__main__':
             song = djv.recognize(FileRecognizer, opt_arg)
         print(song)
 
+    djv.close()
     sys.exit(0)
@@ -10,36 +10,27 @@
 
 
 from dejavu.database import get_database
+import dejavu.align as align
 import dejavu.decoder as decoder
 import fingerprint
 import multiprocessing
 import os
-import traceback
-import sys
 import re
 import json
+import threading
+from dejavu.logs import get_logger
 
 __PATH__ = "website/app/"
-__MONGOLOG_FILE__ = "mongolog.cnf"
-
-# Configure logging
-import logging
-if os.path.isfile(__MONGOLOG_FILE__):
-	with open(__MONGOLOG_FILE__) as f:
-		config = json.load(f)
-	from log4mongo.handlers import MongoHandler
-	handler = MongoHandler(level = logging.DEBUG ,host=config['host'], capped=config['capped'], port=config['port'], database_name=config['db'], collection=config['collection'], username=config['user'], password=config['passwd'])
-else:
-	handler = logging.FileHandler("dejavu.log")
-	handler.setLevel(logging.DEBUG)
-	# create a logging format
-	formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-	handler.setFormatter(formatter)
-
-logger = logging.getLogger('Classification_Dejavu')
-logger.addHandler(handler)
-logger.setLevel(logging.DEBUG)
-logger.info('dejavu initiated')
+
+# Configure logging, the handler is set up on the first record
+logger = get_logger('Classification_Dejavu', "dejavu.log")
+
+# How matches are aligned: "rows" fetches every matching fingerprint and
+# counts offset differences here, "histogram" has the database count them
+# and only fetches the best candidates, see `Database.return_match_counts`
+MATCH_ROWS = "rows"
+MATCH_HISTOGRAM = "histogram"
+MATCH_MODES = (MATCH_ROWS, MATCH_HISTOGRAM)
 
 class Dejavu(object):
 
@@ -59,12 +50,29 @@ class Dejavu(object):
 
 		super(Dejavu, self).__init__()
 
+		logger.info('dejavu initiated')
 		self.config = config
 
+		# fingerprinting parameters: the given profile, or the settings
+		# stored in the db, read once and cached in a local file
+		if "fingerprint" in config:
+			fingerprint_config = fingerprint.FingerprintConfig(**config["fingerprint"])
+		else:
+			fingerprint_config = fingerprint.FingerprintConfig.load(
+				config.get("fingerprint_settings_cache",
+						   fingerprint.SETTINGS_CACHE_FILE))
+
+		# fingerprint encoding, has to match the one stored in the database
+		if "fingerprint_format" in config:
+			fingerprint_config = fingerprint_config.replace(
+				fingerprint_format=config["fingerprint_format"])
+		self.fingerprint_config = fingerprint_config
+
 		# initialize db
 		db_cls = get_database(config.get("database_type", None))
 
-		self.db = db_cls(**config.get("database", {}))
+		self.db = db_cls(fingerprint_format=self.fingerprint_format,
+						 **config.get("database", {}))
 		self.db.setup()
 
 		# if we should limit seconds fingerprinted,
@@ -72,16 +80,86 @@ class Dejavu(object):
 		self.limit = self.config.get("fingerprint_limit", None)
 		if self.limit == -1:  # for JSON compatibility
 			self.limit = None
-		self.get_fingerprinted_songs()
 
-	def get_fingerprinted_songs(self):
-		# get songs previously indexed
+		self.match_mode = config.get("match_mode", MATCH_ROWS)
+		if self.match_mode not in MATCH_MODES:
+			raise ValueError("Unsupported match mode: %s" % self.match_mode)
+		# number of (song, offset) candidates the histogram mode fetches
+		self.match_candidates = config.get("match_candidates", 10)
+		# number of songs `top_matches` returns
+		self.match_top_n = config.get("match_top_n", 5)
+
+		# fingerprinted songs are written to the database together once
+		# they hold this many hashes, see `Database.insert_hashes_many`
+		# and `pipeline.WorkerPool`
+		self.insert_batch_size = config.get("insert_batch_size", 500000)
+
+		# how audio is decoded, see `decoder.iter_decode`; the sample rate
+		# is always the fingerprinting one
+		self.decoder_options = {
+			"mode": config.get("decoder", decoder.DECODER_WAV),
+			"nchannels": config.get("decoder_channels", 1),
+		}
+		# names of the fingerprinted songs of each (user, bundle, admin)
+		# bundle, read from the database the first time it is needed
+		self.fingerprinted_songs = {}
+		self._songs_lock = threading.Lock()
+
+		# computed fingerprints by audio content, so a file is not
+		# fingerprinted again under another name or bundle, see
+		# `cache.FingerprintCache`
+		self.cache = None
+		if "fingerprint_cache" in config:
+			from dejavu.cache import FingerprintCache
+			self.cache = FingerprintCache(**config["fingerprint_cache"])
+
+		# Bloom filters of the hashes each bundle holds, so lookups leave
+		# out the query hashes it can't match, see `bloom.BloomFilters`
+		self.filters = None
+		if "bloom_filter" in config:
+			from dejavu.bloom import BloomFilters
+			self.filters = BloomFilters(self.fingerprint_format,
+										**config["bloom_filter"])
+
+		# songs and fingerprints of each hash of each bundle, so lookups,
+		# and optionally ingestion, leave out the hashes too common to
+		# tell its songs apart, see `stophashes.StopHashes`
+		self.stop_hashes = None
+		if "stop_hashes" in config:
+			from dejavu.stophashes import StopHashes
+			self.stop_hashes = StopHashes(self.fingerprint_format,
+										  **config["stop_hashes"])
+
+		# decoder and fingerprint processes, started when first needed
+		# and kept for every bundle after, see `worker_pool`
+		self._pool = None
+		self._pool_lock = threading.RLock()
+
+	@property
+	def fingerprint_format(self):
+		return self.fingerprint_config.fingerprint_format
+
+	def iter_decode(self, filename):
+		"""
+		Yields (channels, Fs) blocks of `filename` with the configured
+		decoder, up to the configured limit.
+		"""
+		return decoder.iter_decode(filename, self.limit,
+								   fs=self.fingerprint_config.fs,
+								   **self.decoder_options)
+
+	def get_fingerprinted_songs(self, user, bundle, admin):
+		"""
+		Returns the set of names of the songs of a bundle fingerprinted so
+		far, to know which ones we've computed before. It is read once per
+		bundle and then kept up to date as songs are added.
+		"""
 		# TODO: should probably use a checksum of the file instead of filename
-		self.songs = self.db.get_songs()
-		self.songnames_set = set()  # to know which ones we've computed before
-		for song in self.songs:
-			song_name = song[self.db.FIELD_SONGNAME]
-			self.songnames_set.add(song_name)
+		key = (user, bundle, bool(admin))
+		if key not in self.fingerprinted_songs:
+			self.fingerprinted_songs[key] = set(
+				self.db.get_song_names(user, bundle, admin))
+		return self.fingerprinted_songs[key]
 
 	def erase_bundle(self, user, bundle, admin):
 		"""
@@ -90,171 +168,571 @@ class Dejavu(object):
 		from the old files.
 		"""
 		self.db.delete_bundle(user,bundle,admin)
+		self.fingerprinted_songs.pop((user, bundle, bool(admin)), None)
+		if self.filters is not None:
+			self.filters.drop((user, bundle, admin))
+		if self.stop_hashes is not None:
+			self.stop_hashes.drop((user, bundle, admin))
 		logger.info("%s by %s deleted from SQL" % (bundle, user))
 		return 0
 
-	def fingerprint_bundle(self, bundle_list, nprocesses=None):
+	def migrate_fingerprint_format(self, fingerprint_format, bundle_lists=(),
+								   nprocesses=None):
+		"""
+		Moves the database over to another fingerprint format.
+
+		Existing fingerprints can't be converted, so every song is dropped
+		and each bundle in `bundle_lists` is fingerprinted again in the new
+		format.
+		"""
+		logger.info("Migrating fingerprints from %s to %s" % (
+			self.fingerprint_format, fingerprint_format))
+		self.db.migrate_fingerprint_format(fingerprint_format)
+		self.fingerprint_config = self.fingerprint_config.replace(
+			fingerprint_format=fingerprint_format)
+		self.fingerprinted_songs = {}
+		if self.filters is not None:
+			self.filters.clear()
+			self.filters.fingerprint_format = fingerprint_format
+		if self.stop_hashes is not None:
+			self.stop_hashes.clear()
+			self.stop_hashes.fingerprint_format = fingerprint_format
+		# the workers fingerprint in the old format
+		self.close()
+
+		for bundle_list in bundle_lists:
+			self.fingerprint_bundle(bundle_list, nprocesses)
+
+	def migrate_schema(self, schema):
+		"""
+		Rewrites the stored fingerprints into another table layout of the
+		database, keeping every song.
+		"""
+		logger.info("Migrating fingerprints table to the %s schema" % schema)
+		self.db.migrate_schema(schema)
+
+	def fingerprint_bundle(self, bundle_list, nprocesses=None, manifest=None):
 		"""
 		Fingerprints a bundle, taking in a dict like object.
 
-		This creates a pool of processes that returns the fingerprint for each
-		file and writes them to the database.
+		Files are decoded, fingerprinted and written to the database by
+		the stages of the worker pool running side by side, see
+		`worker_pool`. Returns the throughput of each stage, see
+		`WorkerPool.run`.
+
+		With a `manifest`, the path of an `IngestManifest` or one, the run
+		records the state of every file and picks up where an earlier run
+		with the same manifest stopped, see `_ingest`.
 		"""
 		logger.debug('Starting to train bundle.')
-		# Try to use the maximum amount of processes if not given.
-		try:
-			nprocesses = nprocesses or multiprocessing.cpu_count()
-		except NotImplementedError:
-			nprocesses = 1
-		else:
-			nprocesses = 1 if nprocesses <= 0 else nprocesses
-
-		pool = multiprocessing.Pool(nprocesses)
 
+		known_files = []
 		files_to_fingerprint = []
 		for file_obj in bundle_list:
 
 			filename = file_obj.file_path+file_obj.file_name
 
-			# don't refingerprint already fingerprinted files
-			if decoder.path_to_songname(filename) in self.songnames_set:
+			# don't refingerprint already fingerprinted files, they are
+			# stored under their file name
+			known_songs = self.get_fingerprinted_songs(
+				file_obj.user, file_obj.bundle, file_obj.admin)
+			if file_obj.file_name in known_songs:
 				logger.debug("%s already fingerprinted, continuing..." % filename)
+				known_files.append(__PATH__ + filename)
 				continue
 
-			files_to_fingerprint.append(file_obj)
-
-		# Prepare _fingerprint_worker input
-		worker_input = zip(files_to_fingerprint,
-						   [self.limit] * len(files_to_fingerprint))
+			files_to_fingerprint.append((file_obj, __PATH__ + filename))
 
-		# Send off our tasks
-		iterator = pool.imap_unordered(_fingerprint_worker,
-									   worker_input)
-
-		# Loop till we have all of them
-		while True:
-			try:
-				file_obj, hashes = iterator.next()
-			except multiprocessing.TimeoutError:
-				continue
-			except StopIteration:
-				break
-			except Exception, e:
-				logger.error("Failed fingerprinting: %s" % e)
-				# Print traceback because we can't reraise it here
-				traceback.print_exc(file=sys.stdout)
-			else:
+		def store(results):
+			songs = []
+			for file_obj, hashes in results:
 				logger.info("Adding file %s by user %s to SQL" % (file_obj.file_name, file_obj.user))
-
 				sid = self.db.insert_song(file_obj.file_name, file_obj.labeled_as, file_obj.user, file_obj.bundle, file_obj.admin)
+				songs.append((file_obj.file_name, (sid, hashes, file_obj.labeled_as, file_obj.user, file_obj.bundle, file_obj.admin)))
+			self._store_songs(songs)
 
-				self.db.insert_hashes(sid, hashes, file_obj.labeled_as, file_obj.user, file_obj.bundle, file_obj.admin)
-				self.db.set_song_fingerprinted(sid)
-				self.get_fingerprinted_songs()
+		return self._ingest(files_to_fingerprint, store, nprocesses,
+							manifest, known_files)
 
-		pool.close()
-		pool.join()
-
-
-	def fingerprint_directory(self, path, extensions, user, bundle, admin, nprocesses=None):
-		# Try to use the maximum amount of processes if not given.
-		try:
-			nprocesses = nprocesses or multiprocessing.cpu_count()
-		except NotImplementedError:
-			nprocesses = 1
-		else:
-			nprocesses = 1 if nprocesses <= 0 else nprocesses
+	def sync_bundle(self, bundle_list, nprocesses=None):
+		"""
+		Brings the stored songs of the bundles in `bundle_list` in line
+		with its files, like `erase_bundle` followed by
+		`fingerprint_bundle` but without redoing the work for files that
+		did not change.
+
+		A file is unchanged if it has the size and modification time of
+		the file its song was fingerprinted from or, failing that, the
+		same SHA1 checksum. Only new and changed files are fingerprinted,
+		and only the songs of changed and removed files are deleted, in
+		batches, see `Database.delete_songs`. The song of a changed file
+		is replaced once the new one is stored. Songs added before files
+		were recorded are taken as unchanged, and their file recorded.
+
+		Returns the number of "added", "changed", "unchanged" and
+		"removed" songs, and the throughput of fingerprinting as "ingest",
+		see `WorkerPool.run`.
+		"""
+		from dejavu.cache import file_checksum
 
-		pool = multiprocessing.Pool(nprocesses)
+		# incoming files of each (user, bundle, admin)
+		tenants = {}
+		for file_obj in bundle_list:
+			tenant = (file_obj.user, file_obj.bundle, bool(file_obj.admin))
+			tenants.setdefault(tenant, []).append(file_obj)
 
+		counts = {"added": 0, "changed": 0, "unchanged": 0, "removed": 0}
+		files_to_fingerprint = []
+		# tenant -> ids of the songs to delete, and names of the songs gone
+		stale = {}
+		removed_names = {}
+		for tenant, file_objs in tenants.items():
+			sids = stale.setdefault(tenant, [])
+			stored = {}
+			for sid, song_name, size, mtime, checksum in self.db.get_song_files(*tenant):
+				if song_name in stored:
+					# left from an earlier run, keep one
+					sids.append(sid)
+				else:
+					stored[song_name] = (sid, size, mtime, checksum)
+
+			for file_obj in file_objs:
+				filename = __PATH__ + file_obj.file_path + file_obj.file_name
+				try:
+					stat = os.stat(filename)
+				except OSError as e:
+					# leave its song, if any, as it is
+					logger.error("Failed reading %s: %s" % (filename, e))
+					stored.pop(file_obj.file_name, None)
+					continue
+				size, mtime = stat.st_size, stat.st_mtime
+
+				checksum = None
+				old_sid = None
+				song = stored.pop(file_obj.file_name, None)
+				if song is not None:
+					sid, stored_size, stored_mtime, stored_checksum = song
+					if (size, mtime) == (stored_size, stored_mtime):
+						counts["unchanged"] += 1
+						continue
+					if stored_size is None or stored_size == size:
+						checksum = file_checksum(filename)
+						if stored_size is None or checksum == stored_checksum:
+							self.db.set_song_file(sid, size, mtime, checksum)
+							counts["unchanged"] += 1
+							continue
+					old_sid = sid
+					counts["changed"] += 1
+				else:
+					counts["added"] += 1
+
+				if checksum is None:
+					checksum = file_checksum(filename)
+				logger.debug("%s is new or changed" % filename)
+				files_to_fingerprint.append(
+					((file_obj, (size, mtime, checksum), old_sid), filename))
+
+			# files no longer in the bundle
+			for song_name, song in stored.items():
+				sids.append(song[0])
+			removed_names[tenant] = stored.keys()
+			counts["removed"] += len(stored)
+
+		def store(results):
+			songs = []
+			for (file_obj, file_info, old_sid), hashes in results:
+				logger.info("Adding file %s by user %s to SQL" % (file_obj.file_name, file_obj.user))
+				sid = self.db.insert_song(file_obj.file_name, file_obj.labeled_as, file_obj.user, file_obj.bundle, file_obj.admin, file_info=file_info)
+				songs.append((file_obj.file_name, (sid, hashes, file_obj.labeled_as, file_obj.user, file_obj.bundle, file_obj.admin)))
+			self._store_songs(songs)
+			for (file_obj, _, old_sid), _ in results:
+				if old_sid is not None:
+					tenant = (file_obj.user, file_obj.bundle, bool(file_obj.admin))
+					stale[tenant].append(old_sid)
+
+		counts["ingest"] = self._ingest(files_to_fingerprint, store, nprocesses)
+
+		for tenant, sids in stale.items():
+			if sids:
+				if self.stop_hashes is not None:
+					self.stop_hashes.remove(self.db, tenant, sids)
+				self.db.delete_songs(tenant[0], tenant[1], tenant[2], sids)
+			with self._songs_lock:
+				known_songs = self.get_fingerprinted_songs(*tenant)
+				known_songs.difference_update(removed_names[tenant])
+		logger.info("Synced %d bundles: %d added, %d changed, %d unchanged, %d removed" % (
+			len(tenants), counts["added"], counts["changed"],
+			counts["unchanged"], counts["removed"]))
+		return counts
+
+	def fingerprint_directory(self, path, extensions, user, bundle, admin,
+							  nprocesses=None, manifest=None):
+		known_songs = self.get_fingerprinted_songs(user, bundle, admin)
+		known_files = []
 		filenames_to_fingerprint = []
 		for filename, _ in decoder.find_files(path, extensions):
 
 			print filename
 			# don't refingerprint already fingerprinted files
-			if decoder.path_to_songname(filename) in self.songnames_set:
+			song_name = decoder.path_to_songname(filename)
+			if song_name in known_songs:
 				print "%s already fingerprinted, continuing..." % filename
+				known_files.append(filename)
 				continue
 
-			filenames_to_fingerprint.append(filename)
+			filenames_to_fingerprint.append((song_name, filename))
 
-		# Prepare _fingerprint_worker input
-		worker_input = zip(filenames_to_fingerprint,
-						   [self.limit] * len(filenames_to_fingerprint))
+		def store(results):
+			tag = 'Not supplied'
+			songs = []
+			for song_name, hashes in results:
+				sid = self.db.insert_song(song_name, tag, user, bundle, admin)
+				songs.append((song_name, (sid, hashes, tag, user, bundle, admin)))
+			self._store_songs(songs)
 
-		# Send off our tasks
-		iterator = pool.imap_unordered(_fingerprint_worker,
-									   worker_input)
+		return self._ingest(filenames_to_fingerprint, store, nprocesses,
+							manifest, known_files)
 
-		# Loop till we have all of them
-		while True:
+	def _ingest(self, tasks, store, nprocesses=None, manifest=None,
+				known_files=()):
+		"""
+		Runs (key, filename) `tasks` through the worker pool, see
+		`worker_pool`, and has `store` write the hashes of finished files
+		in batches of `insert_batch_size` hashes.
+
+		With a `manifest`, an `IngestManifest` or the path of one, files
+		done or failed too often in earlier runs are skipped, and the
+		state of the others is recorded as the run goes; `known_files`,
+		fingerprinted already, are recorded as done. The states of all
+		files are returned as "manifest", see `IngestManifest.summary`.
+		"""
+		options = self.config.get("pipeline", {})
+		pool = self.worker_pool(nprocesses)
+		if manifest is None:
 			try:
-				song_name, hashes = iterator.next()
-			except multiprocessing.TimeoutError:
-				continue
-			except StopIteration:
-				break
-			except:
-				print("Failed fingerprinting")
-				# Print traceback because we can't reraise it here
-				traceback.print_exc(file=sys.stdout)
+				return pool.run(tasks, store,
+								writers=options.get("writers", 1),
+								batch_size=self.insert_batch_size)
+			finally:
+				self.save_filters()
+
+		from dejavu.manifest import IngestManifest, DEFAULT_MAX_ATTEMPTS
+		if not isinstance(manifest, IngestManifest):
+			manifest = IngestManifest(manifest, self.config.get(
+				"manifest_max_attempts", DEFAULT_MAX_ATTEMPTS))
+
+		for filename in known_files:
+			manifest.done(filename)
+		# keyed by filename as well, for the manifest
+		tasks = [((filename, key), filename)
+				 for key, filename in manifest.start(tasks)]
+
+		def consume(results):
+			store([(key, hashes) for (_, key), hashes in results])
+			for (filename, _), _ in results:
+				manifest.done(filename)
+
+		try:
+			stats = pool.run(
+				tasks, consume, writers=options.get("writers", 1),
+				batch_size=self.insert_batch_size,
+				started=lambda key: manifest.in_progress(key[0]),
+				failed=lambda key, error: manifest.failed(key[0], error))
+		finally:
+			manifest.close()
+			self.save_filters()
+
+		stats["manifest"] = manifest.summary()
+		logger.info("Manifest %s: %s" % (manifest.path, ", ".join(
+			"%d %s" % (stats["manifest"][state], state)
+			for state in ("done", "failed", "in_progress", "pending"))))
+		return stats
+
+	def worker_pool(self, nprocesses=None):
+		"""
+		Returns the `pipeline.WorkerPool` fingerprinting files for
+		ingestion and batch recognition. It is created on first use and
+		kept, with its processes, until `close`; a given `nprocesses`
+		resizes it to that many fingerprint processes, sized by the
+		"pipeline" config and the cpu count otherwise.
+		"""
+		from dejavu.pipeline import WorkerPool, DEFAULT_QUEUE_SIZE
+
+		options = self.config.get("pipeline", {})
+		with self._pool_lock:
+			if self._pool is not None and not nprocesses:
+				return self._pool
+
+			# Try to use the maximum amount of processes if not given.
+			try:
+				nprocesses = nprocesses or multiprocessing.cpu_count()
+			except NotImplementedError:
+				nprocesses = 1
+			else:
+				nprocesses = 1 if nprocesses <= 0 else nprocesses
+			decoders = options.get("decoders", max(1, nprocesses // 2))
+			fingerprinters = options.get("fingerprinters", nprocesses)
+
+			if self._pool is None:
+				self._pool = WorkerPool(
+					self.fingerprint_config, limit=self.limit,
+					decoder_options=self.decoder_options,
+					decoders=decoders, fingerprinters=fingerprinters,
+					queue_size=options.get("queue_size", DEFAULT_QUEUE_SIZE),
+					before_fork=self.db.before_fork,
+					after_fork=self.db.after_fork, cache=self.cache)
 			else:
-				tag = 'Not supplied'
+				self._pool.resize(decoders, fingerprinters)
+			return self._pool
 
-				sid = self.db.insert_song(song_name, tag, user, bundle, admin)
+	def start_workers(self, nprocesses=None):
+		"""
+		Starts and warms up the worker processes ahead of the first
+		bundle, instead of on the first one.
+		"""
+		self.worker_pool(nprocesses).start()
 
-				self.db.insert_hashes(sid, hashes, tag, user, bundle, admin)
-				self.db.set_song_fingerprinted(sid)
-				self.get_fingerprinted_songs()
+	def resize_workers(self, nprocesses):
+		"""
+		Changes the number of worker processes, see `worker_pool`.
+		"""
+		self.worker_pool(nprocesses)
 
-		pool.close()
-		pool.join()
+	def close(self):
+		"""
+		Stops the worker processes, if any were started, and saves the
+		Bloom filters.
+		"""
+		with self._pool_lock:
+			if self._pool is not None:
+				self._pool.close()
+				self._pool = None
+		self.save_filters()
+
+	def save_filters(self):
+		"""
+		Writes the Bloom filters and stop hash counts changed since they
+		were last saved, see `bloom.BloomFilters` and
+		`stophashes.StopHashes`.
+		"""
+		if self.filters is not None:
+			self.filters.save()
+		if self.stop_hashes is not None:
+			self.stop_hashes.save()
+
+	def bloom_filter_stats(self):
+		"""
+		Returns the hit rate and false positive rates of the Bloom filter
+		of each bundle, by "user/bundle", see `bloom.BloomFilters.stats`;
+		empty without the "bloom_filter" config.
+		"""
+		if self.filters is None:
+			return {}
+		return self.filters.stats()
 
-	def fingerprint_file(self, filepath, tag, song_name=None):
+	def stop_hash_stats(self):
+		"""
+		Returns the stop hashes of each bundle, by "user/bundle", with the
+		share of its fingerprints they make, which `prune_stored` keeps
+		out of the index, and the share of query hashes they took out of
+		lookups, see `stophashes.StopHashes.stats`; empty without the
+		"stop_hashes" config.
+		"""
+		if self.stop_hashes is None:
+			return {}
+		return self.stop_hashes.stats()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, extype, exvalue, traceback):
+		self.close()
+
+	def _store_songs(self, songs):
+		"""
+		Writes the hashes of `songs`, (song_name, (sid, hashes, tag, user,
+		bundle, admin)) tuples, with a single bulk insert and marks the
+		songs fingerprinted. Called by the writer threads of the pipeline.
+		"""
+		# with `prune_stored`, the songs are stored without their stop hashes
+		stored = [song for _, song in songs]
+		if self.stop_hashes is not None:
+			stored = [(sid, self.stop_hashes.prune(self.db, hashes, user,
+												   bundle, admin),
+					   tag, user, bundle, admin)
+					  for sid, hashes, tag, user, bundle, admin in stored]
+		self.db.insert_hashes_many(stored)
+		for (song_name, _), song in zip(songs, stored):
+			sid, hashes, _, user, bundle, admin = song
+			self.db.set_song_fingerprinted(sid)
+			if self.filters is not None:
+				self.filters.add((user, bundle, admin), [sid],
+								 [hash for hash, _ in hashes])
+			if self.stop_hashes is not None:
+				self.stop_hashes.add((user, bundle, admin), [(sid, hashes)])
+			with self._songs_lock:
+				self.get_fingerprinted_songs(user, bundle, admin).add(song_name)
+
+	def fingerprint_file(self, filepath, tag, user, bundle, admin=False,
+						 song_name=None):
 		songname = decoder.path_to_songname(filepath)
 		song_name = song_name or songname
 		# don't refingerprint already fingerprinted files
-		if song_name in self.songnames_set:
+		known_songs = self.get_fingerprinted_songs(user, bundle, admin)
+		if song_name in known_songs:
 			print "%s already fingerprinted, continuing..." % song_name
 		else:
-			song_name, hashes, tag = _fingerprint_worker(filepath,
+			song_name, hashes = _fingerprint_worker(filepath,
 													self.limit,
-													song_name=song_name)
+													song_name=song_name,
+													config=self.fingerprint_config,
+													decoder_options=self.decoder_options,
+													cache=self.cache)
+
+			sid = self.db.insert_song(song_name, tag, user, bundle, admin)
+
+			stored = hashes
+			if self.stop_hashes is not None:
+				stored = self.stop_hashes.prune(self.db, hashes, user, bundle,
+												admin)
+			self.db.insert_hashes(sid, stored, tag, user, bundle, admin)
+			self.db.set_song_fingerprinted(sid)
+			if self.filters is not None:
+				self.filters.add((user, bundle, admin), [sid],
+								 [hash for hash, _ in stored])
+			if self.stop_hashes is not None:
+				self.stop_hashes.add((user, bundle, admin), [(sid, stored)])
+			self.save_filters()
+			known_songs.add(song_name)
+
+	def find_matches(self, samples, user, bundle, admin, Fs=None):
+		hashes = fingerprint.fingerprint(samples, self.fingerprint_config, Fs=Fs)
+		hashes = self._filter_hashes(hashes, user, bundle, admin)
+		return self.db.return_matches(hashes, user, bundle, admin)
 
-			sid = self.db.insert_song(song_name, tag)
+	def _filter_hashes(self, hashes, user, bundle, admin):
+		"""
+		Leaves out the (hash, offset) pairs the bundle can't match, with
+		the "bloom_filter" config, and its stop hashes, with the
+		"stop_hashes" config.
+		"""
+		if self.stop_hashes is not None:
+			hashes = self.stop_hashes.filter(self.db, hashes, user, bundle,
+											 admin)
+		if self.filters is not None:
+			hashes = self.filters.filter(self.db, hashes, user, bundle, admin)
+		return hashes
+
+	def find_matches_in_stream(self, blocks, user, bundle, admin):
+		"""
+		Streaming counterpart of `find_matches`. `blocks` yields
+		(channels, Fs) pairs like `decoder.iter_read`; hashes are looked up
+		as soon as a block completes them, so memory use does not grow with
+		the length of the audio.
+		"""
+		for hashes in _stream_hashes(blocks, self.fingerprint_config):
+			hashes = self._filter_hashes(hashes, user, bundle, admin)
+			for match in self.db.return_matches(hashes, user, bundle, admin):
+				yield match
 
-			self.db.insert_hashes(sid, hashes, tag)
-			self.db.set_song_fingerprinted(sid)
-			self.get_fingerprinted_songs()
+	def align_stream(self, blocks, user, bundle, admin):
+		"""
+		Fingerprints `blocks`, (channels, Fs) pairs like `decoder.iter_read`,
+		and returns the best aligned match with the configured match mode,
+		like ``align_matches(find_matches_in_stream(...))``.
+		"""
+		if self.match_mode == MATCH_HISTOGRAM:
+			# the histogram has to cover the whole query, so it is sent at once
+			hashes = []
+			for block_hashes in _stream_hashes(blocks, self.fingerprint_config):
+				hashes.extend(block_hashes)
+			return self._align_hashes(hashes, user, bundle, admin)
 
-	def find_matches(self, samples, user, bundle, admin, Fs=fingerprint.DEFAULT_FS):
-		hashes = fingerprint.fingerprint(samples, Fs=Fs)
-		return self.db.return_matches(hashes, user, bundle, admin)
+		matches = self.find_matches_in_stream(blocks, user, bundle, admin)
+		return self.align_matches(matches)
+
+	def recognize_files(self, filenames, user, bundle, admin, nprocesses=None):
+		"""
+		Recognizes each of `filenames` against a bundle, fingerprinting
+		them with the worker pool, see `worker_pool`. Returns the best
+		aligned match of each file like `align_stream`, in the order of
+		`filenames`, None for files without one or that failed.
+		"""
+		filenames = list(filenames)
+		results = [None] * len(filenames)
+
+		def match(batch):
+			for index, hashes in batch:
+				results[index] = self._align_hashes(hashes, user, bundle, admin)
+
+		options = self.config.get("pipeline", {})
+		self.worker_pool(nprocesses).run(
+			enumerate(filenames), match, writers=options.get("writers", 1),
+			unique=False)
+		return results
+
+	def _align_hashes(self, hashes, user, bundle, admin):
+		"""
+		Looks up `hashes` of a query and aligns the matches with the
+		configured match mode.
+		"""
+		hashes = self._filter_hashes(hashes, user, bundle, admin)
+		if self.match_mode == MATCH_HISTOGRAM:
+			counts = self.db.return_match_counts(hashes, user, bundle, admin,
+												 self.match_candidates)
+			return self.align_match_counts(counts)
+		return self.align_matches(self.db.return_matches(hashes, user, bundle, admin))
+
+	def align_match_counts(self, counts, config=None):
+		"""
+		Same as `align_matches`, for an offset histogram of
+		(song_id, offset_difference, count) tuples, most common first, as
+		returned by `Database.return_match_counts`.
+		"""
+		if not counts:
+			return None
+		song_id, largest, largest_count = counts[0]
+		return self._match_result(song_id, largest, largest_count, config)
 
-	def align_matches(self, matches):
+	def align_matches(self, matches, config=None):
 		"""
 			Finds hash matches that align in time with other matches and finds
 			consensus about which hashes are "true" signal from the audio.
 
+			Offsets are converted to seconds with the FingerprintConfig the
+			matches were fingerprinted with, `self.fingerprint_config` if
+			`config` is not given.
+
+			`matches` are (song_id, offset difference) pairs, or arrays of
+			each, see `align.match_arrays`; they are counted in one go by
+			`align.top_alignments`.
+
 			Returns a dictionary with match information.
 		"""
-		# align by diffs
-		diff_counter = {}
-		largest = 0
-		largest_count = 0
-		song_id = -1
-		for tup in matches:
-			sid, diff = tup
-			if diff not in diff_counter:
-				diff_counter[diff] = {}
-			if sid not in diff_counter[diff]:
-				diff_counter[diff][sid] = 0
-			diff_counter[diff][sid] += 1
-
-			if diff_counter[diff][sid] > largest_count:
-				largest = diff
-				largest_count = diff_counter[diff][sid]
-				song_id = sid
+		sids, diffs = align.match_arrays(matches)
+		top = align.top_alignments(sids, diffs, 1)
+		if not top:
+			return None
+		song_id, largest, largest_count = top[0]
+		return self._match_result(song_id, largest, largest_count, config)
+
+	def top_matches(self, matches, n=None, config=None):
+		"""
+		Like `align_matches`, but returns the match information of the `n`
+		songs with the most aligned matches, `match_top_n` by default,
+		each at its best offset, most confident first.
+		"""
+		sids, diffs = align.match_arrays(matches)
+		results = []
+		for song_id, largest, largest_count in align.top_alignments(
+				sids, diffs, n or self.match_top_n):
+			song = self._match_result(song_id, largest, largest_count, config)
+			if song:
+				results.append(song)
+		return results
+
+	def _match_result(self, song_id, largest, largest_count, config=None):
+		config = config or self.fingerprint_config
 
 		# extract idenfication
 		song = self.db.get_song_by_id(song_id)
@@ -266,9 +744,9 @@ class Dejavu(object):
 			return None
 
 		# return match info
-		nseconds = round(float(largest) / fingerprint.DEFAULT_FS *
-						 fingerprint.DEFAULT_WINDOW_SIZE *
-						 fingerprint.DEFAULT_OVERLAP_RATIO, 5)
+		nseconds = round(float(largest) / config.fs *
+						 config.window_size *
+						 config.overlap_ratio, 5)
 		song = {
 			Dejavu.SONG_ID: song_id,
 			Dejavu.TAG: tag,
@@ -285,14 +763,18 @@ class Dejavu(object):
 		return r.recognize(*options, **kwoptions)
 
 
-def _fingerprint_worker(file, limit=None, song_name=None):
+def _fingerprint_worker(file, limit=None, song_name=None, config=None,
+						decoder_options=None, cache=None):
 	# Pool.imap sends arguments as tuples so we have to unpack
 	# them ourself.
 
-	try:
-		filename, limit = file
-	except ValueError:
-		pass
+	if isinstance(file, tuple):
+		filename, limit, config, decoder_options = file
+	else:
+		filename = file
+
+	if config is None:
+		config = fingerprint.FingerprintConfig.load()
 
 	print "File Type(%s): %s" %  (filename,type(filename))
 
@@ -306,19 +788,31 @@ def _fingerprint_worker(file, limit=None, song_name=None):
 
 	songname, extension = os.path.splitext(os.path.basename(filename))
 	song_name = song_name or songname
-	channels, Fs = decoder.read(filename, limit)
-	result = set()
-	channel_amount = len(channels)
 
-	for channeln, channel in enumerate(channels):
+	# the same audio may have been fingerprinted before, under any name
+	key = None
+	cached = None
+	if cache is not None:
+		key = cache.key(filename, config, limit, decoder_options)
+		cached = cache.get(key)
+
+	if cached is not None:
+		logger.debug("Found %s in the fingerprint cache" % filename)
+		hashes, offsets = cached
+	else:
 		# TODO: Remove prints or change them into optional logging.
-		print("Fingerprinting channel %d/%d for %s" % (channeln + 1,
-														channel_amount,
-														filename))
-		hashes = fingerprint.fingerprint(channel, Fs=Fs)
-		print("Finished channel %d/%d for %s" % (channeln + 1, channel_amount,
-												 filename))
-		result |= set(hashes)
+		print("Fingerprinting %s" % filename)
+		blocks = decoder.iter_decode(filename, limit, fs=config.fs,
+									 **(decoder_options or {}))
+		arrays = list(_stream_hash_arrays(blocks, config)) or [
+			fingerprint.empty_hash_arrays(config)]
+		# one copy of each (hash, offset) pair of all channels
+		hashes, offsets = fingerprint.unique_hashes([h for h, _ in arrays],
+													[o for _, o in arrays])
+		if key is not None:
+			cache.put(key, hashes, offsets)
+	result = zip(hashes.tolist(), offsets.tolist())
+	print("Finished %s" % filename)
 
 	if type(filename) is not str:
 		# return the full file dict if a dict was the input
@@ -327,6 +821,32 @@ def _fingerprint_worker(file, limit=None, song_name=None):
 		return song_name, result
 
 
+def _stream_hashes(blocks, config):
+	"""
+	Fingerprints every channel of `blocks`, (channels, Fs) pairs as yielded
+	by `decoder.iter_read`, with the FingerprintConfig `config` and yields
+	the hashes as each block completes them.
+	"""
+	for hashes, offsets in _stream_hash_arrays(blocks, config):
+		yield zip(hashes.tolist(), offsets.tolist())
+
+
+def _stream_hash_arrays(blocks, config):
+	"""
+	Like `_stream_hashes`, but yields (hashes, offsets) arrays.
+	"""
+	streams = None
+	for channels, Fs in blocks:
+		if streams is None:
+			streams = [fingerprint.FingerprintStream(config, Fs=Fs)
+					   for _ in channels]
+		for stream, samples in zip(streams, channels):
+			yield stream.feed_arrays(samples)
+
+	for stream in streams or []:
+		yield stream.close_arrays()
+
+
 def chunkify(lst, n):
 	"""
 	Splits a list into roughly n equal parts.
@@ -0,0 +1,93 @@
+"""
+Alignment of matches: counting how many matching hashes agree on each
+(song, offset difference) pair, with NumPy arrays rather than a dict per
+offset difference.
+
+Each pair is packed into one 64-bit key, and the keys are counted with
+`np.bincount` when their range is small enough, or by sorting them
+otherwise.
+"""
+from itertools import chain
+
+import numpy as np
+
+# Keys are counted with np.bincount while their range is at most this
+# many times the number of matches (plus a constant for small queries),
+# which keeps the count array about as large as the input
+BINCOUNT_RANGE_FACTOR = 4
+BINCOUNT_MIN_RANGE = 1 << 16
+
+
+def match_arrays(matches):
+    """
+    Returns (sids, diffs) int64 arrays of `matches`, an iterable of
+    (song_id, offset difference) pairs like `Database.return_matches`
+    yields, or such a pair of arrays already.
+    """
+    if (isinstance(matches, tuple) and len(matches) == 2 and
+            isinstance(matches[0], np.ndarray)):
+        sids, diffs = matches
+        return sids.astype(np.int64, copy=False), diffs.astype(np.int64, copy=False)
+
+    flat = np.fromiter(chain.from_iterable(matches), dtype=np.int64)
+    return flat[0::2], flat[1::2]
+
+
+def count_alignments(sids, diffs):
+    """
+    Counts the distinct (sid, diff) pairs of the arrays. Returns
+    (sids, diffs, counts) arrays with one entry per pair, ordered by sid
+    then diff.
+    """
+    if not len(sids):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+
+    sid_min, diff_min = sids.min(), diffs.min()
+    span = int(diffs.max() - diff_min) + 1
+    key_range = (int(sids.max() - sid_min) + 1) * span
+    if key_range >= 1 << 63:
+        # can't be packed, count the pairs the slow way
+        order = np.lexsort((diffs, sids))
+        sids, diffs = sids[order], diffs[order]
+        starts = np.concatenate(([0], np.flatnonzero(
+            (sids[1:] != sids[:-1]) | (diffs[1:] != diffs[:-1])) + 1))
+        counts = np.diff(np.concatenate((starts, [len(sids)])))
+        return sids[starts], diffs[starts], counts
+
+    keys = (sids - sid_min) * span + (diffs - diff_min)
+    if key_range <= max(BINCOUNT_RANGE_FACTOR * len(keys), BINCOUNT_MIN_RANGE):
+        counts = np.bincount(keys)
+        keys = np.flatnonzero(counts)
+        counts = counts[keys]
+    else:
+        keys = np.sort(keys)
+        starts = np.concatenate(([0], np.flatnonzero(keys[1:] != keys[:-1]) + 1))
+        counts = np.diff(np.concatenate((starts, [len(keys)])))
+        keys = keys[starts]
+    return keys // span + sid_min, keys % span + diff_min, counts
+
+
+def top_alignments(sids, diffs, n=1):
+    """
+    Returns the best aligned offset difference of each of the `n` songs
+    with the most aligned matches, as (sid, diff, count) tuples, most
+    common first. Ties go to the lower sid, then diff.
+    """
+    sids, diffs, counts = count_alignments(sids, diffs)
+    if not len(counts):
+        return []
+
+    # best count of each song, pairs being ordered by sid
+    starts = np.concatenate(([0], np.flatnonzero(sids[1:] != sids[:-1]) + 1))
+    sizes = np.diff(np.concatenate((starts, [len(sids)])))
+    best = np.maximum.reduceat(counts, starts)
+    # and the first, lowest, diff reaching it
+    hits = np.flatnonzero(counts == np.repeat(best, sizes))
+    _, first = np.unique(sids[hits], return_index=True)
+    hits = hits[first]
+
+    # most common first, then by sid
+    picks = hits[np.lexsort((sids[hits], -counts[hits]))[:n]]
+    return zip(sids[picks].tolist(), diffs[picks].tolist(),
+               counts[picks].tolist())
@@ -0,0 +1,632 @@
+from __future__ import division
+import hashlib
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+import dejavu.fingerprint as fingerprint
+
+
+def best_time(func, *args, **kwargs):
+    """
+    Runs `func` `repeat` times (keyword, default 3) and returns
+    (best wall time in seconds, result of the last call).
+    """
+    repeat = kwargs.pop("repeat", 3)
+    best = None
+    result = None
+    for _ in xrange(repeat):
+        t = time.time()
+        result = func(*args, **kwargs)
+        t = time.time() - t
+        best = t if best is None else min(best, t)
+    return best, result
+
+
+def synthetic_peaks(npeaks, nfreqs=2049, seed=42):
+    """
+    Random (frequency, time) peaks laid out like the output of
+    `fingerprint.get_2D_peaks`, i.e. ordered by frequency then time.
+    """
+    rng = np.random.RandomState(seed)
+    freqs = rng.randint(0, nfreqs, npeaks)
+    # roughly 30 peaks per spectrogram column, as seen on real recordings
+    times = rng.randint(0, max(npeaks // 30, 1), npeaks)
+    order = np.lexsort((times, freqs))
+    return zip(freqs[order], times[order])
+
+
+def synthetic_audio(seconds, Fs=fingerprint.DEFAULT_FS, seed=42):
+    """
+    Mono int16 test signal: a few gliding and pulsed tones over noise,
+    with a stretch of digital silence.
+    """
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(seconds * Fs)) / Fs
+    x = rng.randn(len(t)) * 2000
+    x += 6000 * np.sin(2 * np.pi * 440 * t) * (np.sin(2 * np.pi * 0.3 * t) > 0)
+    x += 4000 * np.sin(2 * np.pi * (1000 + 500 * np.sin(t)) * t)
+    x += 3000 * np.sin(2 * np.pi * 3150 * t) * (np.sin(2 * np.pi * 1.7 * t) > 0.5)
+    x[int(Fs):int(1.5 * Fs)] = 0
+    return x.astype(np.int16)
+
+
+def _mlab_spectrogram(samples, Fs, wsize, wratio):
+    """
+    The original matplotlib based spectrogram, kept as the reference for
+    `fingerprint.spectrogram`.
+    """
+    import matplotlib.mlab as mlab
+    arr2D = mlab.specgram(
+        samples,
+        NFFT=wsize,
+        Fs=Fs,
+        window=mlab.window_hanning,
+        noverlap=int(wsize * wratio))[0]
+    arr2D = 10 * np.log10(arr2D)
+    arr2D[arr2D == -np.inf] = 0
+    return arr2D
+
+
+def _get_2D_peaks_footprint(arr2D, config):
+    """
+    The original peak picker with a full 2D diamond footprint, kept as the
+    reference for `fingerprint.get_2D_peaks`.
+    """
+    from scipy.ndimage.filters import maximum_filter
+    from scipy.ndimage.morphology import (generate_binary_structure,
+                                          iterate_structure, binary_erosion)
+    struct = generate_binary_structure(2, 1)
+    neighborhood = iterate_structure(struct, config.peak_neighborhood_size)
+
+    local_max = maximum_filter(arr2D, footprint=neighborhood) == arr2D
+    background = (arr2D == 0)
+    eroded_background = binary_erosion(background, structure=neighborhood,
+                                       border_value=1)
+    # boolean subtraction, as the original did on older numpy
+    detected_peaks = local_max ^ eroded_background
+
+    amps = arr2D[detected_peaks]
+    j, i = np.where(detected_peaks)
+    peaks = zip(i, j, amps.flatten())
+    peaks_filtered = [x for x in peaks if x[2] > config.amp_min]
+    return [(x[1], x[0]) for x in peaks_filtered]
+
+
+def _generate_hashes_loop(peaks, config):
+    """
+    The original pure Python hash generator, kept as the reference the
+    vectorized engine is checked and timed against.
+    """
+    idx_freq_i, idx_time_j = config.idx_freq_i, config.idx_time_j
+    if config.peak_sort:
+        peaks = sorted(peaks, key=lambda p: p[idx_time_j])
+
+    for i in range(len(peaks)):
+        for j in range(1, config.fan_value):
+            if (i + j) < len(peaks):
+
+                freq1 = peaks[i][idx_freq_i]
+                freq2 = peaks[i + j][idx_freq_i]
+                t1 = peaks[i][idx_time_j]
+                t2 = peaks[i + j][idx_time_j]
+                t_delta = t2 - t1
+
+                if (t_delta >= config.min_hash_time_delta and
+                        t_delta <= config.max_hash_time_delta):
+                    h = hashlib.sha1(
+                        "%s|%s|%s" % (str(freq1), str(freq2), str(t_delta)))
+                    yield (h.hexdigest()[0:config.fingerprint_reduction], t1)
+
+
+def bench_generate_hashes(npeaks=20000, fan_value=fingerprint.DEFAULT_FAN_VALUE,
+                          repeat=3):
+    """
+    Compares the loop based hash generator with `generate_hash_arrays`
+    on `npeaks` synthetic peaks and checks both produce the same hashes.
+    """
+    config = fingerprint.FingerprintConfig(fan_value=fan_value)
+    peaks = synthetic_peaks(npeaks)
+
+    loop_time, expected = best_time(
+        lambda: list(_generate_hashes_loop(peaks, config)), repeat=repeat)
+    vector_time, (hashes, offsets) = best_time(
+        fingerprint.generate_hash_arrays, peaks, config, repeat=repeat)
+
+    identical = expected == zip(hashes.tolist(), offsets.tolist())
+
+    return {
+        "peaks": npeaks,
+        "hashes": len(hashes),
+        "loop_secs": loop_time,
+        "vectorized_secs": vector_time,
+        "speedup": loop_time / vector_time if vector_time else float("inf"),
+        "identical": identical,
+    }
+
+
+def bench_spectrogram(seconds=60, repeat=3):
+    """
+    Times `fingerprint.spectrogram` against mlab.specgram on `seconds` of
+    synthetic audio, and checks both lead to the same peaks.
+    """
+    config = fingerprint.FingerprintConfig()
+    samples = synthetic_audio(seconds, Fs=config.fs)
+
+    mlab_time, expected = best_time(
+        _mlab_spectrogram, samples, config.fs, config.window_size,
+        config.overlap_ratio, repeat=repeat)
+    stft_time, arr2D = best_time(
+        fingerprint.spectrogram, samples, config, repeat=repeat)
+
+    both = (expected != 0) & (arr2D != 0)
+    same_peaks = (fingerprint.get_2D_peaks(expected, config).tolist() ==
+                  fingerprint.get_2D_peaks(arr2D, config).tolist())
+    minutes = seconds / 60
+
+    return {
+        "audio_secs": seconds,
+        "mlab_secs_per_min": mlab_time / minutes,
+        "stft_secs_per_min": stft_time / minutes,
+        "speedup": mlab_time / stft_time if stft_time else float("inf"),
+        "max_abs_db_diff": float(np.abs(expected[both] - arr2D[both]).max()),
+        "same_silence": bool(((expected == 0) == (arr2D == 0)).all()),
+        "same_peaks": same_peaks,
+    }
+
+
+def bench_peaks(seconds=60, repeat=3):
+    """
+    Times `fingerprint.get_2D_peaks` against the original footprint based
+    peak picker on the spectrogram of `seconds` of synthetic audio, for
+    the default amp_min and for a negative one that brings the silent
+    background erosion into play.
+    """
+    config = fingerprint.FingerprintConfig()
+    arr2D = fingerprint.spectrogram(synthetic_audio(seconds), config)
+    result = {"audio_secs": seconds}
+
+    for name, amp_min in (("", config.amp_min),
+                          ("negative_amp_min_", -1)):
+        peaks_config = config.replace(amp_min=amp_min)
+        footprint_time, expected = best_time(
+            _get_2D_peaks_footprint, arr2D, peaks_config, repeat=repeat)
+        picker_time, peaks = best_time(
+            fingerprint.get_2D_peaks, arr2D, peaks_config, repeat=repeat)
+
+        result[name + "footprint_secs"] = footprint_time
+        result[name + "picker_secs"] = picker_time
+        result[name + "speedup"] = (footprint_time / picker_time
+                                    if picker_time else float("inf"))
+        result[name + "identical"] = peaks.tolist() == map(list, expected)
+    return result
+
+
+# Modules dejavu only needs for plotting, recording, remote logging or
+# a given backend, which a plain run should not have to import
+HEAVY_MODULES = ("matplotlib.pyplot", "scipy.ndimage", "pydub", "MySQLdb",
+                 "pyaudio", "log4mongo", "models")
+
+# Runs the command line tool in-process up to the point where it would
+# start working (without arguments it prints its usage and exits), then
+# reports which heavy modules got imported on the way.
+_CLI_STARTUP = """
+import os, runpy, sys
+sys.argv = [%(cli)r]
+sys.stdout = open(os.devnull, "w")
+try:
+    runpy.run_path(%(cli)r, run_name="__main__")
+except SystemExit:
+    pass
+sys.stdout = sys.__stdout__
+print " ".join(m for m in %(heavy)r if m in sys.modules)
+"""
+
+
+def bench_import(repeat=3):
+    """
+    Cold start cost of ``dejavu.py -r file``: the time a fresh interpreter
+    takes to import everything the command line tool needs and parse its
+    arguments, with and without the interpreter's own start up, and the
+    heavy optional modules that were imported along the way.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = _CLI_STARTUP % {"cli": os.path.join(root, "dejavu.py"),
+                           "heavy": HEAVY_MODULES}
+
+    def run(*args):
+        return subprocess.check_output((sys.executable,) + args, cwd=root)
+
+    interpreter_time, _ = best_time(run, "-c", "pass", repeat=repeat)
+    startup_time, loaded = best_time(run, "-c", code, repeat=repeat)
+
+    return {
+        "interpreter_secs": interpreter_time,
+        "cli_startup_secs": startup_time,
+        "dejavu_secs": startup_time - interpreter_time,
+        "heavy_modules": loaded.strip().split() or "none",
+    }
+
+
+def synthetic_bundle(nsongs, hashes_per_song, vocabulary, fingerprint_format,
+                     seed=42):
+    """
+    Random songs as lists of (hash, offset) pairs, with hashes drawn from
+    a `vocabulary` small enough that each one turns up in many songs, the
+    way common hashes do in a big bundle.
+    """
+    rng = np.random.RandomState(seed)
+    songs = []
+    for _ in xrange(nsongs):
+        values = rng.randint(0, vocabulary, hashes_per_song)
+        offsets = np.sort(rng.randint(0, hashes_per_song // 10, hashes_per_song))
+        if fingerprint_format == fingerprint.FORMAT_SHA1:
+            hashes = ["%020x" % v for v in values.tolist()]
+        else:
+            hashes = values.tolist()
+        songs.append(zip(hashes, offsets.tolist()))
+    return songs
+
+
+def bench_match(config, nsongs=100, hashes_per_song=10000, vocabulary=50000,
+                query_hashes=2000, repeat=3):
+    """
+    Times both match modes on a synthetic bundle of `nsongs` songs stored
+    through the database of the Dejavu `config`: fetching every matching
+    row and aligning them with `Dejavu.align_matches`, against the offset
+    histogram of `Database.return_match_counts`. The query is a stretch of
+    one song, shifted in time, and both modes should find it.
+
+    The bundle is written under its own user and removed afterwards.
+    """
+    from dejavu import Dejavu
+
+    djv = Dejavu(config)
+    db = djv.db
+    user, bundle, admin = "dejavu-benchmark", "match", 0
+    songs = synthetic_bundle(nsongs, hashes_per_song, vocabulary,
+                             djv.fingerprint_format)
+
+    db.delete_bundle(user, bundle, admin)
+    try:
+        sids = []
+        for n, hashes in enumerate(songs):
+            sid = db.insert_song("song-%d" % n, "benchmark", user, bundle, admin)
+            db.insert_hashes(sid, hashes, "benchmark", user, bundle, admin)
+            db.set_song_fingerprinted(sid)
+            sids.append(sid)
+
+        # a stretch of the middle song, 50 windows into the query
+        target = len(songs) // 2
+        start = (hashes_per_song - query_hashes) // 2
+        shift = songs[target][start][1] - 50
+        query = [(h, offset - shift)
+                 for h, offset in songs[target][start:start + query_hashes]]
+
+        rows_time, rows = best_time(
+            lambda: djv.align_matches(
+                db.return_matches(query, user, bundle, admin)),
+            repeat=repeat)
+        nrows = sum(1 for _ in db.return_matches(query, user, bundle, admin))
+        histogram_time, counts = best_time(
+            db.return_match_counts, query, user, bundle, admin,
+            djv.match_candidates, repeat=repeat)
+        histogram = djv.align_match_counts(counts)
+    finally:
+        db.delete_bundle(user, bundle, admin)
+
+    found = lambda match: (match and match[djv.SONG_ID] == sids[target] and
+                           match[djv.OFFSET] == shift)
+    return {
+        "fingerprints": nsongs * hashes_per_song,
+        "query_hashes": query_hashes,
+        "rows_fetched": nrows,
+        "rows_secs": rows_time,
+        "histogram_rows_fetched": len(counts),
+        "histogram_secs": histogram_time,
+        "speedup": rows_time / histogram_time if histogram_time else float("inf"),
+        "rows_found": bool(found(rows)),
+        "histogram_found": bool(found(histogram)),
+    }
+
+
+def _align_matches_loop(matches):
+    """
+    The original dict based alignment, kept as the reference for
+    `align.top_alignments`. Returns (song_id, diff, count) of the best
+    aligned pair.
+    """
+    diff_counter = {}
+    largest = 0
+    largest_count = 0
+    song_id = -1
+    for sid, diff in matches:
+        if diff not in diff_counter:
+            diff_counter[diff] = {}
+        if sid not in diff_counter[diff]:
+            diff_counter[diff][sid] = 0
+        diff_counter[diff][sid] += 1
+
+        if diff_counter[diff][sid] > largest_count:
+            largest = diff
+            largest_count = diff_counter[diff][sid]
+            song_id = sid
+    return song_id, largest, largest_count
+
+
+def synthetic_matches(nrows, nsongs=1000, max_offset=10000, seed=42):
+    """
+    (sids, diffs) arrays of `nrows` matches as a lookup in a big bundle
+    returns them: mostly chance matches spread over songs and offset
+    differences, and 1% lined up on the song and offset of the query.
+    """
+    rng = np.random.RandomState(seed)
+    sids = rng.randint(1, nsongs + 1, nrows).astype(np.int64)
+    diffs = rng.randint(-max_offset, max_offset, nrows).astype(np.int64)
+    aligned = rng.rand(nrows) < 0.01
+    sids[aligned] = nsongs // 2
+    diffs[aligned] = 1234
+    return sids, diffs
+
+
+def bench_align(sizes=(10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7), loop_rows=10 ** 6,
+                top_n=5, repeat=3):
+    """
+    Times `align.top_alignments` against the original dict based
+    alignment on synthetic match sets of each of `sizes` rows, and checks
+    both find the same best match. The vectorized engine is timed on
+    arrays, and on lists of tuples like `Database.return_matches` yields,
+    converted by `align.match_arrays`. The loop, and the conversion, are
+    only timed up to `loop_rows` rows.
+
+    Returns the measurements of each size, by number of rows.
+    """
+    import dejavu.align as align
+
+    results = {}
+    for nrows in sizes:
+        sids, diffs = synthetic_matches(nrows)
+        arrays_time, top = best_time(align.top_alignments, sids, diffs,
+                                     top_n, repeat=repeat)
+        result = {"rows": nrows, "arrays_secs": arrays_time,
+                  "rows_per_sec": nrows / arrays_time if arrays_time else float("inf"),
+                  "top": top}
+
+        if nrows <= loop_rows:
+            matches = zip(sids.tolist(), diffs.tolist())
+            loop_time, expected = best_time(_align_matches_loop, matches,
+                                            repeat=repeat)
+            tuples_time, _ = best_time(
+                lambda: align.top_alignments(
+                    *align.match_arrays(matches), n=top_n),
+                repeat=repeat)
+            result.update(
+                loop_secs=loop_time, tuples_secs=tuples_time,
+                speedup=loop_time / tuples_time if tuples_time else float("inf"),
+                identical=tuple(top[0]) == expected)
+        results[nrows] = result
+    return results
+
+
+def _bench_database(config, songs, queries, repeat):
+    """
+    Ingestion rate and query latencies of the database of `config`, see
+    `bench_databases`.
+    """
+    from dejavu import Dejavu
+
+    djv = Dejavu(config)
+    db = djv.db
+    user, bundle, admin = "dejavu-benchmark", "databases", 0
+
+    db.delete_bundle(user, bundle, admin)
+    try:
+        t = time.time()
+        sids = []
+        for n, hashes in enumerate(songs):
+            sid = db.insert_song("song-%d" % n, "benchmark", user, bundle, admin)
+            db.insert_hashes(sid, hashes, "benchmark", user, bundle, admin)
+            db.set_song_fingerprinted(sid)
+            sids.append(sid)
+        ingest_time = time.time() - t
+
+        rows_times, histogram_times, found = [], [], 0
+        for target, shift, query in queries:
+            rows_time, rows = best_time(
+                lambda: djv.align_matches(
+                    db.return_matches(query, user, bundle, admin)),
+                repeat=repeat)
+            histogram_time, _ = best_time(
+                db.return_match_counts, query, user, bundle, admin,
+                djv.match_candidates, repeat=repeat)
+            rows_times.append(rows_time)
+            histogram_times.append(histogram_time)
+            found += bool(rows and rows[djv.SONG_ID] == sids[target] and
+                          rows[djv.OFFSET] == shift)
+    finally:
+        db.delete_bundle(user, bundle, admin)
+
+    fingerprints = sum(len(hashes) for hashes in songs)
+    return {
+        "fingerprints_per_sec": fingerprints / ingest_time if ingest_time else float("inf"),
+        "ingest_secs": ingest_time,
+        "rows_median_ms": 1000 * np.median(rows_times),
+        "rows_max_ms": 1000 * max(rows_times),
+        "histogram_median_ms": 1000 * np.median(histogram_times),
+        "histogram_max_ms": 1000 * max(histogram_times),
+        "found": "%d/%d" % (found, len(queries)),
+    }
+
+
+def bench_databases(config=None, nsongs=50, hashes_per_song=10000,
+                    vocabulary=200000, query_hashes=500, nqueries=20, repeat=3):
+    """
+    Compares the database of the Dejavu `config`, MySQL normally, with a
+    scratch SQLite database on the same synthetic bundle: the rate songs
+    are written at, one transaction each, and the latency of `nqueries`
+    queries, stretches of different songs, in both match modes. Without
+    `config` only SQLite is measured.
+
+    The bundle is written under its own user and removed afterwards.
+    """
+    import tempfile
+
+    fingerprint_format = (config or {}).get("fingerprint_format",
+                                            fingerprint.DEFAULT_FINGERPRINT_FORMAT)
+    songs = synthetic_bundle(nsongs, hashes_per_song, vocabulary,
+                             fingerprint_format)
+    rng = np.random.RandomState(42)
+    queries = []
+    for target in rng.randint(0, nsongs, nqueries).tolist():
+        start = rng.randint(0, hashes_per_song - query_hashes)
+        shift = songs[target][start][1] - 50
+        queries.append((target, shift, [
+            (h, offset - shift)
+            for h, offset in songs[target][start:start + query_hashes]]))
+
+    fd, path = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    configs = {"sqlite": {
+        "database_type": "sqlite",
+        "database": {"path": path},
+        "fingerprint_format": fingerprint_format,
+        "fingerprint": (config or {}).get("fingerprint", {}),
+    }}
+    if config is not None:
+        configs[config.get("database_type", "mysql")] = config
+
+    try:
+        return dict((name, _bench_database(backend_config, songs, queries, repeat))
+                    for name, backend_config in configs.items())
+    finally:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def skewed_bundle(nsongs, hashes_per_song, vocabulary, common_vocabulary,
+                  common_share, fingerprint_format, seed=42):
+    """
+    Like `synthetic_bundle`, with a `common_share` of the hashes of each
+    song drawn from `common_vocabulary` hashes that turn up in most
+    songs, the way a few hashes do in real bundles, see
+    `stophashes.StopHashes`.
+    """
+    rng = np.random.RandomState(seed)
+    songs = synthetic_bundle(nsongs, hashes_per_song, vocabulary,
+                             fingerprint_format, seed)
+    ncommon = int(hashes_per_song * common_share)
+    for hashes in songs:
+        positions = rng.choice(hashes_per_song, ncommon, replace=False)
+        # past the hashes of the vocabulary
+        values = (vocabulary + rng.randint(0, common_vocabulary, ncommon)).tolist()
+        for position, value in zip(positions.tolist(), values):
+            if fingerprint_format == fingerprint.FORMAT_SHA1:
+                value = "%020x" % value
+            hashes[position] = (value, hashes[position][1])
+    return songs
+
+
+def bench_stop_hashes(nsongs=100, hashes_per_song=10000, vocabulary=500000,
+                      common_vocabulary=1000, common_share=0.3, max_share=0.05,
+                      query_hashes=500, nqueries=20, repeat=3):
+    """
+    What stop hashes save on a synthetic bundle where a `common_share` of
+    the hashes of each song are common ones, in a scratch SQLite
+    database: the share of fingerprints that are stop hashes at
+    `max_share`, and the fingerprints and bytes left once songs are
+    stored without them, and the latency of `nqueries` queries aligned
+    by `Dejavu.align_matches`, with every hash, leaving out the stop
+    hashes, and against the pruned database.
+    """
+    import shutil
+    import sqlite3
+    import tempfile
+    from dejavu import Dejavu
+
+    fingerprint_format = fingerprint.DEFAULT_FINGERPRINT_FORMAT
+    songs = skewed_bundle(nsongs, hashes_per_song, vocabulary,
+                          common_vocabulary, common_share, fingerprint_format)
+    rng = np.random.RandomState(42)
+    queries = []
+    for target in rng.randint(0, nsongs, nqueries).tolist():
+        start = rng.randint(0, hashes_per_song - query_hashes)
+        shift = songs[target][start][1] - 50
+        queries.append((target, shift, [
+            (h, offset - shift)
+            for h, offset in songs[target][start:start + query_hashes]]))
+
+    directory = tempfile.mkdtemp()
+    user, bundle, admin = "dejavu-benchmark", "stop-hashes", 0
+
+    def store(name, prune_stored):
+        djv = Dejavu({
+            "database_type": "sqlite",
+            "database": {"path": os.path.join(directory, name + ".sqlite")},
+            "fingerprint_format": fingerprint_format,
+            "fingerprint": {},
+            "stop_hashes": {"directory": os.path.join(directory, name),
+                            "max_share": max_share,
+                            "prune_stored": prune_stored},
+        })
+        db, stop_hashes = djv.db, djv.stop_hashes
+        sids = []
+        # pruned by the counts of the songs before, so the first ones,
+        # until hashes are in enough songs to be stop hashes, are whole
+        for n, hashes in enumerate(songs):
+            sid = db.insert_song("song-%d" % n, "benchmark", user, bundle, admin)
+            hashes = stop_hashes.prune(db, hashes, user, bundle, admin)
+            db.insert_hashes(sid, hashes, "benchmark", user, bundle, admin)
+            db.set_song_fingerprinted(sid)
+            stop_hashes.add((user, bundle, admin), [(sid, hashes)])
+            sids.append(sid)
+
+        path = os.path.join(directory, name + ".sqlite")
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.close()
+        return djv, sids, db.get_num_fingerprints(), os.path.getsize(path)
+
+    def query(djv, sids, skip):
+        # leaving out the stop hashes is timed with the lookup
+        lookup = lambda hashes: djv.db.return_matches(
+            djv.stop_hashes.filter(djv.db, hashes, user, bundle, admin)
+            if skip else hashes, user, bundle, admin)
+        times, found, nrows = [], 0, 0
+        for target, shift, hashes in queries:
+            query_time, match = best_time(
+                lambda: djv.align_matches(lookup(hashes)), repeat=repeat)
+            times.append(query_time)
+            found += bool(match and match[djv.SONG_ID] == sids[target] and
+                          match[djv.OFFSET] == shift)
+            nrows += sum(1 for _ in lookup(hashes))
+        return times, found, nrows
+
+    try:
+        full, full_sids, full_rows, full_bytes = store("full", False)
+        pruned, pruned_sids, pruned_rows, pruned_bytes = store("pruned", True)
+        stats = full.stop_hash_stats()["%s/%s" % (user, bundle)]
+
+        all_times, all_found, all_rows = query(full, full_sids, False)
+        skip_times, skip_found, skip_rows = query(full, full_sids, True)
+        pruned_times, pruned_found, _ = query(pruned, pruned_sids, True)
+    finally:
+        shutil.rmtree(directory, True)
+
+    return {
+        "stop_hashes": stats["stop_hashes"],
+        "stop_share": stats["stop_share"],
+        "fingerprints": full_rows,
+        "pruned_fingerprints": pruned_rows,
+        "bytes": full_bytes,
+        "pruned_bytes": pruned_bytes,
+        "rows_fetched": all_rows,
+        "skip_rows_fetched": skip_rows,
+        "all_median_ms": 1000 * np.median(all_times),
+        "skip_median_ms": 1000 * np.median(skip_times),
+        "pruned_median_ms": 1000 * np.median(pruned_times),
+        "all_found": "%d/%d" % (all_found, nqueries),
+        "skip_found": "%d/%d" % (skip_found, nqueries),
+        "pruned_found": "%d/%d" % (pruned_found, nqueries),
+    }
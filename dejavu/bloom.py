@@ -0,0 +1,424 @@
+"""
+Bloom filters of the hashes stored in each bundle, so lookups can leave
+out the query hashes a bundle certainly doesn't hold; most hashes of a
+noisy recording match nothing, and the database then never sees them.
+
+A filter says a hash may be in the bundle, or that it is not, and never
+misses a hash of the songs it holds. It only holds the songs it was told
+about: the songs this process writes are added as they are stored, and
+every `check_interval` seconds the filter is compared with the songs the
+database lists for the bundle, adding the hashes of songs written by
+other processes, see `Database.get_bundle_hashes`. Until then, up to
+`check_interval` seconds after they are stored, those songs are missed
+by lookups through the filter; a `check_interval` of 0 compares the
+filter with the database on every lookup. Deleted songs stay in
+the filter, which only lets a few more hashes through, until more than
+STALE_RATIO of its songs are gone and it is built again.
+
+A filter grows by stages: once a stage holds its capacity of hashes, a
+new one twice as large, or as large as the hashes left to add, with half
+the error rate is added, which keeps the false positive rate of the
+whole filter under twice the configured one.
+
+Filters are kept in `directory`, one file per bundle, and built again
+from the database if they were saved by another version or for another
+fingerprint format.
+"""
+from __future__ import division
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+
+import numpy as np
+
+from dejavu.fingerprint import FORMAT_INT64
+from dejavu.logs import get_logger
+
+logger = get_logger('Classification_Dejavu_Bloom', "dejavu.log")
+
+DEFAULT_CAPACITY = 1 << 20
+DEFAULT_ERROR_RATE = 0.01
+DEFAULT_CHECK_INTERVAL = 60
+# capacity and error rate of each new stage, relative to the last one
+GROWTH = 2
+TIGHTENING = 0.5
+# a filter is built again once this share of its songs were deleted
+STALE_RATIO = 0.5
+# keys hashed at once, bounding the (keys, nhashes) position arrays
+CHUNK_SIZE = 1 << 16
+# of the files filters are saved in, and of how their keys are made,
+# see `hash_keys`; files of another version are built again
+FILE_VERSION = 1
+
+_GOLDEN = np.uint64(0x9e3779b97f4a7c15)
+_MIX1 = np.uint64(0xbf58476d1ce4e5b9)
+_MIX2 = np.uint64(0x94d049bb133111eb)
+
+
+def mix_keys(x):
+    """
+    splitmix64 finalizer of a uint64 array, wrapping on overflow.
+    """
+    x = x ^ (x >> np.uint64(30))
+    x = x * _MIX1
+    x = x ^ (x >> np.uint64(27))
+    x = x * _MIX2
+    return x ^ (x >> np.uint64(31))
+
+
+def hash_keys(hashes, fingerprint_format):
+    """
+    uint64 keys of fingerprint `hashes`: int64 fingerprints as they are,
+    sha1 hex strings, in either case, by their last 16 digits, which
+    leading zeros added to odd lengths don't change.
+    """
+    if fingerprint_format == FORMAT_INT64:
+        return np.array(hashes, dtype=np.uint64).reshape(-1)
+    return np.fromiter((int(h[-16:], 16) for h in hashes), dtype=np.uint64,
+                       count=len(hashes))
+
+
+class BloomFilter(object):
+    """
+    Plain Bloom filter of `nbits` bits probed `nhashes` times per key, by
+    double hashing.
+    """
+
+    def __init__(self, nbits, nhashes, bits=None, count=0):
+        super(BloomFilter, self).__init__()
+        self.nbits = nbits
+        self.nhashes = nhashes
+        self.bits = bits if bits is not None else \
+            np.zeros((nbits + 7) // 8, dtype=np.uint8)
+        self.count = count
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate):
+        capacity = max(int(capacity), 1)
+        nbits = int(math.ceil(-capacity * math.log(error_rate) /
+                              math.log(2) ** 2))
+        nhashes = max(1, int(round(nbits / capacity * math.log(2))))
+        return cls(nbits, nhashes)
+
+    def _positions(self, keys):
+        h1 = mix_keys(keys ^ _GOLDEN)
+        h2 = mix_keys(h1) | np.uint64(1)
+        probes = np.arange(self.nhashes, dtype=np.uint64)
+        return (h1[:, None] + probes * h2[:, None]) % np.uint64(self.nbits)
+
+    def add(self, keys):
+        for start in xrange(0, len(keys), CHUNK_SIZE):
+            positions = np.unique(self._positions(keys[start:start + CHUNK_SIZE]))
+            offsets = positions >> np.uint64(3)
+            masks = np.left_shift(1, positions & np.uint64(7)).astype(np.uint8)
+            # several positions can fall in one byte, OR them together
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(offsets)) + 1))
+            self.bits[offsets[starts]] |= np.bitwise_or.reduceat(masks, starts)
+        self.count += len(keys)
+
+    def contains(self, keys):
+        found = np.zeros(len(keys), dtype=bool)
+        for start in xrange(0, len(keys), CHUNK_SIZE):
+            positions = self._positions(keys[start:start + CHUNK_SIZE])
+            set_bits = (self.bits[positions >> np.uint64(3)] >>
+                        (positions & np.uint64(7)).astype(np.uint8)) & 1
+            found[start:start + CHUNK_SIZE] = set_bits.all(axis=1)
+        return found
+
+    def false_positive_rate(self):
+        """
+        Chance a key not added is found, from the share of bits set.
+        """
+        fill = np.unpackbits(self.bits)[:self.nbits].mean()
+        return fill ** self.nhashes
+
+
+class BundleFilter(object):
+    """
+    Filter of the hashes of one bundle, in stages, with the ids of the
+    songs it holds and counts of the lookups it filtered.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE,
+                 stages=None, sids=()):
+        super(BundleFilter, self).__init__()
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # (filter, capacity, error rate) of each stage
+        self.stages = stages or []
+        self.sids = set(sids)
+        self.checked = 0
+        self.dirty = False
+        self.lookups = 0
+        self.hashes = 0
+        self.dropped = 0
+
+    def _stage(self, nkeys):
+        """
+        The last stage and its capacity if it has room left, otherwise a
+        new one, large enough for `nkeys` keys.
+        """
+        if self.stages:
+            stage, capacity, error_rate = self.stages[-1]
+            if stage.count < capacity:
+                return stage, capacity
+            capacity, error_rate = capacity * GROWTH, error_rate * TIGHTENING
+        else:
+            capacity, error_rate = self.capacity, self.error_rate
+        capacity = max(capacity, nkeys)
+        stage = BloomFilter.for_capacity(capacity, error_rate)
+        self.stages.append((stage, capacity, error_rate))
+        return stage, capacity
+
+    def add(self, sids, keys):
+        # no stage holds more than its capacity, which its error rate
+        # is for
+        start = 0
+        while start < len(keys):
+            stage, capacity = self._stage(len(keys) - start)
+            end = start + capacity - stage.count
+            stage.add(keys[start:end])
+            start = end
+        self.sids.update(sids)
+        self.dirty = True
+
+    def contains(self, keys):
+        found = np.zeros(len(keys), dtype=bool)
+        for stage, _, _ in self.stages:
+            found |= stage.contains(keys)
+        return found
+
+    def false_positive_rate(self):
+        """
+        Estimated from how full the stages are.
+        """
+        rate = 1.0
+        for stage, _, _ in self.stages:
+            rate *= 1 - stage.false_positive_rate()
+        return 1 - rate
+
+    def measured_false_positive_rate(self, samples=10000, seed=42):
+        """
+        Share of `samples` random keys found. Fingerprint hashes are
+        mixed before probing, so random keys stand for hashes the bundle
+        doesn't hold.
+        """
+        rng = np.random.RandomState(seed)
+        keys = (rng.randint(0, 1 << 32, samples).astype(np.uint64) <<
+                np.uint64(32)) | rng.randint(0, 1 << 32, samples).astype(np.uint64)
+        return self.contains(keys).mean() if samples else 0.0
+
+    def stats(self):
+        return {
+            "songs": len(self.sids),
+            "keys": sum(stage.count for stage, _, _ in self.stages),
+            "bytes": sum(stage.bits.nbytes for stage, _, _ in self.stages),
+            "stages": len(self.stages),
+            "lookups": self.lookups,
+            "hashes": self.hashes,
+            "dropped": self.dropped,
+            "drop_rate": self.dropped / self.hashes if self.hashes else 0.0,
+            "false_positive_rate": self.false_positive_rate(),
+            "measured_false_positive_rate": self.measured_false_positive_rate(),
+        }
+
+    def save(self, filename, fingerprint_format):
+        meta = {
+            "version": FILE_VERSION, "fingerprint_format": fingerprint_format,
+            "capacity": self.capacity, "error_rate": self.error_rate,
+            "sids": sorted(self.sids),
+            "stages": [(stage.nbits, stage.nhashes, stage.count, capacity,
+                        error_rate)
+                       for stage, capacity, error_rate in self.stages],
+        }
+        arrays = dict(("stage%d" % n, stage.bits)
+                      for n, (stage, _, _) in enumerate(self.stages))
+        tmp_file = "%s.%d.tmp" % (filename, os.getpid())
+        with open(tmp_file, "wb") as f:
+            np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+        os.rename(tmp_file, filename)
+        self.dirty = False
+
+    @classmethod
+    def load(cls, filename, fingerprint_format):
+        """
+        Raises ValueError if the filter was saved by another version, or
+        for another fingerprint format.
+        """
+        with np.load(filename) as data:
+            meta = json.loads(str(data["meta"]))
+            if (meta.get("version"), meta.get("fingerprint_format")) != \
+                    (FILE_VERSION, fingerprint_format):
+                raise ValueError("version %s filter of %s fingerprints" % (
+                    meta.get("version"), meta.get("fingerprint_format")))
+            stages = [(BloomFilter(nbits, nhashes, data["stage%d" % n], count),
+                       capacity, error_rate)
+                      for n, (nbits, nhashes, count, capacity, error_rate)
+                      in enumerate(meta["stages"])]
+        return cls(meta["capacity"], meta["error_rate"], stages, meta["sids"])
+
+
+class BloomFilters(object):
+    """
+    The filters of every bundle, kept in `directory`.
+
+    ```python
+    filters = BloomFilters(fingerprint.FORMAT_SHA1)
+    filters.add(key, [sid], hashes)
+    hashes = filters.filter(db, hashes, user, bundle, admin)
+    filters.save()
+    ```
+    """
+
+    def __init__(self, fingerprint_format, directory="bloom_filters",
+                 capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE,
+                 check_interval=DEFAULT_CHECK_INTERVAL):
+        super(BloomFilters, self).__init__()
+        self.fingerprint_format = fingerprint_format
+        self.directory = directory
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.check_interval = check_interval
+        # (user, bundle, admin) -> BundleFilter
+        self.filters = {}
+        # set once the database can't list the hashes of a bundle
+        self.disabled = False
+        self._lock = threading.RLock()
+
+    def _filename(self, key):
+        digest = hashlib.sha1(json.dumps(key)).hexdigest()
+        return os.path.join(self.directory, digest + ".bloom")
+
+    def _filter(self, key):
+        """
+        The filter of the bundle, loaded from `directory` or new.
+        """
+        # with the lock held
+        bundle_filter = self.filters.get(key)
+        if bundle_filter is None:
+            filename = self._filename(key)
+            if os.path.exists(filename):
+                try:
+                    bundle_filter = BundleFilter.load(
+                        filename, self.fingerprint_format)
+                except Exception as e:
+                    logger.warning("Failed loading %s, rebuilding it: %s"
+                                   % (filename, e))
+            if bundle_filter is None:
+                bundle_filter = BundleFilter(self.capacity, self.error_rate)
+            self.filters[key] = bundle_filter
+        return bundle_filter
+
+    def add(self, key, sids, hashes):
+        """
+        Adds the `hashes` of the songs `sids` of the bundle `key`, (user,
+        bundle, admin), once they are stored and marked fingerprinted.
+        """
+        if key[2]:
+            # admin lookups are not filtered
+            return
+        keys = hash_keys(hashes, self.fingerprint_format)
+        with self._lock:
+            self._filter((key[0], key[1], False)).add(sids, keys)
+
+    def _check(self, db, key):
+        """
+        Brings the filter of bundle `key` in line with the songs the
+        database lists for it, returns None if it can't be.
+        """
+        # with the lock held
+        if not db.lists_bundle_hashes:
+            logger.warning("%s databases can't list the hashes of a "
+                           "bundle, Bloom filters are off" % db.type)
+            self.disabled = True
+            return None
+        bundle_filter = self._filter(key)
+        if time.time() - bundle_filter.checked < self.check_interval:
+            return bundle_filter
+
+        sids = set(song[0] for song in db.get_song_files(*key))
+        if len(bundle_filter.sids - sids) > STALE_RATIO * len(bundle_filter.sids):
+            logger.info("Rebuilding the Bloom filter of %s/%s" % key[:2])
+            bundle_filter = BundleFilter(self.capacity, self.error_rate)
+            self.filters[key] = bundle_filter
+        missing = sids - bundle_filter.sids
+        if missing:
+            hashes = [hash for hash, _ in db.get_bundle_hashes(
+                key[0], key[1], key[2], sorted(missing))]
+            bundle_filter.add(missing, hash_keys(hashes,
+                                                 self.fingerprint_format))
+        bundle_filter.checked = time.time()
+        return bundle_filter
+
+    def filter(self, db, hashes, user, bundle, admin):
+        """
+        Returns the (hash, offset) pairs of `hashes` whose hash may be in
+        the songs of the bundle the filter holds, which leaves out songs
+        other processes stored since the last check. Admin lookups, which
+        search every admin bundle of that name, are not filtered.
+        """
+        if admin or self.disabled:
+            return hashes
+        hashes = list(hashes)
+        key = (user, bundle, False)
+        with self._lock:
+            bundle_filter = self._check(db, key)
+            if bundle_filter is None:
+                return hashes
+            found = bundle_filter.contains(hash_keys(
+                [hash for hash, _ in hashes], self.fingerprint_format))
+            kept = [pair for pair, keep in zip(hashes, found) if keep]
+            bundle_filter.lookups += 1
+            bundle_filter.hashes += len(hashes)
+            bundle_filter.dropped += len(hashes) - len(kept)
+        return kept
+
+    def drop(self, key):
+        """
+        Forgets the filter of a deleted bundle.
+        """
+        key = (key[0], key[1], bool(key[2]))
+        with self._lock:
+            self.filters.pop(key, None)
+            filename = self._filename(key)
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def clear(self):
+        """
+        Forgets every filter, when the database was emptied.
+        """
+        with self._lock:
+            self.filters = {}
+            if os.path.isdir(self.directory):
+                for name in os.listdir(self.directory):
+                    if name.endswith(".bloom"):
+                        os.remove(os.path.join(self.directory, name))
+
+    def save(self):
+        """
+        Writes the filters changed since they were last saved.
+        """
+        with self._lock:
+            dirty = [(key, bundle_filter)
+                     for key, bundle_filter in self.filters.items()
+                     if bundle_filter.dirty]
+            if dirty and not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            for key, bundle_filter in dirty:
+                bundle_filter.save(self._filename(key),
+                                   self.fingerprint_format)
+
+    def stats(self):
+        """
+        Returns the stats of the filters used or changed by this process,
+        by "user/bundle", see `BundleFilter.stats`: lookups and hashes
+        filtered, the share of hashes dropped, and the false positive
+        rate estimated and measured with random hashes.
+        """
+        with self._lock:
+            return dict(("%s/%s" % key[:2], bundle_filter.stats())
+                        for key, bundle_filter in self.filters.items())
@@ -0,0 +1,200 @@
+"""
+Local on-disk cache of computed fingerprints.
+
+Entries are keyed by a checksum of the audio file's content together with
+everything else the hashes depend on: the version of the fingerprinting
+parameters, the decoder options and the limit. The same audio uploaded
+under another name, or to another bundle, or retrained after its bundle
+was erased, is then fingerprinted once.
+
+Each entry is a .npy file holding a structured array of (hash, offset)
+rows, the format `pipeline.save_hashes` hands hashes over in. The cache is
+kept under `max_bytes` by removing the least recently used entries; reads
+touch an entry's modification time, so it also serves as its last use.
+Writes go to a temporary file renamed into place, so several processes
+can share a cache directory.
+"""
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from dejavu.logs import get_logger
+
+logger = get_logger('Classification_Dejavu_Cache', "dejavu.log")
+
+DEFAULT_CACHE_DIR = "fingerprint_cache"
+DEFAULT_MAX_BYTES = 1 << 30
+
+# Once over `max_bytes` the cache is trimmed down to this fraction of it,
+# so it is not trimmed again on the next write
+LOW_WATER_MARK = 0.9
+
+# Bytes of a file read at a time to checksum it
+CHECKSUM_BLOCK_SIZE = 1 << 20
+
+SUFFIX = ".npy"
+
+
+def file_checksum(filename):
+    """
+    Returns the SHA1 hex digest of the content of `filename`.
+    """
+    checksum = hashlib.sha1()
+    with open(filename, "rb") as f:
+        while True:
+            block = f.read(CHECKSUM_BLOCK_SIZE)
+            if not block:
+                break
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+class FingerprintCache(object):
+    """
+    Fingerprints of audio files, stored in `directory` and kept under
+    `max_bytes` bytes in total.
+
+    ```python
+    cache = FingerprintCache("fingerprint_cache")
+    key = cache.key(filename, config)
+    arrays = cache.get(key)
+    if arrays is None:
+        arrays = ...
+        cache.put(key, *arrays)
+    ```
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        super(FingerprintCache, self).__init__()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # bytes in the cache, counted on the first write
+        self._size = None
+
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another process in the meantime
+                if not os.path.isdir(directory):
+                    raise
+
+    def key(self, filename, config, limit=None, decoder_options=None):
+        """
+        Returns the key of the fingerprints of `filename` with the
+        FingerprintConfig `config`, read by `decoder.iter_decode` with
+        `limit` and `decoder_options`.
+        """
+        options = sorted((decoder_options or {}).items())
+        stamp = "%s|%s|%r|%r" % (file_checksum(filename), config.version,
+                                 limit, options)
+        return hashlib.sha1(stamp).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + SUFFIX)
+
+    def get(self, key):
+        """
+        Returns the (hashes, offsets) arrays stored under `key`, or None
+        if there are none.
+        """
+        path = self._path(key)
+        try:
+            array = np.load(path)
+            # mark it as used
+            os.utime(path, None)
+        except (IOError, OSError, ValueError) as e:
+            if os.path.exists(path):
+                logger.warning("Unreadable cache entry %s: %s" % (path, e))
+            return None
+        return array["hash"], array["offset"]
+
+    def put(self, key, hashes, offsets):
+        """
+        Stores the (hashes, offsets) arrays under `key`, then removes the
+        least recently used entries if the cache has grown over
+        `max_bytes`.
+        """
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+        array = np.empty(len(hashes), dtype=[("hash", hashes.dtype),
+                                             ("offset", np.int64)])
+        array["hash"] = hashes
+        array["offset"] = offsets
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, array)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+        if self._size is None:
+            self._size = self.size()
+        else:
+            self._size += os.path.getsize(path)
+        if self._size > self.max_bytes:
+            self.evict(int(self.max_bytes * LOW_WATER_MARK))
+
+    def _entries(self):
+        """
+        Returns (last use, bytes, path) of every entry.
+        """
+        entries = []
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith(SUFFIX):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # evicted by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size(self):
+        """
+        Returns the bytes taken by the cache entries.
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, max_bytes):
+        """
+        Removes the least recently used entries until the cache takes
+        `max_bytes` bytes at most.
+        """
+        entries = sorted(self._entries())
+        size = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, entry_size, path in entries:
+            if size <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= entry_size
+            removed += 1
+        self._size = size
+        if removed:
+            logger.info("Evicted %d fingerprint cache entries, %d bytes left"
+                        % (removed, size))
+
+    def clear(self):
+        """
+        Removes every entry.
+        """
+        self.evict(0)
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 import abc
+import collections
 
 
 class Database(object):
@@ -9,6 +10,10 @@ class Database(object):
     # to refer to your class
     type = None
 
+    # Whether `get_bundle_hashes` is implemented, which Bloom filters and
+    # stop hashes need
+    lists_bundle_hashes = False
+
     def __init__(self):
         super(Database, self).__init__()
 
@@ -77,6 +82,51 @@ class Database(object):
         """
         pass
 
+    @abc.abstractmethod
+    def get_song_names(self, user, bundle, admin):
+        """
+        Returns the names of the fully fingerprinted songs of a bundle.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_song_files(self, user, bundle, admin):
+        """
+        Returns (sid, song_name, size, mtime, checksum) tuples of the fully
+        fingerprinted songs of a bundle, describing the audio file each
+        was fingerprinted from; the last three are None if not recorded.
+        """
+        pass
+
+    @abc.abstractmethod
+    def set_song_file(self, sid, size, mtime, checksum):
+        """
+        Records the size, modification time and SHA1 checksum of the audio
+        file a song was fingerprinted from.
+        """
+        pass
+
+    def get_bundle_hashes(self, user, bundle, admin, sids):
+        """
+        Returns (hash, sid) pairs of the fingerprints of songs of a
+        bundle, in no particular order, see `bloom.BloomFilters` and
+        `stophashes.StopHashes`.
+
+        Only called if `lists_bundle_hashes` is set.
+
+        sids: Identifiers of the songs
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_songs(self, user, bundle, admin, sids):
+        """
+        Removes songs of a bundle and their fingerprints.
+
+        sids: Identifiers of the songs
+        """
+        pass
+
     @abc.abstractmethod
     def get_song_by_id(self, sid):
         """
@@ -91,7 +141,7 @@ class Database(object):
         """
         Inserts a single fingerprint into the database.
 
-          hash: Part of a sha1 hash, in hexadecimal format
+          hash: Part of a sha1 hash, in hexadecimal format, or an int64 fingerprint
            sid: Song identifier this fingerprint is off
         offset: The offset this hash is from
         """
@@ -113,7 +163,7 @@ class Database(object):
         Returns all matching fingerprint entries associated with
         the given hash as parameter.
 
-        hash: Part of a sha1 hash, in hexadecimal format
+        hash: Part of a sha1 hash, in hexadecimal format, or an int64 fingerprint
         """
         pass
 
@@ -131,18 +181,47 @@ class Database(object):
 
            sid: Song identifier the fingerprints belong to
         hashes: A sequence of tuples in the format (hash, offset)
-        -   hash: Part of a sha1 hash, in hexadecimal format
+        -   hash: Part of a sha1 hash, in hexadecimal format, or an int64 fingerprint
         - offset: Offset this hash was created from/at.
         """
         pass
 
+    def insert_hashes_many(self, songs):
+        """
+        Inserts the fingerprints of several songs at once.
+
+        songs: A sequence of (sid, hashes, tag, user, bundle, admin) tuples,
+               the arguments of `insert_hashes`
+        """
+        for song in songs:
+            self.insert_hashes(*song)
+
+    def migrate_fingerprint_format(self, fingerprint_format):
+        """
+        Switches the database to another fingerprint format. Fingerprints
+        of one format can not be turned into the other, so stored songs
+        are dropped and have to be fingerprinted again.
+
+        fingerprint_format: One of `fingerprint.FINGERPRINT_FORMATS`
+        """
+        raise NotImplementedError
+
+    def migrate_schema(self, schema):
+        """
+        Rewrites the stored fingerprints into another table layout,
+        keeping the songs and their fingerprints.
+
+        schema: One of the layouts the backend supports
+        """
+        raise NotImplementedError
+
     @abc.abstractmethod
     def return_matches(self, hashes):
         """
         Searches the database for pairs of (hash, offset) values.
 
         hashes: A sequence of tuples in the format (hash, offset)
-        -   hash: Part of a sha1 hash, in hexadecimal format
+        -   hash: Part of a sha1 hash, in hexadecimal format, or an int64 fingerprint
         - offset: Offset this hash was created from/at.
 
         Returns a sequence of (sid, offset_difference) tuples.
@@ -152,6 +231,36 @@ class Database(object):
         """
         pass
 
+    def return_match_counts(self, hashes, user, bundle, admin, limit=10):
+        """
+        Offset histogram of the matches of `hashes`: the `limit` most
+        common (sid, offset_difference) pairs of `return_matches`.
+
+        Returns a list of (sid, offset_difference, count) tuples, most
+        common first. This counts the matches in Python; backends that can
+        should count them where the fingerprints are stored instead.
+        """
+        counts = collections.Counter(
+            self.return_matches(hashes, user, bundle, admin))
+        return [(sid, diff, count)
+                for (sid, diff), count in counts.most_common(limit)]
+
+
+class FingerprintFormatError(Exception):
+    """
+    Raised when a database holds fingerprints of another format than the
+    one requested.
+    """
+    pass
+
+
+class SchemaError(Exception):
+    """
+    Raised when a database stores its fingerprints in another layout than
+    the one requested.
+    """
+    pass
+
 
 def get_database(database_type=None):
     # Default to using the mysql database
@@ -168,3 +277,6 @@ def get_database(database_type=None):
 
 # Import our default database handler
 import dejavu.database_sql
+import dejavu.database_memindex
+import dejavu.database_sqlite
+import dejavu.database_segments
@@ -0,0 +1,478 @@
+"""
+Fingerprint index held in memory, for nodes that mostly recognize.
+
+The fingerprints of each (user, bundle, admin) bundle are kept as three
+NumPy arrays of hashes, song ids and offsets, sorted by hash, and a query
+looks all its hashes up at once with `np.searchsorted`. Songs are kept in
+a dict.
+
+The index can be saved as a snapshot in a directory: a JSON file with the
+songs and one .npy file per array. Snapshots are opened memory mapped, so
+loading one is instant and processes opening the same snapshot share one
+copy of it in the page cache. `save` writes a new generation of files and
+then switches the JSON file over to it in one step, so readers always see
+a whole snapshot; `reload` picks up the latest one.
+
+```python
+config = {
+    "database_type": "memindex",
+    "database": {"path": "/var/lib/dejavu/index"},
+}
+```
+"""
+from __future__ import absolute_import
+import glob
+import json
+import os
+import threading
+
+import numpy as np
+
+from dejavu.align import count_alignments
+from dejavu.database import Database, FingerprintFormatError
+from dejavu.fingerprint import FORMAT_SHA1, FORMAT_INT64
+from dejavu.logs import get_logger
+
+logger = get_logger('Classification_Dejavu_MemIndex', "dejavu.log")
+
+SNAPSHOT_FILE = "index.json"
+SNAPSHOT_VERSION = 1
+ARRAYS = ("hash", "sid", "offset")
+
+
+class _BundleIndex(object):
+    """
+    Fingerprints of one bundle as (hashes, sids, offsets) arrays sorted by
+    hash. Fingerprints added or deleted are merged into them before the
+    next lookup.
+    """
+
+    def __init__(self, hashes=None, sids=None, offsets=None):
+        self.hashes = hashes
+        self.sids = sids
+        self.offsets = offsets
+        self._added = []
+        self._deleted = set()
+
+    def __len__(self):
+        self.merge()
+        return 0 if self.hashes is None else len(self.hashes)
+
+    def add(self, hashes, sids, offsets):
+        self._added.append((hashes, sids, offsets))
+
+    def delete(self, sids):
+        self._deleted.update(sids)
+
+    def merge(self):
+        if not self._added and not self._deleted:
+            return
+        parts = self._added
+        if self.hashes is not None:
+            parts = [(self.hashes, self.sids, self.offsets)] + parts
+        self._added = []
+        if not parts:
+            self._deleted = set()
+            return
+
+        hashes = np.concatenate([part[0] for part in parts])
+        sids = np.concatenate([part[1] for part in parts])
+        offsets = np.concatenate([part[2] for part in parts])
+        if self._deleted:
+            keep = ~np.in1d(sids, np.fromiter(self._deleted, dtype=sids.dtype))
+            hashes, sids, offsets = hashes[keep], sids[keep], offsets[keep]
+            self._deleted = set()
+
+        order = np.argsort(hashes, kind="mergesort")
+        self.hashes = hashes[order]
+        self.sids = sids[order]
+        self.offsets = offsets[order]
+
+    def lookup(self, hashes):
+        """
+        Returns (rows, queries) of `hashes` in this index, see `lookup`.
+        """
+        self.merge()
+        return lookup(self.hashes, hashes)
+
+
+def lookup(sorted_hashes, hashes):
+    """
+    Looks all of `hashes` up in the array `sorted_hashes` at once. Returns
+    (rows, queries): the index of every entry of `sorted_hashes` matching
+    one of `hashes`, and the index in `hashes` of the one it matches.
+    """
+    if sorted_hashes is None or not len(sorted_hashes) or not len(hashes):
+        empty = np.zeros(0, dtype=np.intp)
+        return empty, empty
+
+    left = np.searchsorted(sorted_hashes, hashes, side="left")
+    right = np.searchsorted(sorted_hashes, hashes, side="right")
+    counts = right - left
+    total = counts.sum()
+    queries = np.repeat(np.arange(len(hashes)), counts)
+    # left of each query's run, plus the position within it
+    ends = np.cumsum(counts)
+    rows = np.repeat(left - (ends - counts), counts) + np.arange(total)
+    return rows, queries
+
+
+def hash_array(hashes, fingerprint_format):
+    """
+    Array of `hashes`: unsigned 64-bit integers, or sha1 hex strings.
+    """
+    if fingerprint_format == FORMAT_INT64:
+        return np.array(hashes, dtype=np.uint64)
+    return np.array(hashes, dtype=str)
+
+
+def query_arrays(hashes, fingerprint_format, unique):
+    """
+    Returns (hashes, offsets) arrays of the (hash, offset) pairs of a
+    query. With `unique` each hash is kept once, with the last of its
+    offsets, like `SQLDatabase.return_matches` looks them up.
+    """
+    if not hashes:
+        return hash_array([], fingerprint_format), np.zeros(0, dtype=np.int64)
+    values, offsets = zip(*hashes)
+    values = hash_array(values, fingerprint_format)
+    offsets = np.array(offsets, dtype=np.int64)
+    if unique:
+        _, last = np.unique(values[::-1], return_index=True)
+        last = len(values) - 1 - last
+        values, offsets = values[last], offsets[last]
+    return values, offsets
+
+
+class MemoryIndexDatabase(Database):
+    """
+    Database kept in memory as sorted arrays, saved to and loaded from
+    memory mapped snapshots in `path` if given. Changes are only written
+    to `path` by `save`.
+    """
+
+    type = "memindex"
+    lists_bundle_hashes = True
+
+    FIELD_SONGNAME = "song_name"
+
+    def __init__(self, fingerprint_format=FORMAT_SHA1, path=None, **options):
+        super(MemoryIndexDatabase, self).__init__()
+        if fingerprint_format not in (FORMAT_SHA1, FORMAT_INT64):
+            raise FingerprintFormatError(
+                "Unsupported fingerprint format: %s" % fingerprint_format)
+        self.fingerprint_format = fingerprint_format
+        self.path = path
+        self._lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        # sid -> song dict; (user, bundle, admin) -> _BundleIndex
+        self.songs = {}
+        self.bundles = {}
+        self._next_sid = 1
+        self._generation = 0
+
+    def _bundle(self, user, bundle, admin):
+        key = (user, bundle, bool(admin))
+        if key not in self.bundles:
+            self.bundles[key] = _BundleIndex()
+        return self.bundles[key]
+
+    def _match_bundles(self, user, bundle, admin):
+        """
+        The bundles a query of this tenant searches: the bundle of `user`,
+        or for admins every admin bundle of that name.
+        """
+        if admin:
+            return [index for (_, name, is_admin), index in self.bundles.items()
+                    if name == bundle and is_admin]
+        index = self.bundles.get((user, bundle, False))
+        return [index] if index is not None else []
+
+    def _hash_array(self, hashes):
+        return hash_array(hashes, self.fingerprint_format)
+
+    def setup(self):
+        """
+        Loads the snapshot in `path`, if there is one, and removes the
+        songs that were never completely fingerprinted.
+        """
+        if self.path and os.path.exists(os.path.join(self.path, SNAPSHOT_FILE)):
+            self.reload()
+        self.delete_unfingerprinted_songs()
+
+    def reload(self):
+        """
+        Replaces the index with the latest snapshot in `path`.
+        """
+        snapshot_file = os.path.join(self.path, SNAPSHOT_FILE)
+        with open(snapshot_file) as f:
+            snapshot = json.load(f)
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported snapshot version in %s"
+                             % snapshot_file)
+        if snapshot["fingerprint_format"] != self.fingerprint_format:
+            raise FingerprintFormatError(
+                "Snapshot holds %s fingerprints but %s was requested, "
+                "migrate it with `migrate_fingerprint_format` first."
+                % (snapshot["fingerprint_format"], self.fingerprint_format))
+
+        bundles = {}
+        for entry in snapshot["bundles"]:
+            arrays = [np.load(os.path.join(self.path, "%s.%s.npy" % (
+                entry["file"], name)), mmap_mode="r") for name in ARRAYS]
+            bundles[(entry["user"], entry["bundle"], entry["admin"])] = \
+                _BundleIndex(*arrays)
+
+        with self._lock:
+            self._clear()
+            self.songs = dict((int(sid), song) for sid, song
+                              in snapshot["songs"].items())
+            self.bundles = bundles
+            self._next_sid = snapshot["next_sid"]
+            self._generation = snapshot["generation"]
+
+    def save(self):
+        """
+        Writes the index to a new snapshot in `path`, then removes the
+        files of older ones. Processes that have an older snapshot open
+        keep reading it until they `reload`.
+        """
+        if not self.path:
+            raise ValueError("No snapshot path given")
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        with self._lock:
+            generation = self._generation + 1
+            bundles = []
+            for n, ((user, bundle, admin), index) in enumerate(
+                    sorted(self.bundles.items())):
+                index.merge()
+                if index.hashes is None:
+                    continue
+                name = "bundle-%d-%d" % (generation, n)
+                for array_name, array in zip(ARRAYS, (index.hashes, index.sids,
+                                                      index.offsets)):
+                    np.save(os.path.join(self.path, "%s.%s.npy" % (
+                        name, array_name)), array)
+                bundles.append({"user": user, "bundle": bundle,
+                                "admin": admin, "file": name})
+
+            snapshot = {
+                "version": SNAPSHOT_VERSION,
+                "generation": generation,
+                "fingerprint_format": self.fingerprint_format,
+                "next_sid": self._next_sid,
+                "songs": self.songs,
+                "bundles": bundles,
+            }
+            snapshot_file = os.path.join(self.path, SNAPSHOT_FILE)
+            tmp_file = "%s.%d.tmp" % (snapshot_file, os.getpid())
+            with open(tmp_file, "w") as f:
+                json.dump(snapshot, f)
+            os.rename(tmp_file, snapshot_file)
+            self._generation = generation
+
+        current = "bundle-%d-" % generation
+        for filename in glob.glob(os.path.join(self.path, "bundle-*.npy")):
+            if not os.path.basename(filename).startswith(current):
+                os.remove(filename)
+        logger.info("Saved fingerprint index snapshot %d to %s"
+                    % (generation, self.path))
+
+    def empty(self):
+        with self._lock:
+            generation = self._generation
+            self._clear()
+            self._generation = generation
+
+    def migrate_fingerprint_format(self, fingerprint_format):
+        """
+        Switches the index to another fingerprint format, dropping all
+        songs and fingerprints. Saved right away if there is a `path`.
+        """
+        if fingerprint_format not in (FORMAT_SHA1, FORMAT_INT64):
+            raise FingerprintFormatError(
+                "Unsupported fingerprint format: %s" % fingerprint_format)
+        self.empty()
+        self.fingerprint_format = fingerprint_format
+        if self.path:
+            self.save()
+
+    def delete_unfingerprinted_songs(self):
+        with self._lock:
+            unfinished = [sid for sid, song in self.songs.items()
+                          if not song["fingerprinted"]]
+            self._delete(unfinished)
+
+    def _delete(self, sids):
+        # with the lock held
+        by_bundle = {}
+        for sid in sids:
+            song = self.songs.pop(sid, None)
+            if song is not None:
+                key = (song["user"], song["bundle"], bool(song["admin"]))
+                by_bundle.setdefault(key, []).append(sid)
+        for key, bundle_sids in by_bundle.items():
+            if key in self.bundles:
+                self.bundles[key].delete(bundle_sids)
+
+    def delete_bundle(self, user, bundle, admin):
+        with self._lock:
+            self.bundles.pop((user, bundle, bool(admin)), None)
+            for sid, song in self.songs.items():
+                if (song["user"], song["bundle"], bool(song["admin"])) == \
+                        (user, bundle, bool(admin)):
+                    del self.songs[sid]
+
+    def get_bundle_hashes(self, user, bundle, admin, sids):
+        with self._lock:
+            index = self.bundles.get((user, bundle, bool(admin)))
+            if index is None:
+                return []
+            index.merge()
+            if index.hashes is None:
+                return []
+            rows = np.in1d(index.sids, np.array(list(sids), dtype=index.sids.dtype))
+            return zip(index.hashes[rows].tolist(), index.sids[rows].tolist())
+
+    def delete_songs(self, user, bundle, admin, sids):
+        with self._lock:
+            self._delete(sids)
+
+    def get_num_songs(self):
+        return sum(1 for song in self.songs.values() if song["fingerprinted"])
+
+    def get_num_fingerprints(self):
+        with self._lock:
+            return sum(len(index) for index in self.bundles.values())
+
+    def set_song_fingerprinted(self, sid):
+        with self._lock:
+            self.songs[sid]["fingerprinted"] = True
+
+    def get_songs(self):
+        for sid, song in sorted(self.songs.items()):
+            if song["fingerprinted"]:
+                yield {"song_id": sid, "song_name": song["song_name"]}
+
+    def _bundle_songs(self, user, bundle, admin):
+        return [(sid, song) for sid, song in sorted(self.songs.items())
+                if song["fingerprinted"] and song["user"] == user and
+                song["bundle"] == bundle and bool(song["admin"]) == bool(admin)]
+
+    def get_song_names(self, user, bundle, admin):
+        return [song["song_name"]
+                for _, song in self._bundle_songs(user, bundle, admin)]
+
+    def get_song_files(self, user, bundle, admin):
+        return [(sid, song["song_name"]) + tuple(song["file"])
+                for sid, song in self._bundle_songs(user, bundle, admin)]
+
+    def set_song_file(self, sid, size, mtime, checksum):
+        with self._lock:
+            self.songs[sid]["file"] = [size, mtime, checksum]
+
+    def get_song_by_id(self, sid):
+        song = self.songs.get(sid)
+        if song is None:
+            return None
+        return {"song_name": song["song_name"], "tag": song["tag"]}
+
+    def insert(self, hash, sid, offset, tag, user, bundle, admin=False):
+        self.insert_hashes(sid, [(hash, offset)], tag, user, bundle, admin)
+
+    def insert_song(self, songname, tag, user, bundle, admin=False,
+                    file_info=None):
+        with self._lock:
+            sid = self._next_sid
+            self._next_sid += 1
+            self.songs[sid] = {
+                "song_name": songname, "tag": tag, "user": user,
+                "bundle": bundle, "admin": bool(admin), "fingerprinted": False,
+                "file": list(file_info or (None, None, None)),
+            }
+            return sid
+
+    def query(self, hash):
+        """
+        Yields the (sid, offset) of every fingerprint of `hash`, or of
+        every fingerprint if `hash` is None.
+        """
+        with self._lock:
+            indexes = list(self.bundles.values())
+        for index in indexes:
+            if hash is None:
+                index.merge()
+                if index.hashes is None:
+                    continue
+                rows = np.arange(len(index.hashes))
+            else:
+                rows, _ = index.lookup(self._hash_array([hash]))
+            for sid, offset in zip(index.sids[rows].tolist(),
+                                   index.offsets[rows].tolist()):
+                yield sid, offset
+
+    def get_iterable_kv_pairs(self):
+        return self.query(None)
+
+    def insert_hashes(self, sid, hashes, tag, user, bundle, admin=False):
+        self.insert_hashes_many([(sid, hashes, tag, user, bundle, admin)])
+
+    def insert_hashes_many(self, songs):
+        """
+        Adds the fingerprints of several songs, (sid, hashes, tag, user,
+        bundle, admin) tuples; they are merged into the sorted arrays of
+        their bundles on the next lookup.
+        """
+        with self._lock:
+            for sid, hashes, tag, user, bundle, admin in songs:
+                if not hashes:
+                    continue
+                values, offsets = zip(*hashes)
+                self._bundle(user, bundle, admin).add(
+                    self._hash_array(values),
+                    np.repeat(np.int32(sid), len(values)),
+                    np.array(offsets, dtype=np.int32))
+
+    def _matches(self, hashes, user, bundle, admin, unique):
+        """
+        Returns (sids, diffs) arrays of the fingerprints matching the
+        (hash, offset) pairs `hashes`. With `unique` each hash is looked
+        up once, with the last of its offsets.
+        """
+        values, offsets = query_arrays(hashes, self.fingerprint_format, unique)
+        sids, diffs = [], []
+        with self._lock:
+            indexes = self._match_bundles(user, bundle, admin)
+            for index in indexes:
+                rows, queries = index.lookup(values)
+                sids.append(index.sids[rows].astype(np.int64))
+                diffs.append(index.offsets[rows].astype(np.int64) -
+                             offsets[queries])
+        if not sids:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+        return np.concatenate(sids), np.concatenate(diffs)
+
+    def return_matches(self, hashes, user, bundle, admin):
+        """
+        Returns the (sid, offset_difference) pairs of the fingerprints of
+        the bundle matching `hashes`, a list of (hash, offset) pairs.
+        """
+        sids, diffs = self._matches(list(hashes), user, bundle, admin, True)
+        return zip(sids.tolist(), diffs.tolist())
+
+    def return_match_counts(self, hashes, user, bundle, admin, limit=10):
+        """
+        Offset histogram of every (hash, offset) pair of the query, like
+        `SQLDatabase.return_match_counts`, counted with
+        `align.count_alignments`.
+        """
+        sids, diffs = self._matches(list(hashes), user, bundle, admin, False)
+        sids, diffs, counts = count_alignments(sids, diffs)
+        order = np.lexsort((diffs, sids, -counts))[:limit]
+        return zip(sids[order].tolist(), diffs[order].tolist(),
+                   counts[order].tolist())
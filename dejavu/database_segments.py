@@ -0,0 +1,600 @@
+"""
+Log structured fingerprint store, for nodes that ingest a lot.
+
+Every call writing fingerprints writes them, sorted by hash, to a new
+immutable segment file per bundle, and nothing else: there is no index to
+update, so ingestion runs at the speed of the disk. Lookups search every
+segment of a bundle with `np.searchsorted`, the segments being opened
+memory mapped.
+
+Everything else is appended to a log, one JSON record per line: songs,
+their fingerprinted flag, segments, and tombstones of deleted songs and
+bundles. The state is rebuilt from the log when the store is opened.
+Tombstones hide their fingerprints from lookups right away; a background
+thread merges the segments of bundles that have more than `max_segments`
+of them, or tombstones, into one, leaving out the deleted fingerprints,
+removes segment files no longer used and rewrites the log to the current
+state.
+
+A store has one writing process at a time.
+
+```python
+config = {
+    "database_type": "segments",
+    "database": {"path": "/var/lib/dejavu/segments"},
+}
+```
+"""
+from __future__ import absolute_import
+import glob
+import json
+import os
+import threading
+
+import numpy as np
+
+from dejavu.align import count_alignments
+from dejavu.database import Database, FingerprintFormatError
+from dejavu.database_memindex import hash_array, lookup, query_arrays
+from dejavu.fingerprint import FORMAT_SHA1, FORMAT_INT64
+from dejavu.logs import get_logger
+
+logger = get_logger('Classification_Dejavu_Segments', "dejavu.log")
+
+LOG_FILE = "store.log"
+DEFAULT_MAX_SEGMENTS = 16
+# seconds the compaction thread sleeps between checks when not woken up
+COMPACTION_INTERVAL = 60
+
+
+class SegmentDatabase(Database):
+    """
+    Database kept in segment files and a log in the directory `path`.
+    """
+
+    type = "segments"
+    lists_bundle_hashes = True
+
+    FIELD_SONGNAME = "song_name"
+
+    def __init__(self, fingerprint_format=FORMAT_SHA1, path="segments",
+                 max_segments=DEFAULT_MAX_SEGMENTS, **options):
+        super(SegmentDatabase, self).__init__()
+        if fingerprint_format not in (FORMAT_SHA1, FORMAT_INT64):
+            raise FingerprintFormatError(
+                "Unsupported fingerprint format: %s" % fingerprint_format)
+        self.fingerprint_format = fingerprint_format
+        self.path = path
+        self.max_segments = max_segments
+        self._log = None
+        self._compactor = None
+        self._reset()
+
+    def _reset(self):
+        self._reset_lock()
+        self._closing = False
+        # sid -> song dict
+        self.songs = {}
+        # (user, bundle, admin) -> names of its segments, oldest first
+        self.segments = {}
+        # (user, bundle, admin) -> sids deleted but still in its segments
+        self.deleted = {}
+        # segment name -> memory mapped array
+        self._arrays = {}
+        # segments written but not in the log yet
+        self._writing = set()
+        self._next_sid = 1
+        self._next_segment = 1
+
+    def _reset_lock(self):
+        self._lock = threading.RLock()
+        self._wakeup = threading.Condition(self._lock)
+
+    def _dtype(self, hashes):
+        return np.dtype([("hash", hashes.dtype), ("sid", "<i4"),
+                         ("offset", "<i4")])
+
+    # log
+
+    def _append(self, record):
+        # with the lock held
+        if self._log is None:
+            self._log = open(os.path.join(self.path, LOG_FILE), "a")
+        self._log.write(json.dumps(record) + "\n")
+        self._log.flush()
+
+    def _replay(self):
+        log_file = os.path.join(self.path, LOG_FILE)
+        if not os.path.exists(log_file):
+            return
+        with open(log_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the line being written when the process was stopped
+                    continue
+                self._apply(record)
+
+    def _apply(self, record):
+        op = record["op"]
+        if op == "format":
+            if record["fingerprint_format"] != self.fingerprint_format:
+                raise FingerprintFormatError(
+                    "Store holds %s fingerprints but %s was requested, "
+                    "migrate it with `migrate_fingerprint_format` first."
+                    % (record["fingerprint_format"], self.fingerprint_format))
+            # ids are never reused, whatever was deleted
+            self._next_sid = max(self._next_sid, record.get("next_sid", 1))
+            self._next_segment = max(self._next_segment,
+                                     record.get("next_segment", 1))
+        elif op == "song":
+            sid = record["sid"]
+            self.songs[sid] = dict((key, record[key]) for key in (
+                "song_name", "tag", "user", "bundle", "admin",
+                "fingerprinted", "file"))
+            self._next_sid = max(self._next_sid, sid + 1)
+        elif op == "fingerprinted":
+            self.songs[record["sid"]]["fingerprinted"] = True
+        elif op == "song_file":
+            self.songs[record["sid"]]["file"] = record["file"]
+        elif op == "segment":
+            self.segments.setdefault(_key(record), []).append(record["name"])
+            self._next_segment = max(self._next_segment,
+                                     int(record["name"].split("-")[1]) + 1)
+        elif op == "delete_songs":
+            for sid in record["sids"]:
+                song = self.songs.pop(sid, None)
+                if song is not None:
+                    self.deleted.setdefault(_key(song), set()).add(sid)
+        elif op == "delete_bundle":
+            key = _key(record)
+            self.segments.pop(key, None)
+            self.deleted.pop(key, None)
+            for sid, song in self.songs.items():
+                if _key(song) == key:
+                    del self.songs[sid]
+        elif op == "song_tombstones":
+            self.deleted.setdefault(_key(record), set()).update(record["sids"])
+        elif op == "compacted":
+            key = _key(record)
+            replaced = set(record["replaces"])
+            names = [name for name in self.segments.get(key, [])
+                     if name not in replaced]
+            self.segments[key] = [record["name"]] + names if record["name"] \
+                else names
+            self.deleted[key] = self.deleted.get(key, set()) - \
+                set(record["applied"])
+
+    def _checkpoint(self):
+        """
+        Rewrites the log to the records of the current state, in one step.
+        """
+        # with the lock held
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+        log_file = os.path.join(self.path, LOG_FILE)
+        tmp_file = "%s.%d.tmp" % (log_file, os.getpid())
+        with open(tmp_file, "w") as f:
+            records = [{"op": "format",
+                        "fingerprint_format": self.fingerprint_format,
+                        "next_sid": self._next_sid,
+                        "next_segment": self._next_segment}]
+            records.extend(dict(song, op="song", sid=sid)
+                           for sid, song in sorted(self.songs.items()))
+            for (user, bundle, admin), names in sorted(self.segments.items()):
+                records.extend({"op": "segment", "name": name, "user": user,
+                                "bundle": bundle, "admin": admin}
+                               for name in names)
+            # tombstones not applied yet, their songs are gone
+            for (user, bundle, admin), sids in sorted(self.deleted.items()):
+                if sids:
+                    records.append({"op": "song_tombstones", "user": user,
+                                    "bundle": bundle, "admin": admin,
+                                    "sids": sorted(sids)})
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        os.rename(tmp_file, log_file)
+
+    # segments
+
+    def _array(self, name):
+        array = self._arrays.get(name)
+        if array is None:
+            array = np.load(os.path.join(self.path, name + ".npy"),
+                            mmap_mode="r")
+            self._arrays[name] = array
+        return array
+
+    def _write_segment(self, rows):
+        """
+        Writes the structured array `rows`, sorted by hash, as a new
+        segment and returns its name. The caller records it in the log,
+        or removes it, then discards the name from `_writing`.
+        """
+        with self._lock:
+            name = "segment-%d" % self._next_segment
+            self._next_segment += 1
+            self._writing.add(name)
+        filename = os.path.join(self.path, name + ".npy")
+        tmp_file = filename + ".tmp"
+        with open(tmp_file, "wb") as f:
+            np.save(f, rows)
+        os.rename(tmp_file, filename)
+        return name
+
+    def setup(self):
+        """
+        Opens the store in `path`, creating it if needed, removes the songs
+        that were never completely fingerprinted, and starts the
+        compaction thread.
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        with self._lock:
+            self._replay()
+            if not os.path.exists(os.path.join(self.path, LOG_FILE)):
+                self._append({"op": "format",
+                              "fingerprint_format": self.fingerprint_format})
+        self.delete_unfingerprinted_songs()
+        self._start_compactor()
+
+    def _start_compactor(self):
+        if self._compactor is None or not self._compactor.is_alive():
+            self._compactor = threading.Thread(target=self._compact_loop,
+                                               name="dejavu-compaction")
+            self._compactor.daemon = True
+            self._compactor.start()
+
+    def before_fork(self):
+        # nothing to share with a new process but the files
+        pass
+
+    def after_fork(self):
+        # the compaction thread and the log file belong to the parent
+        self._log = None
+        self._compactor = None
+        self._reset_lock()
+
+    def close(self):
+        """
+        Stops the compaction thread and closes the log.
+        """
+        with self._lock:
+            self._closing = True
+            self._wakeup.notify()
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+        with self._lock:
+            self._closing = False
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+    # compaction
+
+    def _needs_compaction(self, key):
+        return (len(self.segments.get(key, ())) > self.max_segments or
+                bool(self.deleted.get(key)))
+
+    def _compact_loop(self):
+        while True:
+            with self._lock:
+                if not self._closing:
+                    self._wakeup.wait(COMPACTION_INTERVAL)
+                if self._closing:
+                    return
+                keys = [key for key in self.segments
+                        if self._needs_compaction(key)]
+                if not keys:
+                    continue
+            try:
+                self._compact(keys)
+            except Exception as e:
+                logger.exception("Compaction failed: %s" % e)
+
+    def compact(self):
+        """
+        Merges the segments of every bundle into one, applying the
+        tombstones, then removes unused files and rewrites the log.
+        """
+        with self._lock:
+            keys = list(self.segments)
+        self._compact(keys)
+
+    def _compact(self, keys):
+        for key in keys:
+            with self._lock:
+                names = list(self.segments.get(key, ()))
+                applied = set(self.deleted.get(key, ()))
+                if not names:
+                    continue
+                arrays = [self._array(name) for name in names]
+
+            # the segments are immutable, merge them without the lock
+            if len(arrays) == 1:
+                rows = np.array(arrays[0])
+            else:
+                rows = np.concatenate(arrays)
+                rows = rows[np.argsort(rows["hash"], kind="mergesort")]
+            if applied:
+                rows = rows[~np.in1d(rows["sid"], np.fromiter(
+                    applied, dtype=rows["sid"].dtype))]
+            name = self._write_segment(rows) if len(rows) else None
+
+            with self._lock:
+                user, bundle, admin = key
+                record = {"op": "compacted", "user": user, "bundle": bundle,
+                          "admin": admin, "name": name, "replaces": names,
+                          "applied": sorted(applied)}
+                if set(names) <= set(self.segments.get(key, ())):
+                    self._apply(record)
+                    self._append(record)
+                elif name is not None:
+                    # the bundle was deleted meanwhile
+                    os.remove(os.path.join(self.path, name + ".npy"))
+                self._writing.discard(name)
+
+        with self._lock:
+            self._checkpoint()
+            self._collect_garbage()
+
+    def _collect_garbage(self):
+        """
+        Removes the segment files that no bundle uses.
+        """
+        # with the lock held
+        used = set(name for names in self.segments.values() for name in names)
+        for filename in glob.glob(os.path.join(self.path, "segment-*.npy")):
+            name = os.path.basename(filename)[:-len(".npy")]
+            if name not in used and name not in self._writing:
+                self._arrays.pop(name, None)
+                os.remove(filename)
+        for filename in glob.glob(os.path.join(self.path, "segment-*.npy.tmp")):
+            if os.path.basename(filename)[:-len(".npy.tmp")] not in self._writing:
+                os.remove(filename)
+
+    # Database
+
+    def empty(self):
+        with self._lock:
+            self.songs, self.segments, self.deleted = {}, {}, {}
+            self._checkpoint()
+            self._collect_garbage()
+
+    def migrate_fingerprint_format(self, fingerprint_format):
+        """
+        Switches the store to another fingerprint format, dropping all
+        songs and fingerprints.
+        """
+        if fingerprint_format not in (FORMAT_SHA1, FORMAT_INT64):
+            raise FingerprintFormatError(
+                "Unsupported fingerprint format: %s" % fingerprint_format)
+        with self._lock:
+            self.fingerprint_format = fingerprint_format
+            self.empty()
+
+    def delete_unfingerprinted_songs(self):
+        with self._lock:
+            by_bundle = {}
+            for sid, song in self.songs.items():
+                if not song["fingerprinted"]:
+                    by_bundle.setdefault(_key(song), []).append(sid)
+            for (user, bundle, admin), sids in by_bundle.items():
+                self.delete_songs(user, bundle, admin, sids)
+
+    def delete_bundle(self, user, bundle, admin):
+        """
+        Records a tombstone of the bundle; its segment files are removed
+        by the next compaction.
+        """
+        with self._lock:
+            record = {"op": "delete_bundle", "user": user, "bundle": bundle,
+                      "admin": bool(admin)}
+            self._apply(record)
+            self._append(record)
+            self._wakeup.notify()
+
+    def get_bundle_hashes(self, user, bundle, admin, sids):
+        with self._lock:
+            arrays = [self._array(name) for name in
+                      self.segments.get((user, bundle, bool(admin)), ())]
+        sids = np.array(list(sids), dtype="<i4")
+        pairs = []
+        for rows in arrays:
+            rows = rows[np.in1d(rows["sid"], sids)]
+            pairs.extend(zip(rows["hash"].tolist(), rows["sid"].tolist()))
+        return pairs
+
+    def delete_songs(self, user, bundle, admin, sids):
+        """
+        Records tombstones of the songs, which hide their fingerprints
+        until the next compaction leaves them out.
+        """
+        with self._lock:
+            sids = [sid for sid in sids if sid in self.songs]
+            if not sids:
+                return
+            record = {"op": "delete_songs", "sids": sids}
+            self._apply(record)
+            self._append(record)
+            self._wakeup.notify()
+
+    def get_num_songs(self):
+        return sum(1 for song in self.songs.values() if song["fingerprinted"])
+
+    def get_num_fingerprints(self):
+        with self._lock:
+            bundles = [(names, self.deleted.get(key))
+                       for key, names in self.segments.items()]
+            total = 0
+            for names, deleted in bundles:
+                for name in names:
+                    sids = self._array(name)["sid"]
+                    if deleted:
+                        total += np.count_nonzero(~np.in1d(sids, list(deleted)))
+                    else:
+                        total += len(sids)
+            return total
+
+    def set_song_fingerprinted(self, sid):
+        with self._lock:
+            record = {"op": "fingerprinted", "sid": sid}
+            self._apply(record)
+            self._append(record)
+
+    def get_songs(self):
+        for sid, song in sorted(self.songs.items()):
+            if song["fingerprinted"]:
+                yield {"song_id": sid, "song_name": song["song_name"]}
+
+    def _bundle_songs(self, user, bundle, admin):
+        key = (user, bundle, bool(admin))
+        return [(sid, song) for sid, song in sorted(self.songs.items())
+                if song["fingerprinted"] and _key(song) == key]
+
+    def get_song_names(self, user, bundle, admin):
+        return [song["song_name"]
+                for _, song in self._bundle_songs(user, bundle, admin)]
+
+    def get_song_files(self, user, bundle, admin):
+        return [(sid, song["song_name"]) + tuple(song["file"])
+                for sid, song in self._bundle_songs(user, bundle, admin)]
+
+    def set_song_file(self, sid, size, mtime, checksum):
+        with self._lock:
+            record = {"op": "song_file", "sid": sid,
+                      "file": [size, mtime, checksum]}
+            self._apply(record)
+            self._append(record)
+
+    def get_song_by_id(self, sid):
+        song = self.songs.get(sid)
+        if song is None:
+            return None
+        return {"song_name": song["song_name"], "tag": song["tag"]}
+
+    def insert(self, hash, sid, offset, tag, user, bundle, admin=False):
+        self.insert_hashes(sid, [(hash, offset)], tag, user, bundle, admin)
+
+    def insert_song(self, songname, tag, user, bundle, admin=False,
+                    file_info=None):
+        with self._lock:
+            sid = self._next_sid
+            record = {"op": "song", "sid": sid, "song_name": songname,
+                      "tag": tag, "user": user, "bundle": bundle,
+                      "admin": bool(admin), "fingerprinted": False,
+                      "file": list(file_info or (None, None, None))}
+            self._apply(record)
+            self._append(record)
+            return sid
+
+    def query(self, hash):
+        """
+        Yields the (sid, offset) of every fingerprint of `hash`, or of
+        every fingerprint if `hash` is None.
+        """
+        with self._lock:
+            bundles = [([self._array(name) for name in names],
+                        self.deleted.get(key, set()))
+                       for key, names in self.segments.items()]
+        for arrays, deleted in bundles:
+            for rows in arrays:
+                if hash is not None:
+                    found, _ = lookup(rows["hash"], hash_array(
+                        [hash], self.fingerprint_format))
+                    rows = rows[found]
+                for sid, offset in zip(rows["sid"].tolist(),
+                                       rows["offset"].tolist()):
+                    if sid not in deleted:
+                        yield sid, offset
+
+    def get_iterable_kv_pairs(self):
+        return self.query(None)
+
+    def insert_hashes(self, sid, hashes, tag, user, bundle, admin=False):
+        self.insert_hashes_many([(sid, hashes, tag, user, bundle, admin)])
+
+    def insert_hashes_many(self, songs):
+        """
+        Writes the fingerprints of several songs, (sid, hashes, tag, user,
+        bundle, admin) tuples, as one new segment per bundle.
+        """
+        by_bundle = {}
+        for sid, hashes, tag, user, bundle, admin in songs:
+            if hashes:
+                by_bundle.setdefault((user, bundle, bool(admin)), []).append(
+                    (sid, hashes))
+
+        for (user, bundle, admin), bundle_songs in by_bundle.items():
+            values, sids, offsets = [], [], []
+            for sid, hashes in bundle_songs:
+                song_values, song_offsets = zip(*hashes)
+                values.extend(song_values)
+                offsets.extend(song_offsets)
+                sids.extend([sid] * len(hashes))
+            values = hash_array(values, self.fingerprint_format)
+            rows = np.empty(len(values), dtype=self._dtype(values))
+            rows["hash"] = values
+            rows["sid"] = sids
+            rows["offset"] = offsets
+            rows = rows[np.argsort(values, kind="mergesort")]
+            name = self._write_segment(rows)
+
+            with self._lock:
+                record = {"op": "segment", "name": name, "user": user,
+                          "bundle": bundle, "admin": admin}
+                self._apply(record)
+                self._append(record)
+                self._writing.discard(name)
+                if self._needs_compaction((user, bundle, admin)):
+                    self._wakeup.notify()
+
+    def _matches(self, hashes, user, bundle, admin, unique):
+        """
+        Returns (sids, diffs) arrays of the fingerprints matching the
+        (hash, offset) pairs `hashes`, see `MemoryIndexDatabase`.
+        """
+        values, offsets = query_arrays(hashes, self.fingerprint_format, unique)
+        with self._lock:
+            if admin:
+                keys = [key for key in self.segments
+                        if key[1] == bundle and key[2]]
+            else:
+                keys = [(user, bundle, False)]
+            bundles = [(self.segments.get(key, ()), self.deleted.get(key))
+                       for key in keys]
+            bundles = [([self._array(name) for name in names], deleted)
+                       for names, deleted in bundles]
+
+        sids, diffs = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for arrays, deleted in bundles:
+            for rows in arrays:
+                found, queries = lookup(rows["hash"], values)
+                found_sids = rows["sid"][found].astype(np.int64)
+                found_diffs = rows["offset"][found].astype(np.int64) - \
+                    offsets[queries]
+                if deleted:
+                    live = ~np.in1d(found_sids, list(deleted))
+                    found_sids, found_diffs = found_sids[live], found_diffs[live]
+                sids.append(found_sids)
+                diffs.append(found_diffs)
+        return np.concatenate(sids), np.concatenate(diffs)
+
+    def return_matches(self, hashes, user, bundle, admin):
+        sids, diffs = self._matches(list(hashes), user, bundle, admin, True)
+        return zip(sids.tolist(), diffs.tolist())
+
+    def return_match_counts(self, hashes, user, bundle, admin, limit=10):
+        sids, diffs = self._matches(list(hashes), user, bundle, admin, False)
+        sids, diffs, counts = count_alignments(sids, diffs)
+        order = np.lexsort((diffs, sids, -counts))[:limit]
+        return zip(sids[order].tolist(), diffs[order].tolist(),
+                   counts[order].tolist())
+
+
+def _key(record):
+    return (record["user"], record["bundle"], bool(record["admin"]))
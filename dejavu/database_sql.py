@@ -1,31 +1,15 @@
 from __future__ import absolute_import
 from itertools import izip_longest
+import os
 import Queue
+import tempfile
 
-import MySQLdb as mysql
-from MySQLdb.cursors import DictCursor
-
-from dejavu.database import Database
+from dejavu.database import Database, FingerprintFormatError, SchemaError
+from dejavu.fingerprint import FORMAT_SHA1, FORMAT_INT64
+from dejavu.logs import get_logger
 
-# Configure logging
-__MONGOLOG_FILE__ = "mongolog.cnf"
-import logging
-import json
-import os
-if os.path.isfile(__MONGOLOG_FILE__):
-    with open(__MONGOLOG_FILE__) as f:
-        config = json.load(f)
-    from log4mongo.handlers import MongoHandler
-    handler = MongoHandler(level = logging.DEBUG ,host=config['host'], capped=config['capped'], port=config['port'], database_name=config['db'], collection=config['collection'], username=config['user'], password=config['passwd'])
-else:
-    handler = logging.FileHandler("dejavusql.log")
-    handler.setLevel(logging.DEBUG)
-    # create a logging format
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-logger = logging.getLogger('Classification_Dejavu_SQL')
-logger.addHandler(handler)
-logger.setLevel(logging.DEBUG)
+# Configure logging, the handler is set up on the first record
+logger = get_logger('Classification_Dejavu_SQL', "dejavusql.log")
 
 
 # TODO:
@@ -68,10 +52,18 @@ class SQLDatabase(Database):
     """
 
     type = "mysql"
+    lists_bundle_hashes = True
 
     # tables
     FINGERPRINTS_TABLENAME = "fingerprints"
     SONGS_TABLENAME = "songs"
+    META_TABLENAME = "dejavu_meta"
+    QUERY_HASHES_TABLENAME = "query_hashes"
+    BUNDLES_TABLENAME = "bundles"
+    # fingerprints table of the new layout while `migrate_schema` runs,
+    # and of the old one once it is swapped out
+    MIGRATION_TABLENAME = "fingerprints_migration"
+    RETIRED_TABLENAME = "fingerprints_retired"
 
     # fields
     FIELD_HASH = "hash"
@@ -83,11 +75,84 @@ class SQLDatabase(Database):
     FIELD_BUNDLE = "bundle"
     FIELD_USER = "user"
     FIELD_ADMIN = "admin"
+    FIELD_META_NAME = "name"
+    FIELD_META_VALUE = "value"
+    FIELD_DIFF = "diff"
+    FIELD_BUNDLE_ID = "bundle_id"
+    FIELD_COUNT = "n"
+    # the audio file a song was fingerprinted from, see `sync_bundle`
+    FIELD_FILE_SIZE = "file_size"
+    FIELD_FILE_MTIME = "file_mtime"
+    FIELD_FILE_SHA1 = "file_sha1"
+
+    # meta keys
+    META_FINGERPRINT_FORMAT = "fingerprint_format"
+    META_SCHEMA = "schema"
+
+    # Layouts of the fingerprints table. "legacy" stores the tag, user,
+    # bundle and admin of every fingerprint next to it. "normalized"
+    # stores a bundle_id pointing into the bundles table instead, and
+    # clusters the table on (bundle_id, hash, song_id, offset), so a
+    # lookup only reads the rows of its own bundle, straight from the key.
+    SCHEMA_LEGACY = "legacy"
+    SCHEMA_NORMALIZED = "normalized"
+    SCHEMAS = (SCHEMA_LEGACY, SCHEMA_NORMALIZED)
+
+    # How the hash column is declared, bound and read back for each
+    # fingerprint format. Queries touching the hash column are templates
+    # filled in with these when the database instance is created.
+    HASH_SQL = {
+        FORMAT_SHA1: {
+            "hash_type": "binary(10)",
+            "hash_param": "UNHEX(%s)",
+            "hash_column": "HEX(%s)" % FIELD_HASH,
+            "hash_load": "@%s" % FIELD_HASH,
+            "hash_load_set": "SET %s = UNHEX(@%s)" % (FIELD_HASH, FIELD_HASH),
+        },
+        FORMAT_INT64: {
+            "hash_type": "bigint unsigned",
+            "hash_param": "%s",
+            "hash_column": FIELD_HASH,
+            "hash_load": FIELD_HASH,
+            "hash_load_set": "",
+        },
+    }
+    HASH_QUERIES = (
+        "CREATE_FINGERPRINTS_TABLE", "INSERT_FINGERPRINT", "SELECT",
+        "SELECT_MULTIPLE", "SELECT_MULTIPLE_ADMIN",
+        "CREATE_QUERY_HASHES_TABLE", "INSERT_QUERY_HASH",
+        "LOAD_FINGERPRINTS", "INSERT_FINGERPRINTS_ROW", "SELECT_SONG_HASHES",
+    )
+    # queries replaced by their NORMALIZED_ counterpart in that schema
+    NORMALIZED_QUERIES = (
+        "CREATE_FINGERPRINTS_TABLE", "INSERT_FINGERPRINT", "SELECT_MULTIPLE",
+        "SELECT_MATCH_COUNTS", "DELETE_FINGERPRINT_BUNDLE",
+        "SELECT_SONG_HASHES",
+        "INSERT_FINGERPRINTS", "INSERT_FINGERPRINTS_ROW", "LOAD_FINGERPRINTS",
+    )
+
+    # How `insert_hashes` writes fingerprints: "values" sends multi-row
+    # INSERT statements, "infile" writes them to a temporary tab separated
+    # file and loads it with LOAD DATA LOCAL INFILE. "infile" turns on
+    # local_infile for the connections, which lets the server read any
+    # file the client can, so it has to be asked for; it falls back to
+    # "values" if the server refuses local files.
+    BULK_INFILE = "infile"
+    BULK_VALUES = "values"
+    BULK_INSERTS = (BULK_INFILE, BULK_VALUES)
+    # rows per INSERT statement of the "values" bulk insert
+    VALUES_BATCH_SIZE = 5000
+    # errors of a server or client that has LOCAL INFILE disabled
+    LOCAL_INFILE_ERRORS = (1148, 2068, 3948)
+
+    # Fingerprints removed per DELETE statement, each in its own
+    # transaction, so deleting songs never locks many rows at once
+    DELETE_BATCH_SIZE = 10000
 
     # creates
     CREATE_FINGERPRINTS_TABLE = """
-        CREATE TABLE IF NOT EXISTS `%s` (
-             `%s` binary(10) not null,
+        CREATE TABLE IF NOT EXISTS `{fingerprints_table}` (
+             `%s` {hash_type} not null,
              `%s` mediumint unsigned not null,
              `%s` varchar(250) not null,
              `%s` varchar(250) not null,
@@ -98,7 +163,7 @@ class SQLDatabase(Database):
          UNIQUE KEY `unique_constraint` (%s, %s, %s),
          FOREIGN KEY (%s) REFERENCES %s(%s) ON DELETE CASCADE
     ) ENGINE=INNODB;""" % (
-        FINGERPRINTS_TABLENAME, FIELD_HASH,
+        FIELD_HASH,
         FIELD_SONG_ID, FIELD_TAG,
         FIELD_USER, FIELD_BUNDLE,
         FIELD_ADMIN,
@@ -116,42 +181,198 @@ class SQLDatabase(Database):
             `%s` varchar(250) not null,
             `%s` bool not null default 0,
             `%s` tinyint default 0,
+            `%s` bigint unsigned,
+            `%s` double,
+            `%s` char(40),
         PRIMARY KEY (`%s`),
         UNIQUE KEY `%s` (`%s`)
     ) ENGINE=INNODB;""" % (
         SONGS_TABLENAME, FIELD_SONG_ID, FIELD_SONGNAME, FIELD_TAG,
         FIELD_USER, FIELD_BUNDLE,
         FIELD_ADMIN, FIELD_FINGERPRINTED,
+        FIELD_FILE_SIZE, FIELD_FILE_MTIME, FIELD_FILE_SHA1,
         FIELD_SONG_ID, FIELD_SONG_ID, FIELD_SONG_ID,
     )
 
+    # songs tables created before the file columns existed
+    ADD_SONG_FILE_COLUMNS = """
+        ALTER TABLE `%s` ADD COLUMN `%s` bigint unsigned,
+            ADD COLUMN `%s` double, ADD COLUMN `%s` char(40);
+    """ % (SONGS_TABLENAME, FIELD_FILE_SIZE, FIELD_FILE_MTIME, FIELD_FILE_SHA1)
+
+    # Without a foreign key on song_id, which would need a secondary index
+    # as large as the table itself; fingerprints are deleted along with
+    # their songs explicitly instead.
+    NORMALIZED_CREATE_FINGERPRINTS_TABLE = """
+        CREATE TABLE IF NOT EXISTS `{fingerprints_table}` (
+             `%s` int unsigned not null,
+             `%s` {hash_type} not null,
+             `%s` mediumint unsigned not null,
+             `%s` int unsigned not null,
+         PRIMARY KEY (%s, %s, %s, `%s`)
+    ) ENGINE=INNODB;""" % (
+        FIELD_BUNDLE_ID, FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET,
+        FIELD_BUNDLE_ID, FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET,
+    )
+
+    CREATE_BUNDLES_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%s` (
+            `%s` int unsigned not null auto_increment,
+            `%s` varchar(250) not null,
+            `%s` varchar(250) not null,
+            `%s` bool not null default 0,
+        PRIMARY KEY (`%s`),
+        UNIQUE KEY `tenant` (`%s`, `%s`, `%s`)
+    ) ENGINE=INNODB;""" % (
+        BUNDLES_TABLENAME, FIELD_BUNDLE_ID, FIELD_USER, FIELD_BUNDLE,
+        FIELD_ADMIN, FIELD_BUNDLE_ID, FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN,
+    )
+
+    CREATE_META_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%s` (
+            `%s` varchar(64) not null,
+            `%s` varchar(250) not null,
+        PRIMARY KEY (`%s`)
+    ) ENGINE=INNODB;""" % (
+        META_TABLENAME, FIELD_META_NAME, FIELD_META_VALUE, FIELD_META_NAME,
+    )
+
+    # per connection table holding the hashes of a query, see
+    # `return_match_counts`; the offset is signed so that differences with
+    # it are too
+    CREATE_QUERY_HASHES_TABLE = """
+        CREATE TEMPORARY TABLE IF NOT EXISTS `%s` (
+             `%s` {hash_type} not null,
+             `%s` int not null,
+         INDEX (%s)
+    ) ENGINE=MEMORY;""" % (
+        QUERY_HASHES_TABLENAME, FIELD_HASH, FIELD_OFFSET, FIELD_HASH,
+    )
+
     # inserts (ignores duplicates)
     INSERT_FINGERPRINT = """
         INSERT IGNORE INTO %s (%s, %s ,%s, %s, %s, %s, %s) values
-            (UNHEX(%%s), %%s, %%s, %%s, %%s, %%s, %%s);
+            ({hash_param}, %%s, %%s, %%s, %%s, %%s, %%s);
     """ % (FINGERPRINTS_TABLENAME, FIELD_HASH, FIELD_TAG, FIELD_SONG_ID, FIELD_OFFSET, FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN)
 
-    INSERT_SONG = "INSERT INTO %s (%s, %s, %s, %s, %s) values (%%s, %%s, %%s, %%s, %%s);" % (
-        SONGS_TABLENAME, FIELD_SONGNAME, FIELD_TAG, FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN)
+    # bulk inserts, see `insert_hashes_many`. The columns a song has in
+    # common come first, then hash and offset. Multi-row INSERT, with the
+    # rows filled in before execution:
+    INSERT_FINGERPRINTS = """
+        INSERT IGNORE INTO %s (`%s`, `%s`, `%s`, `%s`, %s, %s, `%s`) values %%s;
+    """ % (FINGERPRINTS_TABLENAME, FIELD_TAG, FIELD_USER, FIELD_BUNDLE,
+           FIELD_ADMIN, FIELD_SONG_ID, FIELD_HASH, FIELD_OFFSET)
+    INSERT_FINGERPRINTS_ROW = "(%s, %s, %s, %s, %s, {hash_param}, %s)"
+
+    NORMALIZED_INSERT_FINGERPRINTS = """
+        INSERT IGNORE INTO %s (%s, %s, %s, `%s`) values %%s;
+    """ % (FINGERPRINTS_TABLENAME, FIELD_BUNDLE_ID, FIELD_SONG_ID, FIELD_HASH, FIELD_OFFSET)
+    NORMALIZED_INSERT_FINGERPRINTS_ROW = "(%s, %s, {hash_param}, %s)"
+
+    # and LOAD DATA of a tab separated file of the same columns
+    LOAD_FINGERPRINTS = """
+        LOAD DATA LOCAL INFILE %%s IGNORE INTO TABLE %s CHARACTER SET utf8
+        (`%s`, `%s`, `%s`, `%s`, %s, {hash_load}, `%s`) {hash_load_set};
+    """ % (FINGERPRINTS_TABLENAME, FIELD_TAG, FIELD_USER, FIELD_BUNDLE,
+           FIELD_ADMIN, FIELD_SONG_ID, FIELD_OFFSET)
+
+    NORMALIZED_LOAD_FINGERPRINTS = """
+        LOAD DATA LOCAL INFILE %%s IGNORE INTO TABLE %s
+        (%s, %s, {hash_load}, `%s`) {hash_load_set};
+    """ % (FINGERPRINTS_TABLENAME, FIELD_BUNDLE_ID, FIELD_SONG_ID, FIELD_OFFSET)
+
+    NORMALIZED_INSERT_FINGERPRINT = """
+        INSERT IGNORE INTO %s (%s, %s, %s, `%s`) values
+            (%%s, {hash_param}, %%s, %%s);
+    """ % (FINGERPRINTS_TABLENAME, FIELD_BUNDLE_ID, FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET)
+
+    # returns the id of the bundle whether it is new or not
+    INSERT_BUNDLE = """
+        INSERT INTO %s (`%s`, `%s`, `%s`) values (%%s, %%s, %%s)
+        ON DUPLICATE KEY UPDATE %s = LAST_INSERT_ID(%s);
+    """ % (BUNDLES_TABLENAME, FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN,
+           FIELD_BUNDLE_ID, FIELD_BUNDLE_ID)
+
+    INSERT_BUNDLES_FROM_SONGS = """
+        INSERT IGNORE INTO %s (`%s`, `%s`, `%s`)
+        SELECT DISTINCT `%s`, `%s`, `%s` FROM %s;
+    """ % (BUNDLES_TABLENAME, FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN,
+           FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN, SONGS_TABLENAME)
+
+    INSERT_QUERY_HASH = """
+        INSERT INTO %s (%s, `%s`) values ({hash_param}, %%s);
+    """ % (QUERY_HASHES_TABLENAME, FIELD_HASH, FIELD_OFFSET)
+
+    INSERT_SONG = "INSERT INTO %s (%s, %s, %s, %s, %s, %s, %s, %s) values (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s);" % (
+        SONGS_TABLENAME, FIELD_SONGNAME, FIELD_TAG, FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN,
+        FIELD_FILE_SIZE, FIELD_FILE_MTIME, FIELD_FILE_SHA1)
 
     # selects
     SELECT = """
-        SELECT %s, %s FROM %s WHERE %s = UNHEX(%%s);
+        SELECT %s, %s FROM %s WHERE %s = {hash_param};
     """ % (FIELD_SONG_ID, FIELD_OFFSET, FINGERPRINTS_TABLENAME, FIELD_HASH)
 
     SELECT_MULTIPLE = """
-        SELECT HEX(%s), %s, %s FROM %s WHERE %s IN (%%s) AND %s = '%%s' AND %s = '%%s' AND %s = %%s;
-    """ % (FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET,
+        SELECT {hash_column}, %s, %s FROM %s WHERE %s IN (%%s) AND %s = '%%s' AND %s = '%%s' AND %s = %%s;
+    """ % (FIELD_SONG_ID, FIELD_OFFSET,
            FINGERPRINTS_TABLENAME, FIELD_HASH,
            FIELD_BUNDLE, FIELD_USER,
            FIELD_ADMIN)
 
+    # bundle ids first, then hashes
+    NORMALIZED_SELECT_MULTIPLE = """
+        SELECT {hash_column}, %s, `%s` FROM %s WHERE %s IN (%%s) AND %s IN (%%s);
+    """ % (FIELD_SONG_ID, FIELD_OFFSET, FINGERPRINTS_TABLENAME,
+           FIELD_BUNDLE_ID, FIELD_HASH)
+
+    SELECT_BUNDLE_ID = """
+        SELECT %s FROM %s WHERE `%s` = %%s AND `%s` = %%s AND `%s` = %%s;
+    """ % (FIELD_BUNDLE_ID, BUNDLES_TABLENAME, FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN)
+
+    # admins see a bundle of that name whoever it belongs to
+    SELECT_ADMIN_BUNDLE_IDS = """
+        SELECT %s FROM %s WHERE `%s` = %%s AND `%s` = %%s;
+    """ % (FIELD_BUNDLE_ID, BUNDLES_TABLENAME, FIELD_BUNDLE, FIELD_ADMIN)
+
     SELECT_MULTIPLE_ADMIN = """
-        SELECT HEX(%s), %s, %s FROM %s WHERE %s IN (%%s) AND %s = '%%s' AND %s = %%s;
-    """ % (FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET,
+        SELECT {hash_column}, %s, %s FROM %s WHERE %s IN (%%s) AND %s = '%%s' AND %s = %%s;
+    """ % (FIELD_SONG_ID, FIELD_OFFSET,
            FINGERPRINTS_TABLENAME, FIELD_HASH,
            FIELD_BUNDLE, FIELD_ADMIN)
 
+    # offset histogram of a query, most common (song, offset difference)
+    # pairs first
+    SELECT_MATCH_COUNTS = """
+        SELECT f.%s, CAST(f.`%s` AS SIGNED) - q.`%s` AS %s, COUNT(*) AS %s
+        FROM %s f JOIN %s q ON f.%s = q.%s
+        WHERE f.%s = %%s AND f.%s = %%s AND f.%s = %%s
+        GROUP BY f.%s, %s ORDER BY %s DESC LIMIT %%s;
+    """ % (FIELD_SONG_ID, FIELD_OFFSET, FIELD_OFFSET, FIELD_DIFF, FIELD_COUNT,
+           FINGERPRINTS_TABLENAME, QUERY_HASHES_TABLENAME, FIELD_HASH, FIELD_HASH,
+           FIELD_BUNDLE, FIELD_USER, FIELD_ADMIN,
+           FIELD_SONG_ID, FIELD_DIFF, FIELD_COUNT)
+
+    SELECT_MATCH_COUNTS_ADMIN = """
+        SELECT f.%s, CAST(f.`%s` AS SIGNED) - q.`%s` AS %s, COUNT(*) AS %s
+        FROM %s f JOIN %s q ON f.%s = q.%s
+        WHERE f.%s = %%s AND f.%s = %%s
+        GROUP BY f.%s, %s ORDER BY %s DESC LIMIT %%s;
+    """ % (FIELD_SONG_ID, FIELD_OFFSET, FIELD_OFFSET, FIELD_DIFF, FIELD_COUNT,
+           FINGERPRINTS_TABLENAME, QUERY_HASHES_TABLENAME, FIELD_HASH, FIELD_HASH,
+           FIELD_BUNDLE, FIELD_ADMIN,
+           FIELD_SONG_ID, FIELD_DIFF, FIELD_COUNT)
+
+    # bundle ids and limit are filled in before execution
+    NORMALIZED_SELECT_MATCH_COUNTS = """
+        SELECT f.%s, CAST(f.`%s` AS SIGNED) - q.`%s` AS %s, COUNT(*) AS %s
+        FROM %s f JOIN %s q ON f.%s = q.%s
+        WHERE f.%s IN (%%s)
+        GROUP BY f.%s, %s ORDER BY %s DESC LIMIT %%d;
+    """ % (FIELD_SONG_ID, FIELD_OFFSET, FIELD_OFFSET, FIELD_DIFF, FIELD_COUNT,
+           FINGERPRINTS_TABLENAME, QUERY_HASHES_TABLENAME, FIELD_HASH, FIELD_HASH,
+           FIELD_BUNDLE_ID,
+           FIELD_SONG_ID, FIELD_DIFF, FIELD_COUNT)
+
     SELECT_ALL = """
         SELECT %s, %s FROM %s;
     """ % (FIELD_SONG_ID, FIELD_OFFSET, FINGERPRINTS_TABLENAME)
@@ -172,20 +393,115 @@ class SQLDatabase(Database):
         SELECT %s, %s FROM %s WHERE %s = 1;
     """ % (FIELD_SONG_ID, FIELD_SONGNAME, SONGS_TABLENAME, FIELD_FINGERPRINTED)
 
+    SELECT_BUNDLE_SONG_NAMES = """
+        SELECT %s FROM %s
+        WHERE %s = 1 AND `%s` = %%s AND `%s` = %%s AND `%s` = %%s;
+    """ % (FIELD_SONGNAME, SONGS_TABLENAME, FIELD_FINGERPRINTED,
+           FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN)
+
+    SELECT_BUNDLE_SONG_FILES = """
+        SELECT %s, %s, %s, %s, %s FROM %s
+        WHERE %s = 1 AND `%s` = %%s AND `%s` = %%s AND `%s` = %%s;
+    """ % (FIELD_SONG_ID, FIELD_SONGNAME, FIELD_FILE_SIZE, FIELD_FILE_MTIME,
+           FIELD_FILE_SHA1, SONGS_TABLENAME, FIELD_FINGERPRINTED,
+           FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN)
+
+    SELECT_BUNDLE_SONG_IDS = """
+        SELECT %s FROM %s WHERE `%s` = %%s AND `%s` = %%s AND `%s` = %%s;
+    """ % (FIELD_SONG_ID, SONGS_TABLENAME, FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN)
+
+    # song ids are filled in before execution
+    SELECT_SONG_HASHES = """
+        SELECT {hash_column}, %s FROM %s WHERE %s IN (%%s);
+    """ % (FIELD_SONG_ID, FINGERPRINTS_TABLENAME, FIELD_SONG_ID)
+
+    NORMALIZED_SELECT_SONG_HASHES = """
+        SELECT {hash_column}, %s FROM %s WHERE %s = %%%%s AND %s IN (%%s);
+    """ % (FIELD_SONG_ID, FINGERPRINTS_TABLENAME, FIELD_BUNDLE_ID,
+           FIELD_SONG_ID)
+
+    SELECT_META = """
+        SELECT %s FROM %s WHERE %s = %%s;
+    """ % (FIELD_META_VALUE, META_TABLENAME, FIELD_META_NAME)
+
+    # (name, type) of a column of the fingerprints table, nothing if the
+    # table or column does not exist
+    SELECT_FINGERPRINTS_COLUMN = """
+        SELECT COLUMN_NAME, COLUMN_TYPE FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = '%s' AND COLUMN_NAME = %%s;
+    """ % FINGERPRINTS_TABLENAME
+
+    SELECT_SONGS_COLUMN = """
+        SELECT COLUMN_NAME, COLUMN_TYPE FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = '%s' AND COLUMN_NAME = %%s;
+    """ % SONGS_TABLENAME
+
+    # schema migrations, from the fingerprints table to MIGRATION_TABLENAME
+    MIGRATE_TO_NORMALIZED = """
+        INSERT IGNORE INTO %s (%s, %s, %s, `%s`)
+        SELECT b.%s, f.%s, f.%s, f.`%s` FROM %s f JOIN %s b
+            ON f.`%s` = b.`%s` AND f.`%s` = b.`%s` AND f.`%s` = b.`%s`;
+    """ % (MIGRATION_TABLENAME, FIELD_BUNDLE_ID, FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET,
+           FIELD_BUNDLE_ID, FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET,
+           FINGERPRINTS_TABLENAME, BUNDLES_TABLENAME,
+           FIELD_USER, FIELD_USER, FIELD_BUNDLE, FIELD_BUNDLE, FIELD_ADMIN, FIELD_ADMIN)
+
+    MIGRATE_TO_LEGACY = """
+        INSERT IGNORE INTO %s (%s, %s, %s, `%s`, `%s`, `%s`, `%s`)
+        SELECT f.%s, f.%s, s.%s, b.`%s`, b.`%s`, b.`%s`, f.`%s`
+        FROM %s f JOIN %s b ON f.%s = b.%s JOIN %s s ON f.%s = s.%s;
+    """ % (MIGRATION_TABLENAME, FIELD_HASH, FIELD_SONG_ID, FIELD_TAG,
+           FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN, FIELD_OFFSET,
+           FIELD_HASH, FIELD_SONG_ID, FIELD_TAG,
+           FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN, FIELD_OFFSET,
+           FINGERPRINTS_TABLENAME, BUNDLES_TABLENAME, FIELD_BUNDLE_ID, FIELD_BUNDLE_ID,
+           SONGS_TABLENAME, FIELD_SONG_ID, FIELD_SONG_ID)
+
+    SWAP_MIGRATION = "RENAME TABLE %s TO %s, %s TO %s;" % (
+        FINGERPRINTS_TABLENAME, RETIRED_TABLENAME,
+        MIGRATION_TABLENAME, FINGERPRINTS_TABLENAME)
+
+    # replaces
+    REPLACE_META = "REPLACE INTO %s (%s, %s) values (%%s, %%s);" % (
+        META_TABLENAME, FIELD_META_NAME, FIELD_META_VALUE)
+
     # drops
     DROP_FINGERPRINTS = "DROP TABLE IF EXISTS %s;" % FINGERPRINTS_TABLENAME
     DROP_SONGS = "DROP TABLE IF EXISTS %s;" % SONGS_TABLENAME
+    DROP_QUERY_HASHES = "DROP TEMPORARY TABLE IF EXISTS %s;" % QUERY_HASHES_TABLENAME
+    DROP_BUNDLES = "DROP TABLE IF EXISTS %s;" % BUNDLES_TABLENAME
+    DROP_MIGRATION = "DROP TABLE IF EXISTS %s;" % MIGRATION_TABLENAME
+    DROP_RETIRED = "DROP TABLE IF EXISTS %s;" % RETIRED_TABLENAME
 
     # update
     UPDATE_SONG_FINGERPRINTED = """
         UPDATE %s SET %s = 1 WHERE %s = %%s
     """ % (SONGS_TABLENAME, FIELD_FINGERPRINTED, FIELD_SONG_ID)
 
+    UPDATE_SONG_FILE = """
+        UPDATE %s SET %s = %%s, %s = %%s, %s = %%s WHERE %s = %%s
+    """ % (SONGS_TABLENAME, FIELD_FILE_SIZE, FIELD_FILE_MTIME, FIELD_FILE_SHA1,
+           FIELD_SONG_ID)
+
     # delete
     DELETE_UNFINGERPRINTED = """
         DELETE FROM %s WHERE %s = 0;
     """ % (SONGS_TABLENAME, FIELD_FINGERPRINTED)
 
+    DELETE_SONGS = "DELETE FROM %s;" % SONGS_TABLENAME
+
+    # the normalized schema has no cascade from songs to fingerprints
+    NORMALIZED_DELETE_UNFINGERPRINTED_FINGERPRINTS = """
+        DELETE f FROM %s s
+        JOIN %s b ON s.`%s` = b.`%s` AND s.`%s` = b.`%s` AND s.`%s` = b.`%s`
+        JOIN %s f ON f.%s = b.%s AND f.%s = s.%s
+        WHERE s.%s = 0;
+    """ % (SONGS_TABLENAME, BUNDLES_TABLENAME,
+           FIELD_USER, FIELD_USER, FIELD_BUNDLE, FIELD_BUNDLE, FIELD_ADMIN, FIELD_ADMIN,
+           FINGERPRINTS_TABLENAME, FIELD_BUNDLE_ID, FIELD_BUNDLE_ID,
+           FIELD_SONG_ID, FIELD_SONG_ID,
+           FIELD_FINGERPRINTED)
+
     DELETE_SONG_BUNDLE = """
         DELETE FROM %s WHERE %s = \'%%s\' AND %s = \'%%s\' AND %s = %%i;
     """ % (SONGS_TABLENAME, FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN)
@@ -194,11 +510,101 @@ class SQLDatabase(Database):
         DELETE FROM %s WHERE %s = \'%%s\' AND %s = \'%%s\' AND %s = %%i;
     """ % (FINGERPRINTS_TABLENAME, FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN)
 
-
-    def __init__(self, **options):
+    NORMALIZED_DELETE_FINGERPRINT_BUNDLE = """
+        DELETE FROM %s WHERE %s = %%s LIMIT %d;
+    """ % (FINGERPRINTS_TABLENAME, FIELD_BUNDLE_ID, DELETE_BATCH_SIZE)
+
+    # song ids are filled in before execution; the legacy table is
+    # indexed on song_id by its unique key
+    DELETE_SONG_FINGERPRINTS = """
+        DELETE FROM %s WHERE %s IN (%%s) LIMIT %d;
+    """ % (FINGERPRINTS_TABLENAME, FIELD_SONG_ID, DELETE_BATCH_SIZE)
+
+    # The normalized table has no index on song_id, see
+    # NORMALIZED_CREATE_FINGERPRINTS_TABLE, so the fingerprints of songs
+    # are deleted walking the primary key range of their bundle once, in
+    # chunks of about DELETE_BATCH_SIZE rows bounded by hash, rather than
+    # scanning the bundle again for every batch. The hash ending the chunk
+    # starting at a hash:
+    NORMALIZED_SELECT_CHUNK_END = """
+        SELECT %s FROM %s WHERE %s = %%s AND %s > %%s
+        ORDER BY %s LIMIT 1 OFFSET %d;
+    """ % (FIELD_HASH, FINGERPRINTS_TABLENAME, FIELD_BUNDLE_ID, FIELD_HASH,
+           FIELD_HASH, DELETE_BATCH_SIZE - 1)
+
+    # song ids are filled in before execution
+    NORMALIZED_DELETE_CHUNK_SONG_FINGERPRINTS = """
+        DELETE FROM %s WHERE %s = %%%%s AND %s >= %%%%s AND %s < %%%%s
+            AND %s IN (%%s);
+    """ % (FINGERPRINTS_TABLENAME, FIELD_BUNDLE_ID, FIELD_HASH, FIELD_HASH,
+           FIELD_SONG_ID)
+
+    NORMALIZED_DELETE_LAST_CHUNK_SONG_FINGERPRINTS = """
+        DELETE FROM %s WHERE %s = %%%%s AND %s >= %%%%s AND %s IN (%%s);
+    """ % (FINGERPRINTS_TABLENAME, FIELD_BUNDLE_ID, FIELD_HASH, FIELD_SONG_ID)
+
+    DELETE_SONGS_BY_ID = """
+        DELETE FROM %s WHERE %s IN (%%s);
+    """ % (SONGS_TABLENAME, FIELD_SONG_ID)
+
+
+    def __init__(self, fingerprint_format=FORMAT_SHA1, schema=SCHEMA_LEGACY,
+                 bulk_insert=BULK_VALUES, **options):
         super(SQLDatabase, self).__init__()
+        if bulk_insert not in self.BULK_INSERTS:
+            raise ValueError("Unsupported bulk insert: %s" % bulk_insert)
+        self.bulk_insert = bulk_insert
+        if bulk_insert == self.BULK_INFILE:
+            # the client refuses LOAD DATA LOCAL unless told otherwise
+            options.setdefault("local_infile", 1)
+
         self.cursor = cursor_factory(**options)
         self._options = options
+        self.schema = self._valid_schema(schema)
+        self._use_fingerprint_format(fingerprint_format)
+
+    def _valid_schema(self, schema):
+        if schema not in self.SCHEMAS:
+            raise SchemaError("Unsupported schema: %s" % schema)
+        return schema
+
+    def _use_fingerprint_format(self, fingerprint_format):
+        """
+        Fills in the hash column of the query templates for the given
+        fingerprint format.
+        """
+        if fingerprint_format not in self.HASH_SQL:
+            raise FingerprintFormatError(
+                "Unsupported fingerprint format: %s" % fingerprint_format)
+
+        self.fingerprint_format = fingerprint_format
+        self._hash_sql = self.HASH_SQL[fingerprint_format]
+        self._prepare_queries()
+
+    def _use_schema(self, schema):
+        self.schema = self._valid_schema(schema)
+        self._prepare_queries()
+
+    def _prepare_queries(self):
+        """
+        Picks the query templates of the schema and fills in their hash
+        column. Forgets the bundle ids looked up so far.
+        """
+        self._bundle_ids = {}
+        for name in set(self.HASH_QUERIES + self.NORMALIZED_QUERIES):
+            setattr(self, name, self._query(name, self.schema))
+
+    def _query(self, name, schema,
+               fingerprints_table=FINGERPRINTS_TABLENAME):
+        if schema == self.SCHEMA_NORMALIZED and name in self.NORMALIZED_QUERIES:
+            name = "NORMALIZED_" + name
+        return getattr(type(self), name).format(
+            fingerprints_table=fingerprints_table, **self._hash_sql)
+
+    def before_fork(self):
+        # Close the cached connections, a process started now would share
+        # their sockets with this one.
+        Cursor.close_cache()
 
     def after_fork(self):
         # Clear the cursor cache, we don't want any stale connections from
@@ -214,8 +620,159 @@ class SQLDatabase(Database):
         """
         with self.cursor() as cur:
             cur.execute(self.CREATE_SONGS_TABLE)
+            cur.execute(self.SELECT_SONGS_COLUMN, (self.FIELD_FILE_SHA1,))
+            if cur.fetchone() is None:
+                cur.execute(self.ADD_SONG_FILE_COLUMNS)
+            cur.execute(self.CREATE_META_TABLE)
+            cur.execute(self.CREATE_BUNDLES_TABLE)
+            self._check_fingerprint_format(cur)
+            self._check_schema(cur)
             cur.execute(self.CREATE_FINGERPRINTS_TABLE)
-            cur.execute(self.DELETE_UNFINGERPRINTED)
+            self._delete_unfingerprinted(cur)
+
+    def _check_fingerprint_format(self, cur):
+        """
+        Compares the fingerprint format stored in the database with the one
+        this instance was created with, recording it if the database has
+        none yet. Databases created before formats existed are recognised
+        by the type of their hash column.
+        """
+        cur.execute(self.SELECT_META, (self.META_FINGERPRINT_FORMAT,))
+        row = cur.fetchone()
+        if row:
+            stored_format = row[0]
+        else:
+            cur.execute(self.SELECT_FINGERPRINTS_COLUMN, (self.FIELD_HASH,))
+            column = cur.fetchone()
+            if column is None:
+                stored_format = self.fingerprint_format
+            elif column[1].lower().startswith("binary"):
+                stored_format = FORMAT_SHA1
+            else:
+                stored_format = FORMAT_INT64
+            cur.execute(self.REPLACE_META,
+                        (self.META_FINGERPRINT_FORMAT, stored_format))
+
+        if stored_format != self.fingerprint_format:
+            raise FingerprintFormatError(
+                "Database holds %s fingerprints but %s was requested, "
+                "migrate it with `migrate_fingerprint_format` first."
+                % (stored_format, self.fingerprint_format))
+
+    def _stored_schema(self, cur):
+        """
+        Returns the schema of the fingerprints table, recording it if the
+        database has none yet. Tables created before schemas existed are
+        legacy ones; a database without fingerprints table takes the
+        schema of this instance.
+        """
+        cur.execute(self.SELECT_META, (self.META_SCHEMA,))
+        row = cur.fetchone()
+        if row:
+            return row[0]
+
+        cur.execute(self.SELECT_FINGERPRINTS_COLUMN, (self.FIELD_HASH,))
+        if cur.fetchone() is None:
+            stored_schema = self.schema
+        else:
+            cur.execute(self.SELECT_FINGERPRINTS_COLUMN,
+                        (self.FIELD_BUNDLE_ID,))
+            if cur.fetchone() is None:
+                stored_schema = self.SCHEMA_LEGACY
+            else:
+                stored_schema = self.SCHEMA_NORMALIZED
+        cur.execute(self.REPLACE_META, (self.META_SCHEMA, stored_schema))
+        return stored_schema
+
+    def _check_schema(self, cur):
+        stored_schema = self._stored_schema(cur)
+        if stored_schema != self.schema:
+            raise SchemaError(
+                "Database holds a %s fingerprints table but %s was requested, "
+                "migrate it with `migrate_schema` first."
+                % (stored_schema, self.schema))
+
+    def migrate_schema(self, schema):
+        """
+        Rewrites the fingerprints table into the layout of `schema`.
+
+        The fingerprints are copied into a table of the new layout with a
+        single INSERT ... SELECT, which takes a while and twice the space
+        on big databases, and the new table then replaces the old one.
+        Songs and their fingerprints are kept.
+        """
+        schema = self._valid_schema(schema)
+        with self.cursor() as cur:
+            cur.execute(self.CREATE_SONGS_TABLE)
+            cur.execute(self.CREATE_META_TABLE)
+            cur.execute(self.CREATE_BUNDLES_TABLE)
+            self._check_fingerprint_format(cur)
+            stored_schema = self._stored_schema(cur)
+
+            if stored_schema != schema:
+                cur.execute(self._query("CREATE_FINGERPRINTS_TABLE",
+                                        stored_schema))
+                cur.execute(self.DROP_MIGRATION)
+                cur.execute(self._query("CREATE_FINGERPRINTS_TABLE", schema,
+                                        self.MIGRATION_TABLENAME))
+                if schema == self.SCHEMA_NORMALIZED:
+                    cur.execute(self.INSERT_BUNDLES_FROM_SONGS)
+                    cur.execute(self.MIGRATE_TO_NORMALIZED)
+                else:
+                    cur.execute(self.MIGRATE_TO_LEGACY)
+                cur.execute(self.SWAP_MIGRATION)
+                cur.execute(self.DROP_RETIRED)
+                cur.execute(self.REPLACE_META, (self.META_SCHEMA, schema))
+
+        self._use_schema(schema)
+
+    def _bundle_id(self, cur, user, bundle, admin):
+        """
+        Returns the id of the bundle, adding it to the bundles table if it
+        is new.
+        """
+        key = (user, bundle, bool(admin))
+        if key not in self._bundle_ids:
+            cur.execute(self.INSERT_BUNDLE, key)
+            self._bundle_ids[key] = cur.lastrowid
+        return self._bundle_ids[key]
+
+    def _match_bundle_ids(self, cur, user, bundle, admin):
+        """
+        Returns the ids of the bundles a query of this tenant searches:
+        the bundle of `user`, or for admins every admin bundle of that name.
+        """
+        if admin:
+            cur.execute(self.SELECT_ADMIN_BUNDLE_IDS, (bundle, admin))
+        else:
+            cur.execute(self.SELECT_BUNDLE_ID, (user, bundle, admin))
+        return [bundle_id for bundle_id, in cur]
+
+    def migrate_fingerprint_format(self, fingerprint_format):
+        """
+        Switches the database to another fingerprint format.
+
+        Hashes can not be converted from one format to the other, so the
+        fingerprints table is recreated for the new format and all songs
+        are removed; bundles have to be fingerprinted again afterwards.
+
+        .. warning:
+            This will result in a loss of data
+        """
+        with self.cursor() as cur:
+            cur.execute(self.CREATE_SONGS_TABLE)
+            cur.execute(self.CREATE_META_TABLE)
+            cur.execute(self.CREATE_BUNDLES_TABLE)
+            self._check_schema(cur)
+            cur.execute(self.DROP_FINGERPRINTS)
+            cur.execute(self.DELETE_SONGS)
+
+        self._use_fingerprint_format(fingerprint_format)
+
+        with self.cursor() as cur:
+            cur.execute(self.CREATE_FINGERPRINTS_TABLE)
+            cur.execute(self.REPLACE_META,
+                        (self.META_FINGERPRINT_FORMAT, fingerprint_format))
 
     def empty(self):
         """
@@ -228,6 +785,11 @@ class SQLDatabase(Database):
         with self.cursor() as cur:
             cur.execute(self.DROP_FINGERPRINTS)
             cur.execute(self.DROP_SONGS)
+            cur.execute(self.DROP_BUNDLES)
+            cur.execute(self.REPLACE_META,
+                        (self.META_FINGERPRINT_FORMAT, self.fingerprint_format))
+            cur.execute(self.REPLACE_META, (self.META_SCHEMA, self.schema))
+        self._bundle_ids = {}
 
         self.setup()
 
@@ -236,17 +798,113 @@ class SQLDatabase(Database):
         Removes all songs that have no fingerprints associated with them.
         """
         with self.cursor() as cur:
-            cur.execute(self.DELETE_UNFINGERPRINTED)
+            self._delete_unfingerprinted(cur)
+
+    def _delete_unfingerprinted(self, cur):
+        if self.schema == self.SCHEMA_NORMALIZED:
+            cur.execute(self.NORMALIZED_DELETE_UNFINGERPRINTED_FINGERPRINTS)
+        cur.execute(self.DELETE_UNFINGERPRINTED)
 
     def delete_bundle(self, user, bundle, admin):
         """
-        Removes all songs and fingerprints associated with a bundle.
+        Removes all songs and fingerprints associated with a bundle, in
+        batches like `delete_songs`.
         """
         with self.cursor() as cur:
-            sql_query = self.DELETE_SONG_BUNDLE % (user, bundle, admin)
-            cur.execute(sql_query, )
-            sql_query = self.DELETE_FINGERPRINT_BUNDLE % (user, bundle, admin)
-            cur.execute(sql_query, )
+            cur.execute(self.SELECT_BUNDLE_SONG_IDS, (user, bundle, admin))
+            sids = [sid for sid, in cur]
+            bundle_ids = []
+            if self.schema == self.SCHEMA_NORMALIZED:
+                cur.execute(self.SELECT_BUNDLE_ID, (user, bundle, admin))
+                bundle_ids = [bundle_id for bundle_id, in cur]
+
+        # straight down the primary key of the normalized table
+        for bundle_id in bundle_ids:
+            self._delete_batches(self.DELETE_FINGERPRINT_BUNDLE, (bundle_id,))
+        self.delete_songs(user, bundle, admin, sids)
+
+    def get_bundle_hashes(self, user, bundle, admin, sids):
+        """
+        Yields (hash, sid) pairs of the fingerprints of songs of a bundle,
+        1000 songs per query.
+        """
+        bundle_ids = []
+        if self.schema == self.SCHEMA_NORMALIZED:
+            with self.cursor() as cur:
+                cur.execute(self.SELECT_BUNDLE_ID, (user, bundle, admin))
+                bundle_ids = [bundle_id for bundle_id, in cur]
+
+        for split_sids in grouper(sids, 1000):
+            in_list = ', '.join(['%s'] * len(split_sids))
+            with self.cursor() as cur:
+                if self.schema == self.SCHEMA_NORMALIZED:
+                    for bundle_id in bundle_ids:
+                        cur.execute(self.SELECT_SONG_HASHES % in_list,
+                                    [bundle_id] + list(split_sids))
+                        for row in cur:
+                            yield row
+                else:
+                    cur.execute(self.SELECT_SONG_HASHES % in_list, split_sids)
+                    for row in cur:
+                        yield row
+
+    def delete_songs(self, user, bundle, admin, sids):
+        """
+        Removes songs of a bundle and their fingerprints. Fingerprints are
+        deleted about DELETE_BATCH_SIZE at a time, each batch committed on
+        its own, so that lookups running meanwhile are never blocked for
+        long; the songs go once their fingerprints are gone.
+        """
+        bundle_ids = []
+        if self.schema == self.SCHEMA_NORMALIZED:
+            with self.cursor() as cur:
+                cur.execute(self.SELECT_BUNDLE_ID, (user, bundle, admin))
+                bundle_ids = [bundle_id for bundle_id, in cur]
+
+        for split_sids in grouper(sids, 1000):
+            in_list = ', '.join(['%s'] * len(split_sids))
+            if self.schema == self.SCHEMA_NORMALIZED:
+                for bundle_id in bundle_ids:
+                    self._delete_song_chunks(bundle_id, in_list, split_sids)
+            else:
+                self._delete_batches(self.DELETE_SONG_FINGERPRINTS % in_list,
+                                     split_sids)
+            with self.cursor() as cur:
+                cur.execute(self.DELETE_SONGS_BY_ID % in_list, split_sids)
+
+    def _delete_song_chunks(self, bundle_id, in_list, sids):
+        """
+        Deletes the fingerprints of songs `sids` of a bundle of the
+        normalized table, a chunk of its primary key range at a time,
+        committing after each, see NORMALIZED_SELECT_CHUNK_END.
+        """
+        # below every hash
+        start = "" if self.fingerprint_format == FORMAT_SHA1 else 0
+        while True:
+            with self.cursor() as cur:
+                cur.execute(self.NORMALIZED_SELECT_CHUNK_END, (bundle_id, start))
+                row = cur.fetchone()
+                if row is None:
+                    cur.execute(
+                        self.NORMALIZED_DELETE_LAST_CHUNK_SONG_FINGERPRINTS
+                        % in_list, [bundle_id, start] + list(sids))
+                    return
+                cur.execute(
+                    self.NORMALIZED_DELETE_CHUNK_SONG_FINGERPRINTS % in_list,
+                    [bundle_id, start, row[0]] + list(sids))
+            start = row[0]
+
+    def _delete_batches(self, query, args):
+        """
+        Runs a DELETE ... LIMIT DELETE_BATCH_SIZE `query` until it deletes
+        less than that, committing after each run.
+        """
+        while True:
+            with self.cursor() as cur:
+                cur.execute(query, args)
+                deleted = cur.rowcount
+            if deleted < self.DELETE_BATCH_SIZE:
+                break
 
     def get_num_songs(self):
         """
@@ -282,16 +940,42 @@ class SQLDatabase(Database):
         """
         Return songs that have the fingerprinted flag set TRUE (1).
         """
-        with self.cursor(cursor_type=DictCursor) as cur:
+        with self.cursor(cursor_type=_mysql().cursors.DictCursor) as cur:
             cur.execute(self.SELECT_SONGS)
             for row in cur:
                 yield row
 
+    def get_song_names(self, user, bundle, admin):
+        """
+        Returns the names of the songs of a bundle that have the
+        fingerprinted flag set TRUE (1).
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_BUNDLE_SONG_NAMES, (user, bundle, admin))
+            return [song_name for song_name, in cur]
+
+    def get_song_files(self, user, bundle, admin):
+        """
+        Returns (sid, song_name, size, mtime, checksum) tuples of the
+        fingerprinted songs of a bundle. Songs added before the file
+        columns existed have None for the last three.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_BUNDLE_SONG_FILES, (user, bundle, admin))
+            return list(cur)
+
+    def set_song_file(self, sid, size, mtime, checksum):
+        """
+        Records the size, mtime and SHA1 checksum of the file of a song.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.UPDATE_SONG_FILE, (size, mtime, checksum, sid))
+
     def get_song_by_id(self, sid):
         """
         Returns song by its ID.
         """
-        with self.cursor(cursor_type=DictCursor) as cur:
+        with self.cursor(cursor_type=_mysql().cursors.DictCursor) as cur:
             cur.execute(self.SELECT_SONG, (sid,))
             return cur.fetchone()
 
@@ -300,15 +984,23 @@ class SQLDatabase(Database):
         Insert a (sha1, tag, song_id, offset) row into database.
         """
         with self.cursor() as cur:
-            cur.execute(self.INSERT_FINGERPRINT, (hash, tag, sid, offset, user, bundle, admin))
-
-    def insert_song(self, songname, tag, user, bundle, admin = False):
+            if self.schema == self.SCHEMA_NORMALIZED:
+                bundle_id = self._bundle_id(cur, user, bundle, admin)
+                cur.execute(self.INSERT_FINGERPRINT, (bundle_id, hash, sid, offset))
+            else:
+                cur.execute(self.INSERT_FINGERPRINT, (hash, tag, sid, offset, user, bundle, admin))
+
+    def insert_song(self, songname, tag, user, bundle, admin = False,
+                    file_info=None):
         """
         Inserts song in the database and returns the ID of the inserted record.
-        """
 
+        file_info: (size, mtime, checksum) of the song's file, if known
+        """
+        size, mtime, checksum = file_info or (None, None, None)
         with self.cursor() as cur:
-            cur.execute(self.INSERT_SONG, (songname, tag, user, bundle, admin))
+            cur.execute(self.INSERT_SONG, (songname, tag, user, bundle, admin,
+                                           size, mtime, checksum))
             return cur.lastrowid
 
     def query(self, hash):
@@ -337,13 +1029,62 @@ class SQLDatabase(Database):
         Insert series of hash => song_id, offset
         values into the database.
         """
-        values = []
-        for hash, offset in hashes:
-            values.append((hash, tag, sid, offset, user, bundle, admin))
+        self.insert_hashes_many([(sid, hashes, tag, user, bundle, admin)])
 
+    def insert_hashes_many(self, songs):
+        """
+        Inserts the hashes of several songs, (sid, hashes, tag, user,
+        bundle, admin) tuples, at once: with a single LOAD DATA LOCAL
+        INFILE of a temporary file, or INSERT statements of
+        VALUES_BATCH_SIZE rows, depending on `bulk_insert`.
+        """
         with self.cursor() as cur:
-            for split_values in grouper(values, 1000):
-                cur.executemany(self.INSERT_FINGERPRINT, split_values)
+            songs = [(self._song_columns(cur, sid, tag, user, bundle, admin),
+                      hashes)
+                     for sid, hashes, tag, user, bundle, admin in songs]
+
+            if self.bulk_insert == self.BULK_INFILE:
+                try:
+                    self._load_fingerprints(cur, songs)
+                    return
+                except _mysql().OperationalError as e:
+                    if e.args[0] not in self.LOCAL_INFILE_ERRORS:
+                        raise
+                    logger.warning("LOAD DATA LOCAL INFILE refused, "
+                                   "inserting fingerprints with INSERT: %s" % e)
+                    self.bulk_insert = self.BULK_VALUES
+
+            self._insert_fingerprints(cur, songs)
+
+    def _song_columns(self, cur, sid, tag, user, bundle, admin):
+        """
+        Returns the values of the columns all fingerprints of a song share,
+        in the order of INSERT_FINGERPRINTS.
+        """
+        if self.schema == self.SCHEMA_NORMALIZED:
+            return (self._bundle_id(cur, user, bundle, admin), sid)
+        return (tag, user, bundle, int(bool(admin)), sid)
+
+    def _load_fingerprints(self, cur, songs):
+        fd, path = tempfile.mkstemp(suffix=".tsv")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for columns, hashes in songs:
+                    head = "".join(_tsv_field(value) + "\t" for value in columns)
+                    f.writelines("%s%s\t%d\n" % (head, hash, offset)
+                                 for hash, offset in hashes)
+            cur.execute(self.LOAD_FINGERPRINTS, (path,))
+        finally:
+            os.remove(path)
+
+    def _insert_fingerprints(self, cur, songs):
+        rows = [columns + (hash, offset)
+                for columns, hashes in songs for hash, offset in hashes]
+        for start in xrange(0, len(rows), self.VALUES_BATCH_SIZE):
+            batch = rows[start:start + self.VALUES_BATCH_SIZE]
+            query = self.INSERT_FINGERPRINTS % ", ".join(
+                [self.INSERT_FINGERPRINTS_ROW] * len(batch))
+            cur.execute(query, [value for row in batch for value in row])
 
     def return_matches(self, hashes, user, bundle, admin):
         """
@@ -359,20 +1100,30 @@ class SQLDatabase(Database):
         # Create a dictionary of hash => offset pairs for later lookups
         mapper = {}
         for hash, offset in hashes:
-            mapper[hash.upper()] = offset
+            mapper[self._hash_key(hash)] = offset
 
         # Get an iteratable of all the hashes we need
         values = mapper.keys()
 
         with self.cursor() as cur:
+            if self.schema == self.SCHEMA_NORMALIZED:
+                bundle_ids = self._match_bundle_ids(cur, user, bundle, admin)
+                if not bundle_ids:
+                    return
+
             for split_values in grouper(values, 1000):
                 # Create our IN part of the query
-                if admin:
+                in_list = ', '.join([self._hash_sql["hash_param"]] * len(split_values))
+                if self.schema == self.SCHEMA_NORMALIZED:
+                    query = self.SELECT_MULTIPLE % (
+                        ', '.join(['%s'] * len(bundle_ids)), in_list)
+                    split_values = bundle_ids + list(split_values)
+                elif admin:
                     query = self.SELECT_MULTIPLE_ADMIN
-                    query = query % (', '.join(['UNHEX(%s)'] * len(split_values)), bundle, admin)
+                    query = query % (in_list, bundle, admin)
                 else:
                     query = self.SELECT_MULTIPLE
-                    query = query % (', '.join(['UNHEX(%s)'] * len(split_values)), bundle, user, admin)
+                    query = query % (in_list, bundle, user, admin)
 
                 cur.execute(query, split_values)
 
@@ -380,12 +1131,66 @@ class SQLDatabase(Database):
                     # (sid, db_offset - song_sampled_offset)
                     yield (sid, offset - mapper[hash])
 
+    def return_match_counts(self, hashes, user, bundle, admin, limit=10):
+        """
+        Offset histogram computed by MySQL. The query hashes and their
+        offsets go into a temporary table, which is joined with the
+        fingerprints and grouped by (song_id, offset difference), so only
+        the `limit` most common pairs are sent back rather than every
+        matching row.
+
+        Every (hash, offset) pair of the query counts, so a hash found in
+        several channels adds up like it does across the lookups of the
+        rows mode.
+
+        Returns a list of (sid, offset_difference, count) tuples, most
+        common first.
+        """
+        values = [(self._hash_key(hash), offset) for hash, offset in hashes]
+
+        with self.cursor() as cur:
+            if self.schema == self.SCHEMA_NORMALIZED:
+                bundle_ids = self._match_bundle_ids(cur, user, bundle, admin)
+                if not bundle_ids:
+                    return []
+
+            # temporary tables belong to the connection, which is pooled
+            cur.execute(self.DROP_QUERY_HASHES)
+            cur.execute(self.CREATE_QUERY_HASHES_TABLE)
+            for split_values in grouper(values, 1000):
+                cur.executemany(self.INSERT_QUERY_HASH, split_values)
+
+            if self.schema == self.SCHEMA_NORMALIZED:
+                cur.execute(self.SELECT_MATCH_COUNTS % (
+                    ', '.join(['%s'] * len(bundle_ids)), limit), bundle_ids)
+            elif admin:
+                cur.execute(self.SELECT_MATCH_COUNTS_ADMIN,
+                            (bundle, admin, limit))
+            else:
+                cur.execute(self.SELECT_MATCH_COUNTS,
+                            (bundle, user, admin, limit))
+            counts = [(sid, int(diff), int(count)) for sid, diff, count in cur]
+
+            cur.execute(self.DROP_QUERY_HASHES)
+        return counts
+
+    def _hash_key(self, hash):
+        """
+        Returns `hash` the way it comes back from `SELECT_MULTIPLE`.
+        """
+        if self.fingerprint_format == FORMAT_SHA1:
+            return hash.upper()
+        return hash
+
     def __getstate__(self):
-        return (self._options,)
+        return (self._options, self.fingerprint_format, self.schema,
+                self.bulk_insert)
 
     def __setstate__(self, state):
-        self._options, = state
+        (self._options, fingerprint_format, self.schema,
+         self.bulk_insert) = state
         self.cursor = cursor_factory(**self._options)
+        self._use_fingerprint_format(fingerprint_format)
 
 
 def grouper(iterable, n, fillvalue=None):
@@ -394,6 +1199,29 @@ def grouper(iterable, n, fillvalue=None):
             in izip_longest(fillvalue=fillvalue, *args))
 
 
+def _tsv_field(value):
+    """
+    Formats `value` as a field of a LOAD DATA file, escaping the
+    characters that would end the field or line.
+    """
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    elif not isinstance(value, str):
+        return str(value)
+    return (value.replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n"))
+
+
+def _mysql():
+    """
+    The MySQLdb driver, imported when a connection is first needed rather
+    than whenever dejavu is imported.
+    """
+    import MySQLdb
+    import MySQLdb.cursors
+    return MySQLdb
+
+
 def cursor_factory(**factory_options):
     def cursor(**options):
         options.update(factory_options)
@@ -414,9 +1242,10 @@ class Cursor(object):
     """
     _cache = Queue.Queue(maxsize=5)
 
-    def __init__(self, cursor_type=mysql.cursors.Cursor, **options):
+    def __init__(self, cursor_type=None, **options):
         super(Cursor, self).__init__()
 
+        mysql = _mysql()
         try:
             conn = self._cache.get_nowait()
         except Queue.Empty:
@@ -427,19 +1256,28 @@ class Cursor(object):
 
         self.conn = conn
         self.conn.autocommit(False)
-        self.cursor_type = cursor_type
+        self.cursor_type = cursor_type or mysql.cursors.Cursor
 
     @classmethod
     def clear_cache(cls):
         cls._cache = Queue.Queue(maxsize=5)
 
+    @classmethod
+    def close_cache(cls):
+        while True:
+            try:
+                conn = cls._cache.get_nowait()
+            except Queue.Empty:
+                break
+            conn.close()
+
     def __enter__(self):
         self.cursor = self.conn.cursor(self.cursor_type)
         return self.cursor
 
     def __exit__(self, extype, exvalue, traceback):
         # if we had a MySQL related error we try to rollback the cursor.
-        if extype is mysql.MySQLError:
+        if extype is _mysql().MySQLError:
             self.cursor.rollback()
 
         self.cursor.close()
@@ -0,0 +1,609 @@
+"""
+Database kept in a local SQLite file, for a single node or offline use
+without a MySQL server.
+
+The file is opened in WAL mode, so lookups keep running while songs are
+written or deleted. Fingerprints are stored like the normalized MySQL
+schema, in a WITHOUT ROWID table whose primary key is (bundle_id, hash,
+song_id, offset): the rows of a bundle sharing a hash sit next to each
+other in the table itself. A query's hashes go into a temporary table
+that is joined with it, which SQLite runs as one primary key lookup per
+query hash.
+
+```python
+config = {
+    "database_type": "sqlite",
+    "database": {"path": "/var/lib/dejavu/dejavu.sqlite"},
+}
+```
+"""
+from __future__ import absolute_import
+import binascii
+import sqlite3
+import threading
+
+from dejavu.database import Database, FingerprintFormatError
+from dejavu.fingerprint import FORMAT_SHA1, FORMAT_INT64
+from dejavu.logs import get_logger
+
+logger = get_logger('Classification_Dejavu_SQLite', "dejavu.log")
+
+
+class SQLiteDatabase(Database):
+
+    type = "sqlite"
+    lists_bundle_hashes = True
+
+    # tables
+    FINGERPRINTS_TABLENAME = "fingerprints"
+    SONGS_TABLENAME = "songs"
+    META_TABLENAME = "dejavu_meta"
+    QUERY_HASHES_TABLENAME = "query_hashes"
+    BUNDLES_TABLENAME = "bundles"
+
+    # fields
+    FIELD_HASH = "hash"
+    FIELD_SONG_ID = "song_id"
+    FIELD_OFFSET = "offset"
+    FIELD_SONGNAME = "song_name"
+    FIELD_TAG = "tag"
+    FIELD_FINGERPRINTED = "fingerprinted"
+    FIELD_BUNDLE = "bundle"
+    FIELD_USER = "user"
+    FIELD_ADMIN = "admin"
+    FIELD_META_NAME = "name"
+    FIELD_META_VALUE = "value"
+    FIELD_DIFF = "diff"
+    FIELD_BUNDLE_ID = "bundle_id"
+    FIELD_COUNT = "n"
+    FIELD_FILE_SIZE = "file_size"
+    FIELD_FILE_MTIME = "file_mtime"
+    FIELD_FILE_SHA1 = "file_sha1"
+
+    # meta keys
+    META_FINGERPRINT_FORMAT = "fingerprint_format"
+
+    # song ids per statement, below SQLite's limit of bound parameters
+    IN_BATCH_SIZE = 500
+
+    # creates
+    CREATE_SONGS_TABLE = """
+        CREATE TABLE IF NOT EXISTS %s (
+            %s integer primary key autoincrement,
+            %s text not null,
+            %s text not null,
+            `%s` text not null,
+            %s text not null,
+            %s integer not null default 0,
+            %s integer not null default 0,
+            %s integer,
+            %s real,
+            %s text
+    );""" % (
+        SONGS_TABLENAME, FIELD_SONG_ID, FIELD_SONGNAME, FIELD_TAG,
+        FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN, FIELD_FINGERPRINTED,
+        FIELD_FILE_SIZE, FIELD_FILE_MTIME, FIELD_FILE_SHA1,
+    )
+
+    CREATE_SONGS_INDEX = """
+        CREATE INDEX IF NOT EXISTS songs_tenant ON %s (`%s`, %s, %s);
+    """ % (SONGS_TABLENAME, FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN)
+
+    CREATE_BUNDLES_TABLE = """
+        CREATE TABLE IF NOT EXISTS %s (
+            %s integer primary key,
+            `%s` text not null,
+            %s text not null,
+            %s integer not null default 0,
+        UNIQUE (`%s`, %s, %s)
+    );""" % (
+        BUNDLES_TABLENAME, FIELD_BUNDLE_ID, FIELD_USER, FIELD_BUNDLE,
+        FIELD_ADMIN, FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN,
+    )
+
+    CREATE_FINGERPRINTS_TABLE = """
+        CREATE TABLE IF NOT EXISTS %s (
+            %s integer not null,
+            %s blob not null,
+            %s integer not null,
+            `%s` integer not null,
+        PRIMARY KEY (%s, %s, %s, `%s`)
+    ) WITHOUT ROWID;""" % (
+        FINGERPRINTS_TABLENAME, FIELD_BUNDLE_ID, FIELD_HASH, FIELD_SONG_ID,
+        FIELD_OFFSET, FIELD_BUNDLE_ID, FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET,
+    )
+
+    CREATE_META_TABLE = """
+        CREATE TABLE IF NOT EXISTS %s (
+            %s text primary key,
+            %s text not null
+    );""" % (META_TABLENAME, FIELD_META_NAME, FIELD_META_VALUE)
+
+    # per connection table holding the hashes of a query
+    CREATE_QUERY_HASHES_TABLE = """
+        CREATE TEMPORARY TABLE IF NOT EXISTS %s (
+            %s blob not null,
+            `%s` integer not null
+    );""" % (QUERY_HASHES_TABLENAME, FIELD_HASH, FIELD_OFFSET)
+
+    # inserts
+    INSERT_FINGERPRINT = """
+        INSERT OR IGNORE INTO %s (%s, %s, %s, `%s`) values (?, ?, ?, ?);
+    """ % (FINGERPRINTS_TABLENAME, FIELD_BUNDLE_ID, FIELD_HASH, FIELD_SONG_ID,
+           FIELD_OFFSET)
+
+    INSERT_SONG = """
+        INSERT INTO %s (%s, %s, `%s`, %s, %s, %s, %s, %s)
+        values (?, ?, ?, ?, ?, ?, ?, ?);
+    """ % (SONGS_TABLENAME, FIELD_SONGNAME, FIELD_TAG, FIELD_USER,
+           FIELD_BUNDLE, FIELD_ADMIN, FIELD_FILE_SIZE, FIELD_FILE_MTIME,
+           FIELD_FILE_SHA1)
+
+    INSERT_BUNDLE = """
+        INSERT OR IGNORE INTO %s (`%s`, %s, %s) values (?, ?, ?);
+    """ % (BUNDLES_TABLENAME, FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN)
+
+    INSERT_QUERY_HASH = """
+        INSERT INTO %s (%s, `%s`) values (?, ?);
+    """ % (QUERY_HASHES_TABLENAME, FIELD_HASH, FIELD_OFFSET)
+
+    REPLACE_META = "INSERT OR REPLACE INTO %s (%s, %s) values (?, ?);" % (
+        META_TABLENAME, FIELD_META_NAME, FIELD_META_VALUE)
+
+    # selects
+    SELECT = """
+        SELECT %s, `%s` FROM %s WHERE %s = ?;
+    """ % (FIELD_SONG_ID, FIELD_OFFSET, FINGERPRINTS_TABLENAME, FIELD_HASH)
+
+    SELECT_ALL = """
+        SELECT %s, `%s` FROM %s;
+    """ % (FIELD_SONG_ID, FIELD_OFFSET, FINGERPRINTS_TABLENAME)
+
+    SELECT_BUNDLE_ID = """
+        SELECT %s FROM %s WHERE `%s` = ? AND %s = ? AND %s = ?;
+    """ % (FIELD_BUNDLE_ID, BUNDLES_TABLENAME, FIELD_USER, FIELD_BUNDLE,
+           FIELD_ADMIN)
+
+    # admins see a bundle of that name whoever it belongs to
+    SELECT_ADMIN_BUNDLE_IDS = """
+        SELECT %s FROM %s WHERE %s = ? AND %s = ?;
+    """ % (FIELD_BUNDLE_ID, BUNDLES_TABLENAME, FIELD_BUNDLE, FIELD_ADMIN)
+
+    # CROSS JOIN keeps the query hashes as the outer loop, each one
+    # looked up in the primary key of every bundle; bundle ids are filled
+    # in before execution
+    SELECT_MULTIPLE = """
+        SELECT f.%s, f.`%s` - q.`%s` FROM %s q CROSS JOIN %s f
+        WHERE f.%s IN (%%s) AND f.%s = q.%s;
+    """ % (FIELD_SONG_ID, FIELD_OFFSET, FIELD_OFFSET, QUERY_HASHES_TABLENAME,
+           FINGERPRINTS_TABLENAME, FIELD_BUNDLE_ID, FIELD_HASH, FIELD_HASH)
+
+    SELECT_MATCH_COUNTS = """
+        SELECT f.%s, f.`%s` - q.`%s` AS %s, COUNT(*) AS %s
+        FROM %s q CROSS JOIN %s f
+        WHERE f.%s IN (%%s) AND f.%s = q.%s
+        GROUP BY f.%s, %s ORDER BY %s DESC LIMIT ?;
+    """ % (FIELD_SONG_ID, FIELD_OFFSET, FIELD_OFFSET, FIELD_DIFF, FIELD_COUNT,
+           QUERY_HASHES_TABLENAME, FINGERPRINTS_TABLENAME,
+           FIELD_BUNDLE_ID, FIELD_HASH, FIELD_HASH,
+           FIELD_SONG_ID, FIELD_DIFF, FIELD_COUNT)
+
+    # song ids are filled in before execution
+    SELECT_SONG_HASHES = """
+        SELECT %s, %s FROM %s WHERE %s = ? AND %s IN (%%s);
+    """ % (FIELD_HASH, FIELD_SONG_ID, FINGERPRINTS_TABLENAME, FIELD_BUNDLE_ID,
+           FIELD_SONG_ID)
+
+    SELECT_SONG = """
+        SELECT %s, %s FROM %s WHERE %s = ?;
+    """ % (FIELD_SONGNAME, FIELD_TAG, SONGS_TABLENAME, FIELD_SONG_ID)
+
+    SELECT_NUM_FINGERPRINTS = "SELECT COUNT(*) FROM %s;" % FINGERPRINTS_TABLENAME
+
+    SELECT_UNIQUE_SONG_IDS = """
+        SELECT COUNT(DISTINCT %s) FROM %s WHERE %s = 1;
+    """ % (FIELD_SONG_ID, SONGS_TABLENAME, FIELD_FINGERPRINTED)
+
+    SELECT_SONGS = """
+        SELECT %s, %s FROM %s WHERE %s = 1;
+    """ % (FIELD_SONG_ID, FIELD_SONGNAME, SONGS_TABLENAME, FIELD_FINGERPRINTED)
+
+    SELECT_BUNDLE_SONG_NAMES = """
+        SELECT %s FROM %s
+        WHERE %s = 1 AND `%s` = ? AND %s = ? AND %s = ?;
+    """ % (FIELD_SONGNAME, SONGS_TABLENAME, FIELD_FINGERPRINTED,
+           FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN)
+
+    SELECT_BUNDLE_SONG_FILES = """
+        SELECT %s, %s, %s, %s, %s FROM %s
+        WHERE %s = 1 AND `%s` = ? AND %s = ? AND %s = ?;
+    """ % (FIELD_SONG_ID, FIELD_SONGNAME, FIELD_FILE_SIZE, FIELD_FILE_MTIME,
+           FIELD_FILE_SHA1, SONGS_TABLENAME, FIELD_FINGERPRINTED,
+           FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN)
+
+    SELECT_BUNDLE_SONG_IDS = """
+        SELECT %s FROM %s WHERE `%s` = ? AND %s = ? AND %s = ?;
+    """ % (FIELD_SONG_ID, SONGS_TABLENAME, FIELD_USER, FIELD_BUNDLE, FIELD_ADMIN)
+
+    SELECT_META = """
+        SELECT %s FROM %s WHERE %s = ?;
+    """ % (FIELD_META_VALUE, META_TABLENAME, FIELD_META_NAME)
+
+    # updates
+    UPDATE_SONG_FINGERPRINTED = """
+        UPDATE %s SET %s = 1 WHERE %s = ?;
+    """ % (SONGS_TABLENAME, FIELD_FINGERPRINTED, FIELD_SONG_ID)
+
+    UPDATE_SONG_FILE = """
+        UPDATE %s SET %s = ?, %s = ?, %s = ? WHERE %s = ?;
+    """ % (SONGS_TABLENAME, FIELD_FILE_SIZE, FIELD_FILE_MTIME, FIELD_FILE_SHA1,
+           FIELD_SONG_ID)
+
+    # deletes
+    DELETE_QUERY_HASHES = "DELETE FROM %s;" % QUERY_HASHES_TABLENAME
+
+    DELETE_UNFINGERPRINTED_FINGERPRINTS = """
+        DELETE FROM %s WHERE %s IN (SELECT %s FROM %s WHERE %s = 0);
+    """ % (FINGERPRINTS_TABLENAME, FIELD_SONG_ID, FIELD_SONG_ID,
+           SONGS_TABLENAME, FIELD_FINGERPRINTED)
+
+    DELETE_UNFINGERPRINTED = """
+        DELETE FROM %s WHERE %s = 0;
+    """ % (SONGS_TABLENAME, FIELD_FINGERPRINTED)
+
+    DELETE_FINGERPRINT_BUNDLE = """
+        DELETE FROM %s WHERE %s = ?;
+    """ % (FINGERPRINTS_TABLENAME, FIELD_BUNDLE_ID)
+
+    # song ids are filled in before execution
+    DELETE_SONG_FINGERPRINTS = """
+        DELETE FROM %s WHERE %s = ? AND %s IN (%%s);
+    """ % (FINGERPRINTS_TABLENAME, FIELD_BUNDLE_ID, FIELD_SONG_ID)
+
+    DELETE_SONGS_BY_ID = """
+        DELETE FROM %s WHERE %s IN (%%s);
+    """ % (SONGS_TABLENAME, FIELD_SONG_ID)
+
+    DELETE_SONGS = "DELETE FROM %s;" % SONGS_TABLENAME
+    DELETE_BUNDLES = "DELETE FROM %s;" % BUNDLES_TABLENAME
+
+    # drops
+    DROP_FINGERPRINTS = "DROP TABLE IF EXISTS %s;" % FINGERPRINTS_TABLENAME
+    DROP_SONGS = "DROP TABLE IF EXISTS %s;" % SONGS_TABLENAME
+    DROP_BUNDLES = "DROP TABLE IF EXISTS %s;" % BUNDLES_TABLENAME
+
+    def __init__(self, fingerprint_format=FORMAT_SHA1, path="dejavu.sqlite",
+                 timeout=30, **options):
+        super(SQLiteDatabase, self).__init__()
+        if fingerprint_format not in (FORMAT_SHA1, FORMAT_INT64):
+            raise FingerprintFormatError(
+                "Unsupported fingerprint format: %s" % fingerprint_format)
+        self.fingerprint_format = fingerprint_format
+        self.path = path
+        self.timeout = timeout
+        self._reset_connections()
+
+    def _reset_connections(self):
+        # one connection per thread, as sqlite3 wants it
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._bundle_ids = {}
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.text_factory = str
+            conn.execute("PRAGMA journal_mode = WAL;")
+            # durable enough with WAL, a crash loses at most the last
+            # transactions but never corrupts the file
+            conn.execute("PRAGMA synchronous = NORMAL;")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def before_fork(self):
+        # a process started now must not use the connections of this one
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+        self._reset_connections()
+
+    def after_fork(self):
+        self._reset_connections()
+
+    def _hash_value(self, hash):
+        """
+        Returns `hash` the way it is stored: the bytes of a sha1 hex
+        string, or an int64 fingerprint as the signed integer SQLite
+        takes.
+        """
+        if self.fingerprint_format == FORMAT_SHA1:
+            if len(hash) % 2:
+                hash = "0" + hash
+            return buffer(binascii.unhexlify(hash))
+        hash = int(hash)
+        return hash - (1 << 64) if hash >= 1 << 63 else hash
+
+    def _stored_hash(self, value):
+        """
+        Inverse of `_hash_value`.
+        """
+        if self.fingerprint_format == FORMAT_SHA1:
+            return binascii.hexlify(value)
+        return value + (1 << 64) if value < 0 else value
+
+    def setup(self):
+        """
+        Creates any non-existing tables required for dejavu to function,
+        and removes all songs that have been added but have no
+        fingerprints associated with them.
+        """
+        with self._conn() as conn:
+            conn.execute(self.CREATE_SONGS_TABLE)
+            conn.execute(self.CREATE_SONGS_INDEX)
+            conn.execute(self.CREATE_BUNDLES_TABLE)
+            conn.execute(self.CREATE_META_TABLE)
+            conn.execute(self.CREATE_FINGERPRINTS_TABLE)
+            self._check_fingerprint_format(conn)
+            self._delete_unfingerprinted(conn)
+
+    def _check_fingerprint_format(self, conn):
+        row = conn.execute(self.SELECT_META,
+                           (self.META_FINGERPRINT_FORMAT,)).fetchone()
+        if row is None:
+            conn.execute(self.REPLACE_META, (self.META_FINGERPRINT_FORMAT,
+                                             self.fingerprint_format))
+        elif row[0] != self.fingerprint_format:
+            raise FingerprintFormatError(
+                "Database holds %s fingerprints but %s was requested, "
+                "migrate it with `migrate_fingerprint_format` first."
+                % (row[0], self.fingerprint_format))
+
+    def migrate_fingerprint_format(self, fingerprint_format):
+        """
+        Switches the database to another fingerprint format, removing all
+        songs and fingerprints.
+
+        .. warning:
+            This will result in a loss of data
+        """
+        if fingerprint_format not in (FORMAT_SHA1, FORMAT_INT64):
+            raise FingerprintFormatError(
+                "Unsupported fingerprint format: %s" % fingerprint_format)
+        with self._conn() as conn:
+            conn.execute(self.CREATE_META_TABLE)
+            conn.execute(self.REPLACE_META, (self.META_FINGERPRINT_FORMAT,
+                                             fingerprint_format))
+        self.fingerprint_format = fingerprint_format
+        self.empty()
+
+    def empty(self):
+        """
+        Drops tables created by dejavu and then creates them again
+        by calling `SQLiteDatabase.setup`.
+
+        .. warning:
+            This will result in a loss of data
+        """
+        with self._conn() as conn:
+            conn.execute(self.DROP_FINGERPRINTS)
+            conn.execute(self.DROP_SONGS)
+            conn.execute(self.DROP_BUNDLES)
+        self._bundle_ids = {}
+        self.setup()
+
+    def delete_unfingerprinted_songs(self):
+        with self._conn() as conn:
+            self._delete_unfingerprinted(conn)
+
+    def _delete_unfingerprinted(self, conn):
+        conn.execute(self.DELETE_UNFINGERPRINTED_FINGERPRINTS)
+        conn.execute(self.DELETE_UNFINGERPRINTED)
+
+    def _bundle_id(self, conn, user, bundle, admin):
+        """
+        Returns the id of the bundle, adding it to the bundles table if it
+        is new.
+        """
+        key = (user, bundle, int(bool(admin)))
+        if key not in self._bundle_ids:
+            conn.execute(self.INSERT_BUNDLE, key)
+            self._bundle_ids[key] = conn.execute(
+                self.SELECT_BUNDLE_ID, key).fetchone()[0]
+        return self._bundle_ids[key]
+
+    def _match_bundle_ids(self, conn, user, bundle, admin):
+        """
+        Returns the ids of the bundles a query of this tenant searches:
+        the bundle of `user`, or for admins every admin bundle of that name.
+        """
+        if admin:
+            rows = conn.execute(self.SELECT_ADMIN_BUNDLE_IDS, (bundle, 1))
+        else:
+            rows = conn.execute(self.SELECT_BUNDLE_ID, (user, bundle, 0))
+        return [bundle_id for bundle_id, in rows]
+
+    def delete_bundle(self, user, bundle, admin):
+        """
+        Removes all songs and fingerprints associated with a bundle. Lookups
+        keep reading the last committed state meanwhile, WAL mode never
+        blocks them on a writer.
+        """
+        admin = int(bool(admin))
+        conn = self._conn()
+        with conn:
+            for bundle_id, in conn.execute(self.SELECT_BUNDLE_ID,
+                                           (user, bundle, admin)).fetchall():
+                conn.execute(self.DELETE_FINGERPRINT_BUNDLE, (bundle_id,))
+            sids = [sid for sid, in conn.execute(
+                self.SELECT_BUNDLE_SONG_IDS, (user, bundle, admin))]
+        self.delete_songs(user, bundle, admin, sids)
+
+    def get_bundle_hashes(self, user, bundle, admin, sids):
+        """
+        Yields (hash, sid) pairs of the fingerprints of songs of a bundle,
+        IN_BATCH_SIZE songs per query.
+        """
+        sids = list(sids)
+        conn = self._conn()
+        bundle_ids = [bundle_id for bundle_id, in conn.execute(
+            self.SELECT_BUNDLE_ID, (user, bundle, int(bool(admin))))]
+        for start in xrange(0, len(sids), self.IN_BATCH_SIZE):
+            split_sids = sids[start:start + self.IN_BATCH_SIZE]
+            in_list = ", ".join(["?"] * len(split_sids))
+            for bundle_id in bundle_ids:
+                for value, sid in conn.execute(
+                        self.SELECT_SONG_HASHES % in_list,
+                        [bundle_id] + split_sids):
+                    yield self._stored_hash(value), sid
+
+    def delete_songs(self, user, bundle, admin, sids):
+        """
+        Removes songs of a bundle and their fingerprints, IN_BATCH_SIZE
+        songs per transaction.
+        """
+        sids = list(sids)
+        conn = self._conn()
+        bundle_ids = [bundle_id for bundle_id, in conn.execute(
+            self.SELECT_BUNDLE_ID, (user, bundle, int(bool(admin))))]
+        for start in xrange(0, len(sids), self.IN_BATCH_SIZE):
+            split_sids = sids[start:start + self.IN_BATCH_SIZE]
+            in_list = ", ".join(["?"] * len(split_sids))
+            with conn:
+                for bundle_id in bundle_ids:
+                    conn.execute(self.DELETE_SONG_FINGERPRINTS % in_list,
+                                 [bundle_id] + split_sids)
+                conn.execute(self.DELETE_SONGS_BY_ID % in_list, split_sids)
+
+    def get_num_songs(self):
+        return self._conn().execute(self.SELECT_UNIQUE_SONG_IDS).fetchone()[0]
+
+    def get_num_fingerprints(self):
+        return self._conn().execute(self.SELECT_NUM_FINGERPRINTS).fetchone()[0]
+
+    def set_song_fingerprinted(self, sid):
+        with self._conn() as conn:
+            conn.execute(self.UPDATE_SONG_FINGERPRINTED, (sid,))
+
+    def get_songs(self):
+        for sid, song_name in self._conn().execute(self.SELECT_SONGS):
+            yield {self.FIELD_SONG_ID: sid, self.FIELD_SONGNAME: song_name}
+
+    def get_song_names(self, user, bundle, admin):
+        return [song_name for song_name, in self._conn().execute(
+            self.SELECT_BUNDLE_SONG_NAMES, (user, bundle, int(bool(admin))))]
+
+    def get_song_files(self, user, bundle, admin):
+        return list(self._conn().execute(
+            self.SELECT_BUNDLE_SONG_FILES, (user, bundle, int(bool(admin)))))
+
+    def set_song_file(self, sid, size, mtime, checksum):
+        with self._conn() as conn:
+            conn.execute(self.UPDATE_SONG_FILE, (size, mtime, checksum, sid))
+
+    def get_song_by_id(self, sid):
+        row = self._conn().execute(self.SELECT_SONG, (sid,)).fetchone()
+        if row is None:
+            return None
+        return {self.FIELD_SONGNAME: row[0], self.FIELD_TAG: row[1]}
+
+    def insert(self, hash, sid, offset, tag, user, bundle, admin=False):
+        self.insert_hashes(sid, [(hash, offset)], tag, user, bundle, admin)
+
+    def insert_song(self, songname, tag, user, bundle, admin=False,
+                    file_info=None):
+        """
+        Inserts song in the database and returns the ID of the inserted record.
+
+        file_info: (size, mtime, checksum) of the song's file, if known
+        """
+        size, mtime, checksum = file_info or (None, None, None)
+        with self._conn() as conn:
+            return conn.execute(self.INSERT_SONG, (
+                songname, tag, user, bundle, int(bool(admin)),
+                size, mtime, checksum)).lastrowid
+
+    def query(self, hash):
+        """
+        Return all (sid, offset) tuples associated with hash, or every
+        one in the database if hash is None.
+        """
+        if hash is None:
+            rows = self._conn().execute(self.SELECT_ALL)
+        else:
+            rows = self._conn().execute(self.SELECT, (self._hash_value(hash),))
+        for sid, offset in rows:
+            yield (sid, offset)
+
+    def get_iterable_kv_pairs(self):
+        return self.query(None)
+
+    def insert_hashes(self, sid, hashes, tag, user, bundle, admin=False):
+        self.insert_hashes_many([(sid, hashes, tag, user, bundle, admin)])
+
+    def insert_hashes_many(self, songs):
+        """
+        Inserts the hashes of several songs, (sid, hashes, tag, user,
+        bundle, admin) tuples, each song in one transaction.
+        """
+        conn = self._conn()
+        hash_value = self._hash_value
+        for sid, hashes, tag, user, bundle, admin in songs:
+            with conn:
+                bundle_id = self._bundle_id(conn, user, bundle, admin)
+                conn.executemany(self.INSERT_FINGERPRINT, (
+                    (bundle_id, hash_value(hash), sid, offset)
+                    for hash, offset in hashes))
+
+    def _load_query(self, conn, values):
+        conn.execute(self.CREATE_QUERY_HASHES_TABLE)
+        conn.execute(self.DELETE_QUERY_HASHES)
+        conn.executemany(self.INSERT_QUERY_HASH, values)
+
+    def return_matches(self, hashes, user, bundle, admin):
+        """
+        Return the (song_id, offset_diff) tuples associated with a list of
+        (sha1, sample_offset) values, joining the query hashes, one offset
+        each, with the fingerprints.
+        """
+        mapper = {}
+        for hash, offset in hashes:
+            mapper[self._hash_value(hash)] = offset
+
+        conn = self._conn()
+        with conn:
+            bundle_ids = self._match_bundle_ids(conn, user, bundle, admin)
+            if not bundle_ids:
+                return []
+            self._load_query(conn, mapper.iteritems())
+            return conn.execute(self.SELECT_MULTIPLE % ", ".join(
+                ["?"] * len(bundle_ids)), bundle_ids).fetchall()
+
+    def return_match_counts(self, hashes, user, bundle, admin, limit=10):
+        """
+        Offset histogram computed by SQLite, over every (hash, offset)
+        pair of the query like `SQLDatabase.return_match_counts`.
+
+        Returns a list of (sid, offset_difference, count) tuples, most
+        common first.
+        """
+        values = [(self._hash_value(hash), offset) for hash, offset in hashes]
+
+        conn = self._conn()
+        with conn:
+            bundle_ids = self._match_bundle_ids(conn, user, bundle, admin)
+            if not bundle_ids:
+                return []
+            self._load_query(conn, values)
+            return conn.execute(self.SELECT_MATCH_COUNTS % ", ".join(
+                ["?"] * len(bundle_ids)), bundle_ids + [limit]).fetchall()
+
+    def __getstate__(self):
+        return (self.fingerprint_format, self.path, self.timeout)
+
+    def __setstate__(self, state):
+        self.fingerprint_format, self.path, self.timeout = state
+        self._reset_connections()
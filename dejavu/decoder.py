@@ -1,11 +1,22 @@
 import os
 import fnmatch
+import subprocess
+from contextlib import closing
+import tempfile
+import audioop
 import numpy as np
-from pydub import AudioSegment
-from pydub.effects import normalize
-from pydub.utils import audioop
 import wavio
 
+# Number of frames `iter_read` decodes at a time
+DEFAULT_BLOCKSIZE = 2 ** 20
+
+# Decoders `iter_decode` can use: "wav" reads like `read` (through a
+# temporary WAV file, normalized, at the file's own rate), "pcm" pipes raw
+# PCM out of ffmpeg, resampled and remixed on the way, see `iter_read_pcm`
+DECODER_WAV = "wav"
+DECODER_PCM = "pcm"
+DECODERS = (DECODER_WAV, DECODER_PCM)
+
 def find_files(path, extensions):
     """
     Returns files in directory matching the given extensions
@@ -34,6 +45,9 @@ def read(filename, limit=None):
 
     returns: (channels, samplerate)
     """
+    from pydub import AudioSegment
+    from pydub.effects import normalize
+
     try:
         audiofile = normalize(AudioSegment.from_file(filename))
 
@@ -46,20 +60,187 @@ def read(filename, limit=None):
             channels.append(data[chn::audiofile.channels])
         fs = audiofile.frame_rate
     except audioop.error:
-        fs, _, audiofile = wavio.readwav(filename)
-
-        if limit:
-            audiofile = audiofile[:limit * 1000]
+        with closing(wavio.WavReader(filename)) as wav:
+            fs = wav.rate
+            audiofile = wav.read(0, limit or None)
 
-        audiofile = audiofile.T
-        audiofile = audiofile.astype(np.int16)
         channels = []
-        for chn in audiofile:
+        for chn in audiofile.T:
             channels.append(chn)
 
     return channels, fs
 
 
+def iter_read(filename, limit=None, blocksize=DEFAULT_BLOCKSIZE):
+    """
+    Streaming counterpart of `read`: yields the same channels, normalized
+    the same way, in blocks of at most `blocksize` frames so that only one
+    block is held in memory at a time.
+
+    PCM WAV files are memory mapped and decoded a block at a time (see
+    `wavio.WavReader`); anything else is first converted to a temporary
+    16 bit WAV file with ffmpeg. 16 bit audio is read twice: once to find
+    the peak used for normalization, once to hand out the blocks. Other
+    sample widths are cut down to 16 bits and, like the wavio fallback of
+    `read`, not normalized.
+
+    yields: (channels, samplerate) for each block
+    """
+    wavname = filename
+    try:
+        try:
+            wav = wavio.WavReader(filename)
+        except ValueError:
+            wavname = _convert_to_wav(filename)
+            wav = wavio.WavReader(wavname)
+
+        with closing(wav):
+            fs = wav.rate
+            nchannels = wav.nchannels
+            stop = limit or None
+
+            if wav.sampwidth == 2:
+                # pydub path: normalize over the whole file, then cut
+                gain = _normalize_gain(wav, blocksize)
+                for data in wav.raw_blocks(0, stop, blocksize):
+                    if gain != 1:
+                        data = audioop.mul(data, 2, gain)
+                    data = np.fromstring(data, np.int16)
+                    yield [data[chn::nchannels] for chn in xrange(nchannels)], fs
+            else:
+                for data in wav.blocks(0, stop, blocksize):
+                    yield list(data.T), fs
+    finally:
+        if wavname != filename:
+            os.remove(wavname)
+
+
+def iter_read_pcm(filename, limit=None, fs=44100, nchannels=1,
+                  blocksize=DEFAULT_BLOCKSIZE):
+    """
+    Decodes `filename` with ffmpeg straight to 16 bit PCM at `fs` Hz with
+    `nchannels` channels, and yields it in blocks of at most `blocksize`
+    frames as it comes out of the pipe.
+
+    Nothing is written to disk and ffmpeg stops after `limit` seconds. Each
+    block is read into a buffer of its own, and the channels handed out are
+    `np.frombuffer` views of it rather than copies. Unlike `read` the audio
+    is not normalized, which would need the whole file first; a gain
+    shifts every cell of the spectrogram alike, so the peaks only differ
+    around the `amp_min` threshold.
+
+    yields: (channels, samplerate) for each block
+    """
+    from pydub import AudioSegment
+
+    command = [AudioSegment.converter, "-nostdin", "-v", "error",
+               "-i", filename, "-vn"]
+    nframes = None
+    if limit:
+        command += ["-t", str(limit)]
+        nframes = int(limit * fs)
+    command += ["-f", "s16le", "-acodec", "pcm_s16le",
+                "-ar", str(fs), "-ac", str(nchannels), "-"]
+
+    frame_bytes = 2 * nchannels
+    with open(os.devnull, 'wb') as devnull:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                   stderr=devnull)
+    try:
+        while nframes is None or nframes > 0:
+            size = blocksize if nframes is None else min(blocksize, nframes)
+            buf = bytearray(size * frame_bytes)
+            nbytes = _read_into(process.stdout, buf)
+            nbytes -= nbytes % frame_bytes
+            if not nbytes:
+                break
+            if nframes is not None:
+                nframes -= nbytes // frame_bytes
+
+            data = np.frombuffer(buf, np.int16, count=nbytes // 2)
+            yield [data[chn::nchannels] for chn in xrange(nchannels)], fs
+
+        if nframes is None or nframes > 0:
+            # ffmpeg ran to the end of the file by itself
+            process.stdout.close()
+            if process.wait():
+                raise subprocess.CalledProcessError(process.returncode,
+                                                    command)
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+def _read_into(stream, buf):
+    """
+    Fills `buf` from `stream` and returns the number of bytes read, which
+    is only less than its size at the end of the stream.
+    """
+    view = memoryview(buf)
+    nbytes = 0
+    while nbytes < len(buf):
+        n = stream.readinto(view[nbytes:])
+        if not n:
+            break
+        nbytes += n
+    return nbytes
+
+
+def iter_decode(filename, limit=None, mode=DECODER_WAV, fs=44100,
+                nchannels=1, blocksize=DEFAULT_BLOCKSIZE):
+    """
+    Yields (channels, samplerate) blocks of `filename` with the decoder
+    `mode`, one of DECODERS. `fs` and `nchannels` are the sample rate and
+    number of channels the "pcm" decoder converts to; the "wav" decoder
+    keeps those of the file.
+    """
+    if mode == DECODER_PCM:
+        return iter_read_pcm(filename, limit, fs=fs, nchannels=nchannels,
+                             blocksize=blocksize)
+    elif mode == DECODER_WAV:
+        return iter_read(filename, limit, blocksize=blocksize)
+    raise ValueError("Unsupported decoder: %s" % mode)
+
+
+def _normalize_gain(wav, blocksize):
+    """
+    Returns the factor pydub.effects.normalize would scale the samples of
+    the 16 bit `wavio.WavReader` by.
+    """
+    from pydub.utils import db_to_float, ratio_to_db
+
+    peak = 0
+    for data in wav.raw_blocks(blocksize=blocksize):
+        peak = max(peak, audioop.max(data, 2))
+    if peak == 0:
+        return 1
+
+    target_peak = 2 ** 15 * db_to_float(-0.1)
+    return db_to_float(float(ratio_to_db(target_peak / float(peak))))
+
+
+def _convert_to_wav(filename):
+    """
+    Converts `filename` to a temporary 16 bit WAV file with the same
+    converter pydub uses and returns the path of the temporary file.
+    """
+    from pydub import AudioSegment
+
+    fd, wavname = tempfile.mkstemp(suffix=".wav")
+    os.close(fd)
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            subprocess.check_call([AudioSegment.converter, "-y", "-i", filename,
+                                   "-vn", "-acodec", "pcm_s16le", "-f", "wav",
+                                   wavname], stdout=devnull, stderr=devnull)
+    except:
+        os.remove(wavname)
+        raise
+    return wavname
+
+
 def path_to_songname(path):
     """
     Extracts song name from a filepath. Used to identify which songs
@@ -1,132 +1,664 @@
 import numpy as np
-import matplotlib.mlab as mlab
-import matplotlib.pyplot as plt
-from scipy.ndimage.filters import maximum_filter
-from scipy.ndimage.morphology import (generate_binary_structure,
-                                      iterate_structure, binary_erosion)
+from numpy.lib.stride_tricks import as_strided
+from scipy import fftpack
 import hashlib
-from operator import itemgetter
-
-# Loads settings from the db
-from models import Sys_Settings
-sys_sett = Sys_Settings.objects.get()
+import json
+import os
 
+######################################################################
+# Defaults of the fingerprinting parameters. The values in use are the
+# ones of the FingerprintConfig handed to the functions below, which by
+# default come from the settings stored in the db (Sys_Settings), see
+# `FingerprintConfig.load`.
 
-IDX_FREQ_I = sys_sett.dejavu_settings.IDX_FREQ_I
-IDX_TIME_J = sys_sett.dejavu_settings.IDX_FREQ_J
+IDX_FREQ_I = 0
+IDX_TIME_J = 1
 
 ######################################################################
 # Sampling rate, related to the Nyquist conditions, which affects
 # the range frequencies we can detect.
-DEFAULT_FS = sys_sett.dejavu_settings.DEFAULT_FS
+DEFAULT_FS = 44100
 
 ######################################################################
 # Size of the FFT window, affects frequency granularity
-DEFAULT_WINDOW_SIZE = sys_sett.dejavu_settings.DEFAULT_WINDOW_SIZE
+DEFAULT_WINDOW_SIZE = 4096
 
 ######################################################################
 # Ratio by which each sequential window overlaps the last and the
 # next window. Higher overlap will allow a higher granularity of offset
 # matching, but potentially more fingerprints.
-DEFAULT_OVERLAP_RATIO = float(sys_sett.dejavu_settings.DEFAULT_OVERLAP_RATIO)
+DEFAULT_OVERLAP_RATIO = 0.5
 
 ######################################################################
 # Degree to which a fingerprint can be paired with its neighbors --
 # higher will cause more fingerprints, but potentially better accuracy.
-DEFAULT_FAN_VALUE = sys_sett.dejavu_settings.DEFAULT_FAN_VALUE
+DEFAULT_FAN_VALUE = 15
 
 ######################################################################
 # Minimum amplitude in spectrogram in order to be considered a peak.
 # This can be raised to reduce number of fingerprints, but can negatively
 # affect accuracy.
-DEFAULT_AMP_MIN = sys_sett.dejavu_settings.DEFAULT_AMP_MIN
+DEFAULT_AMP_MIN = 10
 
 ######################################################################
 # Number of cells around an amplitude peak in the spectrogram in order
 # for Dejavu to consider it a spectral peak. Higher values mean less
 # fingerprints and faster matching, but can potentially affect accuracy.
-PEAK_NEIGHBORHOOD_SIZE = sys_sett.dejavu_settings.PEAK_NEIGHBORHOOD_SIZE
+PEAK_NEIGHBORHOOD_SIZE = 20
 
 ######################################################################
 # Thresholds on how close or far fingerprints can be in time in order
 # to be paired as a fingerprint. If your max is too low, higher values of
 # DEFAULT_FAN_VALUE may not perform as expected.
-MIN_HASH_TIME_DELTA = sys_sett.dejavu_settings.MIN_HASH_TIME_DELTA
-MAX_HASH_TIME_DELTA = sys_sett.dejavu_settings.MAX_HASH_TIME_DELTA
+MIN_HASH_TIME_DELTA = 0
+MAX_HASH_TIME_DELTA = 200
 
 ######################################################################
 # If True, will sort peaks temporally for fingerprinting;
 # not sorting will cut down number of fingerprints, but potentially
 # affect performance.
-PEAK_SORT = sys_sett.dejavu_settings.PEAK_SORT
+PEAK_SORT = True
 
 ######################################################################
 # Number of bits to throw away from the front of the SHA1 hash in the
 # fingerprint calculation. The more you throw away, the less storage, but
 # potentially higher collisions and misclassifications when identifying songs.
-FINGERPRINT_REDUCTION = sys_sett.dejavu_settings.FINGERPRINT_REDUCTION
+FINGERPRINT_REDUCTION = 20
+
+######################################################################
+# Encoding of the fingerprints. "sha1" keeps the truncated SHA1 hex
+# strings described above. "int64" packs freq1, freq2 and t_delta
+# straight into an unsigned 64-bit integer, which is smaller to store
+# and needs no string conversion anywhere; the two are not compatible
+# so a database only ever holds one of them.
+FORMAT_SHA1 = "sha1"
+FORMAT_INT64 = "int64"
+FINGERPRINT_FORMATS = (FORMAT_SHA1, FORMAT_INT64)
+DEFAULT_FINGERPRINT_FORMAT = FORMAT_SHA1
+
+# Bit layout of an int64 fingerprint: freq1 | freq2 | t_delta
+INT64_FREQ_BITS = 20
+INT64_DELTA_BITS = 24
+
+######################################################################
+# Number of windows `spectrogram` transforms at once. Bounds the scratch
+# memory used next to the output array.
+STFT_BLOCK_WINDOWS = 1024
+
+######################################################################
+# Local copy of the settings stored in the db, so they are only queried
+# once rather than by every process that fingerprints.
+SETTINGS_CACHE_FILE = "fingerprint_settings.json"
+
+
+class FingerprintConfig(object):
+    """
+    One set of fingerprinting parameters.
+
+    The attributes are the module defaults above in lower case, and any
+    left out take the default. A config is passed explicitly to
+    `fingerprint`, `get_2D_peaks`, `generate_hashes`, `FingerprintStream`
+    and `Dejavu.align_matches`, so several profiles can be used side by
+    side in one process.
+
+    ```python
+    config = FingerprintConfig.load()
+    hashes = fingerprint(samples, config)
+    coarse = config.replace(fan_value=5, amp_min=20)
+    ```
+    """
+
+    # attribute, field of Sys_Settings.dejavu_settings, type
+    SETTINGS = (
+        ("idx_freq_i", "IDX_FREQ_I", int),
+        ("idx_time_j", "IDX_FREQ_J", int),
+        ("fs", "DEFAULT_FS", int),
+        ("window_size", "DEFAULT_WINDOW_SIZE", int),
+        ("overlap_ratio", "DEFAULT_OVERLAP_RATIO", float),
+        ("fan_value", "DEFAULT_FAN_VALUE", int),
+        ("amp_min", "DEFAULT_AMP_MIN", float),
+        ("peak_neighborhood_size", "PEAK_NEIGHBORHOOD_SIZE", int),
+        ("min_hash_time_delta", "MIN_HASH_TIME_DELTA", int),
+        ("max_hash_time_delta", "MAX_HASH_TIME_DELTA", int),
+        ("peak_sort", "PEAK_SORT", bool),
+        ("fingerprint_reduction", "FINGERPRINT_REDUCTION", int),
+    )
+
+    # layout of the cache file, bumped when it changes
+    CACHE_VERSION = 1
+
+    def __init__(self, idx_freq_i=IDX_FREQ_I, idx_time_j=IDX_TIME_J,
+                 fs=DEFAULT_FS,
+                 window_size=DEFAULT_WINDOW_SIZE,
+                 overlap_ratio=DEFAULT_OVERLAP_RATIO,
+                 fan_value=DEFAULT_FAN_VALUE,
+                 amp_min=DEFAULT_AMP_MIN,
+                 peak_neighborhood_size=PEAK_NEIGHBORHOOD_SIZE,
+                 min_hash_time_delta=MIN_HASH_TIME_DELTA,
+                 max_hash_time_delta=MAX_HASH_TIME_DELTA,
+                 peak_sort=PEAK_SORT,
+                 fingerprint_reduction=FINGERPRINT_REDUCTION,
+                 fingerprint_format=DEFAULT_FINGERPRINT_FORMAT):
+        super(FingerprintConfig, self).__init__()
+
+        values = locals()
+        for name, _, cast in self.SETTINGS:
+            setattr(self, name, cast(values[name]))
 
-def fingerprint(channel_samples, Fs=DEFAULT_FS,
-                wsize=DEFAULT_WINDOW_SIZE,
-                wratio=DEFAULT_OVERLAP_RATIO,
-                fan_value=DEFAULT_FAN_VALUE,
-                amp_min=DEFAULT_AMP_MIN):
+        if fingerprint_format not in FINGERPRINT_FORMATS:
+            raise ValueError("Unsupported fingerprint format: %s"
+                             % fingerprint_format)
+        self.fingerprint_format = fingerprint_format
+
+    def as_dict(self):
+        settings = dict((name, getattr(self, name))
+                        for name, _, _ in self.SETTINGS)
+        settings["fingerprint_format"] = self.fingerprint_format
+        return settings
+
+    def replace(self, **changes):
+        """
+        Returns a copy of the config with the given parameters changed.
+        """
+        settings = self.as_dict()
+        settings.update(changes)
+        return FingerprintConfig(**settings)
+
+    @property
+    def version(self):
+        """
+        Stamp of the parameters; it changes whenever one of them, and so
+        the fingerprints they give, does.
+        """
+        settings = json.dumps(self.as_dict(), sort_keys=True)
+        return hashlib.sha1(settings).hexdigest()[:12]
+
+    def __eq__(self, other):
+        return (isinstance(other, FingerprintConfig) and
+                self.as_dict() == other.as_dict())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.version)
+
+    def __repr__(self):
+        return "FingerprintConfig(%s)" % ", ".join(
+            "%s=%r" % item for item in sorted(self.as_dict().items()))
+
+    @classmethod
+    def from_sys_settings(cls):
+        """
+        Queries the settings stored in the db.
+        """
+        from models import Sys_Settings
+        settings = Sys_Settings.objects.get().dejavu_settings
+        return cls(**dict((name, getattr(settings, field))
+                          for name, field, _ in cls.SETTINGS))
+
+    @classmethod
+    def load(cls, cache_file=SETTINGS_CACHE_FILE, refresh=False):
+        """
+        Returns the settings stored in the db, read from `cache_file` when
+        it holds a copy of them. The db is only queried when there is no
+        valid copy or `refresh` is set, and the result is written back to
+        `cache_file`. With no `cache_file` the db is always queried.
+        """
+        if cache_file and not refresh:
+            config = cls.read_cache(cache_file)
+            if config is not None:
+                return config
+
+        config = cls.from_sys_settings()
+        if cache_file:
+            config.write_cache(cache_file)
+        return config
+
+    @classmethod
+    def read_cache(cls, cache_file):
+        """
+        Returns the config stored in `cache_file`, or None if it is
+        missing, unreadable, of another layout or does not match its
+        version stamp.
+        """
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+            if cached.get("cache_version") != cls.CACHE_VERSION:
+                return None
+            config = cls(**dict((str(name), value) for name, value
+                                in cached["settings"].items()))
+        except (IOError, ValueError, TypeError, KeyError, AttributeError):
+            return None
+
+        if config.version != cached.get("version"):
+            return None
+        return config
+
+    def write_cache(self, cache_file):
+        """
+        Stores the config in `cache_file`. The file is replaced in one
+        step, so processes reading it concurrently never see half of it.
+        """
+        directory = os.path.dirname(os.path.abspath(cache_file))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+        with open(tmp_file, "w") as f:
+            json.dump({"cache_version": self.CACHE_VERSION,
+                       "version": self.version,
+                       "settings": self.as_dict()}, f, indent=2,
+                      sort_keys=True)
+        os.rename(tmp_file, cache_file)
+
+
+def fingerprint(channel_samples, config, Fs=None):
     """
     FFT the channel, log transform output, find local maxima, then return
     locally sensitive hashes.
-    """
-    # FFT the signal and extract frequency components
-    arr2D = mlab.specgram(
-        channel_samples,
-        NFFT=wsize,
-        Fs=Fs,
-        window=mlab.window_hanning,
-        noverlap=int(wsize * wratio))[0]
 
-    # apply log transform since specgram() returns linear array
-    arr2D = 10 * np.log10(arr2D)
-    arr2D[arr2D == -np.inf] = 0  # replace infs with zeros
+    `config` is the FingerprintConfig to use; `Fs` is the sampling rate of
+    the channel, ``config.fs`` if not given.
+    """
+    arr2D = spectrogram(channel_samples, config, Fs=Fs)
 
     # find local maxima
-    local_maxima = get_2D_peaks(arr2D, plot=False, amp_min=amp_min)
+    local_maxima = get_2D_peaks(arr2D, config, plot=False)
 
     # return hashes
-    return generate_hashes(local_maxima, fan_value=fan_value)
+    return generate_hashes(local_maxima, config)
+
 
+def spectrogram(channel_samples, config, Fs=None):
+    """
+    Log scaled spectrogram of the channel, frequencies by windows, with
+    the window size and overlap of `config`.
+
+    Gives the float32 equivalent of ``10 * log10(mlab.specgram(...))``
+    with silent cells set to 0. The samples are cut into windows through a
+    strided view instead of being copied, transformed with scipy's single
+    precision real FFT a few windows at a time, and the power is scaled
+    and log transformed in place.
+    """
+    if Fs is None:
+        Fs = config.fs
+    wsize = config.window_size
+    plan = _stft_plan(wsize, int(wsize * config.overlap_ratio))
+
+    samples = np.asarray(channel_samples)
+    if len(samples) < wsize:
+        # too short for a single window, zero pad like mlab.specgram
+        padded = np.zeros(wsize, dtype=samples.dtype)
+        padded[:len(samples)] = samples
+        samples = padded
+
+    nwindows = 1 + (len(samples) - wsize) // plan.step
+    stride = samples.strides[0]
+    windows = as_strided(samples, shape=(nwindows, wsize),
+                         strides=(stride * plan.step, stride))
 
-def get_2D_peaks(arr2D, plot=False, amp_min=DEFAULT_AMP_MIN):
+    arr2D = np.empty((nwindows, plan.nfreqs), dtype=np.float32)
+    for start in xrange(0, nwindows, STFT_BLOCK_WINDOWS):
+        block = windows[start:start + STFT_BLOCK_WINDOWS] * plan.window
+        power = arr2D[start:start + len(block)]
+        _power_spectrum(block, power)
+
+    # scale to a power spectral density, then to dB
+    arr2D *= plan.scale / np.float32(Fs)
+    with np.errstate(divide='ignore'):
+        np.log10(arr2D, out=arr2D)
+    arr2D *= 10
+    arr2D[np.isneginf(arr2D)] = 0  # replace infs with zeros
+    return arr2D.T
+
+
+def _power_spectrum(block, power):
     """
-    Uses `image processing <http://docs.scipy.org/doc/scipy/reference/generated/scipy.ndimage.morphology.iterate_structure.html#scipy.ndimage.morphology.iterate_structure>`_
-    toolkit from scipy to get 2D peaks from the spectogram(``arr2D``) of the sound.
+    Writes the squared magnitudes of the real FFT of each row of the
+    float32 `block` into `power`, unpacking fftpack's
+    [y0, Re(y1), Im(y1), ...] layout.
     """
-    #
-    struct = generate_binary_structure(2, 1)
-    neighborhood = iterate_structure(struct, PEAK_NEIGHBORHOOD_SIZE)
+    coeffs = fftpack.rfft(block, axis=1, overwrite_x=True)
+    np.square(coeffs, out=coeffs)
+    power[:, 0] = coeffs[:, 0]
+    if block.shape[1] % 2:
+        np.add(coeffs[:, 1::2], coeffs[:, 2::2], out=power[:, 1:])
+    else:
+        np.add(coeffs[:, 1:-1:2], coeffs[:, 2:-1:2], out=power[:, 1:-1])
+        power[:, -1] = coeffs[:, -1]
 
-    # find local maxima using our fliter shape
-    local_max = maximum_filter(arr2D, footprint=neighborhood) == arr2D
-    background = (arr2D == 0)
-    eroded_background = binary_erosion(background, structure=neighborhood,
-                                       border_value=1)
 
-    # Boolean mask of arr2D with True at peaks
-    detected_peaks = local_max - eroded_background
+class _STFTPlan(object):
+    """
+    The Hanning window and one sided PSD scaling (as used by
+    mlab.specgram, less the division by Fs) for one window size and
+    overlap.
+    """
+    def __init__(self, wsize, noverlap):
+        super(_STFTPlan, self).__init__()
+
+        self.step = wsize - noverlap
+        self.nfreqs = wsize // 2 + 1
+
+        window = np.hanning(wsize)
+        self.window = window.astype(np.float32)
+
+        # every bin but DC (and Nyquist for even sizes) is doubled
+        self.scale = np.empty(self.nfreqs, dtype=np.float32)
+        self.scale[:] = 2.0 / (window ** 2).sum()
+        self.scale[0] /= 2
+        if wsize % 2 == 0:
+            self.scale[-1] /= 2
+
+
+_stft_plans = {}
+
+
+def _stft_plan(wsize, noverlap):
+    key = (wsize, noverlap)
+    if key not in _stft_plans:
+        _stft_plans[key] = _STFTPlan(wsize, noverlap)
+    return _stft_plans[key]
+
+
+class FingerprintStream(object):
+    """
+    Fingerprints a single channel incrementally.
+
+    Samples are fed in blocks of any size and hashes are handed out as
+    soon as they can no longer change, so only a few windows of samples,
+    a slice of the spectrogram and a handful of peaks per frequency bin
+    are ever held in memory, however long the channel is.
+
+    Blocks are cut on the same window grid as `fingerprint` and peaks are
+    looked for with ``config.peak_neighborhood_size`` windows of context on each
+    side, so the hashes produced over the whole stream are exactly the
+    ones `fingerprint` gives for the complete channel (they can come out
+    in a different order). With ``config.idx_freq_i`` and
+    ``config.idx_time_j`` other than the (frequency, time) layout of
+    `get_2D_peaks`, peaks are only paired once the stream is closed.
+
+    ```python
+    stream = FingerprintStream(config, Fs=fs)
+    for block in blocks:
+        hashes.extend(stream.feed(block))
+    hashes.extend(stream.close())
+    ```
+    """
+
+    # Minimum number of new spectrogram windows before looking for peaks,
+    # so the context windows are not recomputed for tiny blocks.
+    MIN_PEAK_WINDOWS = 256
+
+    def __init__(self, config, Fs=None):
+        super(FingerprintStream, self).__init__()
+
+        self.config = config
+        self.Fs = config.fs if Fs is None else Fs
+        self.wsize = wsize = config.window_size
+        self.fan_value = fan_value = config.fan_value
+
+        self.step = wsize - int(wsize * config.overlap_ratio)
+        self.closed = False
+
+        # samples from the start of the next window on
+        self._samples = np.zeros(0, dtype=np.int16)
+        self._nwindows = 0
+
+        # spectrogram windows kept for peak finding, starting at window
+        # `_window_start`; peaks before `_peaks_done` were handed out
+        self._arr2D = None
+        self._window_start = 0
+        self._peaks_done = 0
+
+        # per group (frequency bin, or everything when peak_sort is set)
+        # the last ``fan_value - 1`` peaks still waiting for neighbours
+        self._tail = np.zeros((0, 2), dtype=np.int64)
+
+        # first ``fan_value - 1`` peak times and number of peaks in each
+        # frequency bin, to pair peaks across bins once the stream ends
+        nfreqs = wsize // 2 + 1
+        self._heads = np.zeros((nfreqs, max(fan_value - 1, 0)), dtype=np.int64)
+        self._counts = np.zeros(nfreqs, dtype=np.int64)
+
+        # peaks are held until the stream ends, and paired like
+        # `fingerprint` does, unless the config pairs them in the
+        # (frequency, time) layout `get_2D_peaks` gives them in
+        self._held = None
+        if (config.idx_freq_i, config.idx_time_j) != (0, 1):
+            self._held = []
+
+    def feed(self, samples):
+        """
+        Adds a block of samples and returns the hashes it completed, as a
+        list of (hash, offset) tuples like `fingerprint`.
+        """
+        hashes, offsets = self.feed_arrays(samples)
+        return zip(hashes.tolist(), offsets.tolist())
+
+    def close(self):
+        """
+        Flushes the end of the stream and returns the remaining hashes.
+        """
+        hashes, offsets = self.close_arrays()
+        return zip(hashes.tolist(), offsets.tolist())
+
+    def feed_arrays(self, samples):
+        """
+        Like `feed`, but returns the hashes as (hashes, offsets) NumPy
+        arrays like `generate_hash_arrays`.
+        """
+        if self.closed:
+            raise ValueError("Can not feed a closed FingerprintStream")
+
+        samples = np.concatenate((self._samples, samples))
+        nwindows = 0
+        if len(samples) >= self.wsize:
+            nwindows = 1 + (len(samples) - self.wsize) // self.step
+        if not nwindows:
+            self._samples = samples
+            return self._no_hashes()
 
-    # extract peaks
-    amps = arr2D[detected_peaks]
-    j, i = np.where(detected_peaks)
+        used = (nwindows - 1) * self.step + self.wsize
+        self._add_windows(samples[:used])
+        self._samples = samples[nwindows * self.step:]
 
-    # filter peaks
-    amps = amps.flatten()
-    peaks = zip(i, j, amps)
-    peaks_filtered = [x for x in peaks if x[2] > amp_min]  # freq, time, amp
+        ready = (self._window_start + self._arr2D.shape[1] -
+                 self.config.peak_neighborhood_size - self._peaks_done)
+        if ready < self.MIN_PEAK_WINDOWS:
+            return self._no_hashes()
+        return self._hashes(final=False)
 
-    # get indices for frequency and time
-    frequency_idx = [x[1] for x in peaks_filtered]
-    time_idx = [x[0] for x in peaks_filtered]
+    def close_arrays(self):
+        """
+        Like `close`, but returns the hashes as (hashes, offsets) arrays.
+        """
+        if self.closed:
+            return self._no_hashes()
+        self.closed = True
+
+        if not self._nwindows and len(self._samples):
+            # too short for a single window, `spectrogram` zero pads it
+            self._add_windows(self._samples)
+        self._samples = None
+
+        if self._arr2D is None:
+            return self._no_hashes()
+        return self._hashes(final=True)
+
+    def _no_hashes(self):
+        return empty_hash_arrays(self.config)
+
+    def _add_windows(self, samples):
+        arr2D = spectrogram(samples, self.config, Fs=self.Fs)
+        if self._arr2D is None:
+            self._arr2D = arr2D
+        else:
+            self._arr2D = np.hstack((self._arr2D, arr2D))
+        self._nwindows += arr2D.shape[1]
+
+    def _hashes(self, final):
+        context = self.config.peak_neighborhood_size
+        window_end = self._window_start + self._arr2D.shape[1]
+        done = window_end if final else window_end - context
+
+        # (frequency, time) peaks, whatever layout the config pairs them in
+        peaks = np.asarray(get_2D_peaks(self._arr2D, self.config),
+                           dtype=np.int64).reshape(-1, 2)
+        peaks[:, 1] += self._window_start
+        peaks = peaks[(peaks[:, 1] >= self._peaks_done) & (peaks[:, 1] < done)]
+
+        # keep enough windows around to give the next ones full context
+        self._peaks_done = done
+        keep_from = max(done - context, self._window_start)
+        self._arr2D = self._arr2D[:, keep_from - self._window_start:]
+        self._window_start = keep_from
+
+        if self._held is not None:
+            self._held.append(peaks)
+            if not final:
+                return self._no_hashes()
+            # in the order `get_2D_peaks` gives them for the whole channel
+            peaks = np.vstack(self._held)
+            peaks = peaks[np.lexsort((peaks[:, 1], peaks[:, 0]))]
+            freq1, freq2, t_delta, t1 = _pair_peaks(peaks, self.config)
+            return _encode_pairs(freq1, freq2, t_delta, self.config), t1
+
+        freq1, freq2, t_delta, t1 = self._pair(peaks)
+        if final and not self.config.peak_sort:
+            pairs = self._pair_across_bins()
+            freq1, freq2, t_delta, t1 = [np.concatenate((a, b)) for a, b
+                                         in zip((freq1, freq2, t_delta, t1),
+                                                pairs)]
+
+        return _encode_pairs(freq1, freq2, t_delta, self.config), t1
+
+    def _pair(self, peaks):
+        """
+        Pairs new peaks with each other and with the peaks left waiting
+        from earlier blocks.
+        """
+        freq_idx, time_idx = self.config.idx_freq_i, self.config.idx_time_j
+        nwaiting = len(self._tail)
+        peaks = np.vstack((self._tail, peaks))
+        fresh = np.arange(len(peaks)) >= nwaiting
+
+        # Order peaks the way `generate_hashes` sees them: by time when
+        # peak_sort is set, otherwise by frequency bin then time. Waiting
+        # peaks are always older, so they stay in front of their group.
+        peak_sort = self.config.peak_sort
+        if peak_sort:
+            order = np.lexsort((peaks[:, freq_idx], peaks[:, time_idx]))
+            groups = np.zeros(len(peaks), dtype=np.int64)
+        else:
+            order = np.lexsort((peaks[:, time_idx], peaks[:, freq_idx]))
+        peaks = peaks[order]
+        fresh = fresh[order]
+        if not peak_sort:
+            groups = peaks[:, freq_idx]
+            self._remember_heads(peaks[fresh])
+
+        pairs = _pair_sorted_peaks(peaks[:, freq_idx], peaks[:, time_idx],
+                                   self.config, groups=groups, fresh=fresh)
+
+        # peaks with fewer than fan_value - 1 successors in their group
+        # wait for the next block
+        if len(peaks):
+            last = np.flatnonzero(np.r_[groups[1:] != groups[:-1], True])
+            position = np.arange(len(peaks))
+            group_end = last[np.searchsorted(last, position)]
+            self._tail = peaks[group_end - position < self.fan_value - 1]
+        return pairs
+
+    def _remember_heads(self, peaks):
+        if not len(peaks) or not self._heads.shape[1]:
+            return
+        freqs = peaks[:, self.config.idx_freq_i]
+        starts = np.flatnonzero(np.r_[True, freqs[1:] != freqs[:-1]])
+        rank = np.arange(len(peaks)) - np.repeat(starts, np.diff(np.r_[starts, len(peaks)]))
+        rank += self._counts[freqs]
+        head = rank < self._heads.shape[1]
+        self._heads[freqs[head], rank[head]] = peaks[head, self.config.idx_time_j]
+        self._counts += np.bincount(freqs, minlength=len(self._counts))
+
+    def _pair_across_bins(self):
+        """
+        Without peak_sort the last peaks of a frequency bin are paired with
+        the first peaks of the following bins; those are only known once
+        the whole stream has been seen.
+        """
+        freq1, freq2, t_delta, t1 = [], [], [], []
+        nheads = self._heads.shape[1]
+
+        tails = {}
+        for peak in self._tail.tolist():
+            tails.setdefault(peak[self.config.idx_freq_i], []).append(
+                peak[self.config.idx_time_j])
+
+        # peaks that follow the end of each bin, nearest first
+        following = []
+        for freq in xrange(len(self._counts) - 1, -1, -1):
+            if freq in tails:
+                times = tails[freq]
+                for distance, time in enumerate(reversed(times), 1):
+                    for freq_b, time_b in following[:nheads + 1 - distance]:
+                        freq1.append(freq)
+                        freq2.append(freq_b)
+                        t_delta.append(time_b - time)
+                        t1.append(time)
+            if self._counts[freq]:
+                count = min(self._counts[freq], nheads)
+                head = [(freq, time) for time in self._heads[freq, :count].tolist()]
+                following = (head + following)[:nheads]
+
+        freq1, freq2, t_delta, t1 = [np.array(a, dtype=np.int64)
+                                     for a in (freq1, freq2, t_delta, t1)]
+        in_window = ((t_delta >= self.config.min_hash_time_delta) &
+                     (t_delta <= self.config.max_hash_time_delta))
+        return (freq1[in_window], freq2[in_window], t_delta[in_window],
+                t1[in_window])
+
+
+def get_2D_peaks(arr2D, config, plot=False):
+    """
+    Finds the spectral peaks of the spectrogram (``arr2D``) of the sound:
+    cells above ``config.amp_min`` that are the maximum of the diamond
+    shaped neighborhood of ``config.peak_neighborhood_size`` cells around
+    them, leaving out flat silent (zero) areas.
+
+    Gives the same peaks as scipy's `maximum_filter` with an
+    ``iterate_structure(generate_binary_structure(2, 1), size)``
+    footprint, see `_diamond_maximum_filter`.
+
+    returns: (npeaks, 2) array of (frequency, time) indices, ordered by
+    frequency then time
+    """
+    # Boolean mask of arr2D with True at peaks
+    size = config.peak_neighborhood_size
+    detected_peaks = arr2D > config.amp_min
+    detected_peaks &= _diamond_maximum_filter(arr2D, size) == arr2D
+
+    frequency_idx, time_idx = np.nonzero(detected_peaks)
+
+    # Only zero cells can be part of an eroded (silent) background, so the
+    # erosion is skipped unless some peak candidates are zero, which needs
+    # a negative amp_min.
+    silent = arr2D[frequency_idx, time_idx] == 0
+    if silent.any():
+        from scipy.ndimage.morphology import (generate_binary_structure,
+                                              binary_erosion)
+        eroded_background = binary_erosion(
+            arr2D == 0, structure=generate_binary_structure(2, 1),
+            iterations=size, border_value=1)
+        keep = ~eroded_background[frequency_idx, time_idx]
+        frequency_idx = frequency_idx[keep]
+        time_idx = time_idx[keep]
 
     if plot:
         # scatter of the peaks
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots()
         ax.imshow(arr2D)
         ax.scatter(time_idx, frequency_idx)
@@ -136,29 +668,198 @@ def get_2D_peaks(arr2D, plot=False, amp_min=DEFAULT_AMP_MIN):
         plt.gca().invert_yaxis()
         plt.show()
 
-    return zip(frequency_idx, time_idx)
+    return np.column_stack((frequency_idx, time_idx))
 
 
-def generate_hashes(peaks, fan_value=DEFAULT_FAN_VALUE):
+def _diamond_maximum_filter(arr2D, size):
+    """
+    Maximum filter over a diamond of radius `size`.
+
+    The diamond is `size` dilations of a 3x3 cross, so rather than a full
+    2D pass over the ~2 * `size` ** 2 cells of the footprint this takes
+    `size` passes that each compare every cell with its four direct
+    neighbours. The cross and the diamond are both symmetric, so this is
+    identical to scipy's `maximum_filter` with its default 'reflect'
+    borders; at a border the reflected neighbour is the cell itself and
+    can simply be left out.
+    """
+    buffers = (np.empty_like(arr2D), np.empty_like(arr2D))
+    result = arr2D
+    for n in xrange(size):
+        src, result = result, buffers[n % 2]
+        result[...] = src
+        np.maximum(result[:, 1:], src[:, :-1], out=result[:, 1:])
+        np.maximum(result[:, :-1], src[:, 1:], out=result[:, :-1])
+        np.maximum(result[1:], src[:-1], out=result[1:])
+        np.maximum(result[:-1], src[1:], out=result[:-1])
+    return result
+
+
+def generate_hashes(peaks, config):
     """
     Hash list structure:
        sha1_hash[0:20]    time_offset
     [(e05b341a9b77a51fd26, 32), ... ]
+
+    or, with the int64 fingerprint format:
+       packed_hash        time_offset
+    [(17592219598856, 32), ... ]
+    """
+    hashes, offsets = generate_hash_arrays(peaks, config)
+    return zip(hashes.tolist(), offsets.tolist())
+
+
+def empty_hash_arrays(config):
+    """
+    Returns empty (hashes, offsets) arrays of the dtypes
+    `generate_hash_arrays` uses for the config's fingerprint format.
     """
-    if PEAK_SORT:
-        peaks.sort(key=itemgetter(1))
+    empty = np.zeros(0, dtype=np.int64)
+    return _encode_pairs(empty, empty, empty, config), empty
 
-    for i in range(len(peaks)):
-        for j in range(1, fan_value):
-            if (i + j) < len(peaks):
 
-                freq1 = peaks[i][IDX_FREQ_I]
-                freq2 = peaks[i + j][IDX_FREQ_I]
-                t1 = peaks[i][IDX_TIME_J]
-                t2 = peaks[i + j][IDX_TIME_J]
-                t_delta = t2 - t1
+def unique_hashes(hashes, offsets):
+    """
+    Drops repeated (hash, offset) pairs from the arrays, as putting the
+    tuples of `generate_hashes` in a set would, and returns the remaining
+    ones ordered by hash, then offset. Several (hashes, offsets) pairs,
+    e.g. of each channel, can be given as lists of arrays.
+    """
+    if isinstance(hashes, list):
+        hashes = np.concatenate(hashes)
+        offsets = np.concatenate(offsets)
+    if not len(hashes):
+        return hashes, offsets
+
+    order = np.lexsort((offsets, hashes))
+    hashes = hashes[order]
+    offsets = offsets[order]
+    keep = np.empty(len(hashes), dtype=bool)
+    keep[0] = True
+    keep[1:] = (hashes[1:] != hashes[:-1]) | (offsets[1:] != offsets[:-1])
+    return hashes[keep], offsets[keep]
+
+
+def generate_hash_arrays(peaks, config):
+    """
+    Batched engine behind `generate_hashes`.
+
+    Builds every (peak, neighbour) pair at once, masks out the pairs that
+    fall outside the config's [min_hash_time_delta, max_hash_time_delta]
+    and hashes each distinct (freq1, freq2, t_delta) triple only once. The
+    output is identical, hash for hash and in the same order, to the
+    original double loop over `fan_value`.
+
+    returns: (hashes, offsets) as NumPy arrays
+    """
+    freq1, freq2, t_delta, t1 = _pair_peaks(peaks, config)
+    return _encode_pairs(freq1, freq2, t_delta, config), t1
+
+
+def _pair_peaks(peaks, config):
+    """
+    Returns (freq1, freq2, t_delta, t1) arrays for every pair of a peak
+    with one of its next ``fan_value - 1`` neighbours that passes the time
+    delta window, ordered by anchor peak then neighbour.
+    """
+    peaks = np.asarray(peaks, dtype=np.int64).reshape(-1, 2)
+    if config.peak_sort:
+        # mergesort is stable, like list.sort in the original generator
+        order = np.argsort(peaks[:, config.idx_time_j], kind='mergesort')
+        peaks = peaks[order]
+
+    return _pair_sorted_peaks(peaks[:, config.idx_freq_i],
+                              peaks[:, config.idx_time_j], config)
+
+
+def _pair_sorted_peaks(freqs, times, config, groups=None, fresh=None):
+    """
+    Pairs already ordered peaks with their next ``fan_value - 1``
+    neighbours. With `groups`, peaks are only paired within their group;
+    with `fresh`, only pairs whose neighbour is fresh are returned.
+    """
+    # (npeaks, fan_value - 1) grid of indices, raveled row by row so that
+    # pairs come out anchor-major like the nested loops did
+    steps = np.arange(1, max(config.fan_value, 1))
+    anchor = np.repeat(np.arange(len(freqs)), len(steps))
+    neighbour = anchor + np.tile(steps, len(freqs))
+
+    keep = neighbour < len(freqs)
+    anchor = anchor[keep]
+    neighbour = neighbour[keep]
 
-                if t_delta >= MIN_HASH_TIME_DELTA and t_delta <= MAX_HASH_TIME_DELTA:
-                    h = hashlib.sha1(
-                        "%s|%s|%s" % (str(freq1), str(freq2), str(t_delta)))
-                    yield (h.hexdigest()[0:FINGERPRINT_REDUCTION], t1)
+    if groups is not None or fresh is not None:
+        keep = np.ones(len(anchor), dtype=bool)
+        if groups is not None:
+            keep &= groups[neighbour] == groups[anchor]
+        if fresh is not None:
+            keep &= fresh[neighbour]
+        anchor = anchor[keep]
+        neighbour = neighbour[keep]
+
+    t_delta = times[neighbour] - times[anchor]
+    in_window = ((t_delta >= config.min_hash_time_delta) &
+                 (t_delta <= config.max_hash_time_delta))
+    anchor = anchor[in_window]
+    neighbour = neighbour[in_window]
+
+    return freqs[anchor], freqs[neighbour], t_delta[in_window], times[anchor]
+
+
+def _encode_pairs(freq1, freq2, t_delta, config):
+    if config.fingerprint_format == FORMAT_INT64:
+        return _pack_pairs(freq1, freq2, t_delta)
+    elif config.fingerprint_format == FORMAT_SHA1:
+        return _hash_pairs(freq1, freq2, t_delta, config.fingerprint_reduction)
+    raise ValueError("Unsupported fingerprint format: %s"
+                     % config.fingerprint_format)
+
+
+def _hash_pairs(freq1, freq2, t_delta, reduction):
+    """
+    SHA1 hashes (truncated to `reduction` characters) of the given pairs.
+    """
+    if not len(freq1):
+        return np.array([], dtype='S%d' % reduction)
+
+    # Pack each triple into a single integer key so repeated triples,
+    # which are common, are only run through sha1 once.
+    nfreq = int(max(freq1.max(), freq2.max())) + 1
+    delta_min = int(t_delta.min())
+    ndelta = int(t_delta.max()) - delta_min + 1
+    keys = (freq1 * nfreq + freq2) * ndelta + (t_delta - delta_min)
+    _, first, inverse = np.unique(keys, return_index=True,
+                                  return_inverse=True)
+
+    digests = [hashlib.sha1("%s|%s|%s" % triple).hexdigest()[0:reduction]
+               for triple in zip(freq1[first].tolist(),
+                                 freq2[first].tolist(),
+                                 t_delta[first].tolist())]
+    return np.array(digests)[inverse]
+
+
+def _pack_pairs(freq1, freq2, t_delta):
+    """
+    Packs the given pairs into unsigned 64-bit integer fingerprints.
+    """
+    if len(freq1) and max(freq1.max(), freq2.max()) >> INT64_FREQ_BITS:
+        raise ValueError("Frequency bin does not fit in %d bits"
+                         % INT64_FREQ_BITS)
+
+    delta_mask = (1 << INT64_DELTA_BITS) - 1
+    packed = freq1.astype(np.uint64) << np.uint64(INT64_FREQ_BITS + INT64_DELTA_BITS)
+    packed |= freq2.astype(np.uint64) << np.uint64(INT64_DELTA_BITS)
+    packed |= (t_delta & delta_mask).astype(np.uint64)
+    return packed
+
+
+def unpack_hash(packed):
+    """
+    Returns the (freq1, freq2, t_delta) triple of an int64 fingerprint.
+    """
+    packed = int(packed)
+    freq_mask = (1 << INT64_FREQ_BITS) - 1
+    delta_mask = (1 << INT64_DELTA_BITS) - 1
+    return (packed >> (INT64_FREQ_BITS + INT64_DELTA_BITS),
+            (packed >> INT64_DELTA_BITS) & freq_mask,
+            packed & delta_mask)
@@ -0,0 +1,65 @@
+"""
+Logging setup shared by the dejavu modules.
+
+Records go to MongoDB through log4mongo when a mongolog.cnf file is
+present, and to a local log file otherwise. The real handler is only
+built when the first record is emitted, so importing dejavu neither
+imports log4mongo nor opens a file or a connection.
+"""
+import json
+import logging
+import os
+
+__MONGOLOG_FILE__ = "mongolog.cnf"
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class LazyHandler(logging.Handler):
+    """
+    Handler that builds the MongoDB or file handler on first use and
+    passes every record on to it.
+    """
+    def __init__(self, filename, level=logging.DEBUG):
+        logging.Handler.__init__(self, level)
+        self.filename = filename
+        self.handler = None
+
+    def emit(self, record):
+        # called with the handler lock held, so the handler is built once
+        if self.handler is None:
+            self.handler = self._build()
+        self.handler.handle(record)
+
+    def _build(self):
+        if os.path.isfile(__MONGOLOG_FILE__):
+            with open(__MONGOLOG_FILE__) as f:
+                config = json.load(f)
+            from log4mongo.handlers import MongoHandler
+            return MongoHandler(level=logging.DEBUG, host=config['host'],
+                                capped=config['capped'], port=config['port'],
+                                database_name=config['db'],
+                                collection=config['collection'],
+                                username=config['user'],
+                                password=config['passwd'])
+
+        handler = logging.FileHandler(self.filename)
+        handler.setLevel(logging.DEBUG)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        return handler
+
+    def close(self):
+        if self.handler is not None:
+            self.handler.close()
+        logging.Handler.close(self)
+
+
+def get_logger(name, filename):
+    """
+    Returns the logger `name`, logging to MongoDB or to `filename`.
+    """
+    logger = logging.getLogger(name)
+    if not any(isinstance(h, LazyHandler) for h in logger.handlers):
+        logger.addHandler(LazyHandler(filename))
+    logger.setLevel(logging.DEBUG)
+    return logger
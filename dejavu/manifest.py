@@ -0,0 +1,165 @@
+"""
+Manifest of an ingestion run, so a run that crashed or was killed can be
+picked up where it stopped.
+
+The manifest records the state of every file of the run:
+
+    pending -> in_progress -> done
+                           -> failed (with the error)
+
+Each change is appended to the manifest file as a line of JSON and
+flushed right away, so the file is consistent up to the last change
+whatever happens to the process. A later run given the same manifest
+skips the files done, retries the failed and interrupted ones until they
+were tried `max_attempts` times, and the file is compacted to one line
+per file when the run ends. A file still in progress after its last
+attempt, one that killed its worker or the run, is recorded as failed,
+"interrupted".
+"""
+import json
+import os
+import threading
+
+from dejavu.logs import get_logger
+
+logger = get_logger('Classification_Dejavu_Manifest', "dejavu.log")
+
+PENDING = "pending"
+IN_PROGRESS = "in_progress"
+DONE = "done"
+FAILED = "failed"
+STATES = (PENDING, IN_PROGRESS, DONE, FAILED)
+
+DEFAULT_MAX_ATTEMPTS = 3
+# error of files still in progress after their last attempt
+INTERRUPTED = "interrupted"
+
+
+class IngestManifest(object):
+    """
+    States of the files of an ingestion run, kept in the file `path` and
+    read back from it if it exists.
+
+    ```python
+    manifest = IngestManifest("retrain.manifest")
+    tasks = manifest.start(tasks)
+    ...
+    manifest.done(filename)
+    manifest.failed(filename, error)
+    print manifest.summary()
+    ```
+    """
+
+    def __init__(self, path, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        super(IngestManifest, self).__init__()
+        self.path = path
+        self.max_attempts = max_attempts
+        # filename -> {"state", "attempts", "error"}
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    filename = record.pop("file")
+                except (ValueError, KeyError):
+                    # the line being written when the run was stopped
+                    continue
+                self.entries[filename] = record
+
+    def _write(self, filename, entry):
+        # with the lock held
+        if self._file is None:
+            self._file = open(self.path, "a")
+        record = dict(entry, file=filename)
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def _set(self, filename, state, error=None, attempt=False):
+        with self._lock:
+            entry = self.entries.setdefault(
+                filename, {"state": PENDING, "attempts": 0, "error": None})
+            entry["state"] = state
+            entry["error"] = error
+            if attempt:
+                entry["attempts"] += 1
+            self._write(filename, entry)
+
+    def start(self, tasks):
+        """
+        Returns the (key, filename) `tasks` that still have to be run,
+        recording them as pending: files not done, that were not tried
+        `max_attempts` times already. Files left in progress by an
+        interrupted run are run again until then.
+        """
+        remaining = []
+        skipped = 0
+        for key, filename in tasks:
+            entry = self.entries.get(filename)
+            if entry is not None and entry["state"] == DONE:
+                skipped += 1
+                continue
+            if entry is not None and entry["attempts"] >= self.max_attempts:
+                if entry["state"] != FAILED:
+                    self._set(filename, FAILED, entry["error"] or INTERRUPTED)
+                skipped += 1
+                continue
+            if entry is None or entry["state"] != PENDING:
+                self._set(filename, PENDING,
+                          entry and entry["error"])
+            remaining.append((key, filename))
+
+        if skipped:
+            logger.info("Manifest %s: skipping %d files done or tried "
+                        "%d times" % (self.path, skipped, self.max_attempts))
+        return remaining
+
+    def in_progress(self, filename):
+        """
+        Records that `filename` is being fingerprinted, which counts as an
+        attempt.
+        """
+        self._set(filename, IN_PROGRESS, attempt=True)
+
+    def done(self, filename):
+        entry = self.entries.get(filename)
+        if entry is None or entry["state"] != DONE:
+            self._set(filename, DONE)
+
+    def failed(self, filename, error):
+        self._set(filename, FAILED, str(error))
+
+    def summary(self):
+        """
+        Returns the number of files in each state, and the error of each
+        failed file as "failures".
+        """
+        with self._lock:
+            summary = dict((state, 0) for state in STATES)
+            summary["failures"] = {}
+            for filename, entry in self.entries.items():
+                summary[entry["state"]] += 1
+                if entry["state"] == FAILED:
+                    summary["failures"][filename] = entry["error"]
+            return summary
+
+    def close(self):
+        """
+        Rewrites the manifest with one line per file, in one step.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+            tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+            with open(tmp_path, "w") as f:
+                for filename, entry in sorted(self.entries.items()):
+                    f.write(json.dumps(dict(entry, file=filename)) + "\n")
+            os.rename(tmp_path, self.path)
@@ -0,0 +1,516 @@
+"""
+Staged fingerprinting: audio files are decoded, fingerprinted and handed
+back by pools of workers running at the same time.
+
+    tasks -> decoder processes -> fingerprint processes -> writer threads
+
+Decoders stream the blocks of each file to one fingerprint process, chosen
+by the file's index so that all blocks of a file meet the same
+`FingerprintStream`. Fingerprint processes hand the hashes of finished
+files to writer threads of the calling process, which store (or match)
+them in batches. Hashes do not go through the queue: they are written as
+typed arrays to a memory mapped file, in shared memory where there is
+some, and only its path is sent.
+
+Every queue between stages is bounded, so a slow stage holds up the ones
+feeding it instead of piling up decoded audio, and the database is
+written to while the next files are still being decoded.
+
+With a `cache.FingerprintCache`, decoders look each file up in it first
+and hand over the cached hashes of files fingerprinted before; the hashes
+of the others are added to it once fingerprinted.
+
+The processes of a `WorkerPool` outlive a run: they are started and
+warmed up on first use, and serve one run after another until the pool
+is closed.
+"""
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import Queue
+
+import numpy as np
+
+import dejavu.decoder as decoder
+import dejavu.fingerprint as fingerprint
+from dejavu.logs import get_logger
+
+logger = get_logger('Classification_Dejavu_Pipeline', "dejavu.log")
+
+# Blocks (or results) each queue between stages holds before the stage
+# feeding it has to wait
+DEFAULT_QUEUE_SIZE = 8
+
+# Seconds to wait on a result before checking the workers are still alive
+POLL_INTERVAL = 1
+
+# message kinds passed between stages, as (run, index, kind, payload)
+STARTED = "started"
+BLOCK = "block"
+DONE = "done"
+ERROR = "error"
+
+STAGES = ("decode", "fingerprint", "write")
+
+# Where the hashes of fingerprinted files are handed over: /dev/shm lives
+# in memory, elsewhere the system's temporary directory is used
+HASHES_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+class WorkerDied(Exception):
+    """
+    Raised when a worker process of a `WorkerPool` exits during a run.
+    """
+    pass
+
+
+class WorkerPool(object):
+    """
+    `decoders` decoder processes and `fingerprinters` fingerprint
+    processes fingerprinting files with the FingerprintConfig `config`,
+    one run after another, see `run`.
+
+    `before_fork` is called before the processes are started and
+    `after_fork` in each of them, like `Database.before_fork` and
+    `Database.after_fork`.
+
+    Hashes stored (see `run`) are looked up in and added to the
+    `cache.FingerprintCache` `cache`, if given.
+    """
+
+    def __init__(self, config, limit=None, decoder_options=None,
+                 decoders=1, fingerprinters=1,
+                 queue_size=DEFAULT_QUEUE_SIZE,
+                 before_fork=None, after_fork=None, cache=None):
+        self.config = config
+        self.limit = limit
+        self.decoder_options = decoder_options or {}
+        self.decoders = max(1, decoders)
+        self.fingerprinters = max(1, fingerprinters)
+        self.queue_size = queue_size
+        self.before_fork = before_fork
+        self.after_fork = after_fork
+        self.cache = cache
+
+        self._decoders = []
+        self._fingerprinters = []
+        self._run = 0
+        # runs (and starting, resizing and closing) take turns
+        self._lock = threading.RLock()
+
+    @property
+    def started(self):
+        return bool(self._decoders)
+
+    def start(self):
+        """
+        Starts the worker processes unless they are running already. They
+        load and warm up what they need right away, so the first run does
+        not wait on it.
+        """
+        with self._lock:
+            if self.started:
+                return
+            if self.before_fork:
+                self.before_fork()
+
+            self._task_queue = multiprocessing.Queue()
+            self._block_queues = [multiprocessing.Queue(self.queue_size)
+                                  for _ in xrange(self.fingerprinters)]
+            self._result_queue = multiprocessing.Queue(self.queue_size)
+
+            self._decoders = [
+                self._spawn(_decode, self._task_queue, self._block_queues,
+                            self._result_queue, self.config, self.limit,
+                            self.decoder_options, self.cache)
+                for _ in xrange(self.decoders)]
+            self._fingerprinters = [
+                self._spawn(_fingerprint, block_queue, self._result_queue,
+                            self.config, self.cache)
+                for block_queue in self._block_queues]
+            logger.info("Started %d decoder and %d fingerprint processes"
+                        % (self.decoders, self.fingerprinters))
+
+    def _spawn(self, target, *args):
+        process = multiprocessing.Process(
+            target=_worker, args=(self.after_fork, target) + args)
+        process.daemon = True
+        process.start()
+        return process
+
+    def resize(self, decoders=None, fingerprinters=None):
+        """
+        Changes the number of decoder and fingerprint processes. Running
+        workers are restarted between runs if the numbers differ.
+        """
+        with self._lock:
+            decoders = max(1, decoders or self.decoders)
+            fingerprinters = max(1, fingerprinters or self.fingerprinters)
+            if (decoders, fingerprinters) == (self.decoders, self.fingerprinters):
+                return
+
+            started = self.started
+            self.close()
+            self.decoders = decoders
+            self.fingerprinters = fingerprinters
+            if started:
+                self.start()
+
+    def close(self, timeout=5):
+        """
+        Stops the worker processes, waiting up to `timeout` seconds for
+        each stage to finish before terminating it.
+        """
+        with self._lock:
+            if not self.started:
+                return
+            for _ in self._decoders:
+                self._task_queue.put(None)
+            for process in self._decoders:
+                process.join(timeout)
+            for block_queue in self._block_queues:
+                block_queue.put(None)
+            for process in self._fingerprinters:
+                process.join(timeout)
+            self._terminate()
+            logger.info("Stopped worker processes")
+
+    def _terminate(self):
+        for process in self._decoders + self._fingerprinters:
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self._decoders = []
+        self._fingerprinters = []
+
+    def run(self, tasks, consume, writers=1, batch_size=0, unique=True,
+            started=None, failed=None):
+        """
+        Fingerprints `tasks`, (key, filename) pairs, starting the workers
+        if needed. `consume` is called from `writers` threads with lists of
+        (key, hashes) pairs holding at least `batch_size` hashes, or
+        whatever is left at the end, and has to be thread safe if there
+        are several writers. With `unique` the hashes of a file hold each
+        (hash, offset) pair once, as they are stored; otherwise those of
+        every channel are kept, as they are matched.
+
+        `started` is called with the key of each file as a decoder takes
+        it up, and `failed` with its key and the error when fingerprinting
+        or consuming it fails.
+
+        Returns the throughput of each stage: for "decode", "fingerprint"
+        and "write", the number of workers, files they went through,
+        seconds they spent working (not waiting on the other stages) and
+        files per second of wall time, plus audio seconds decoded and
+        hashes fingerprinted and written. Files whose hashes were found
+        in the cache are counted as "cached" by the decode stage.
+        """
+        with self._lock:
+            self.start()
+            self._run += 1
+            run = self._run
+            tasks = list(tasks)
+            writers = max(1, writers)
+            start = time.time()
+
+            stats = {"files": len(tasks)}
+            for stage in STAGES:
+                stats[stage] = {"workers": 0, "files": 0, "busy_secs": 0.0}
+            stats["decode"]["workers"] = len(self._decoders)
+            stats["decode"]["audio_secs"] = 0.0
+            stats["decode"]["cached"] = 0
+            stats["fingerprint"]["workers"] = len(self._fingerprinters)
+            stats["fingerprint"]["hashes"] = 0
+            stats["write"].update(workers=writers, hashes=0, failed=0)
+
+            for index, (_, filename) in enumerate(tasks):
+                self._task_queue.put((run, index, filename, unique))
+
+            write_queue = Queue.Queue(self.queue_size)
+            threads = [threading.Thread(
+                target=self._write, args=(tasks, write_queue, consume,
+                                          batch_size, failed, stats["write"]))
+                for _ in xrange(writers)]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+
+            try:
+                self._collect(run, tasks, write_queue, stats, started, failed)
+            finally:
+                for _ in threads:
+                    write_queue.put(None)
+                for thread in threads:
+                    thread.join()
+
+            wall = time.time() - start
+            stats["wall_secs"] = wall
+            for stage in STAGES:
+                stats[stage]["files_per_sec"] = stats[stage]["files"] / wall if wall else 0.0
+
+            logger.info("Fingerprinted %d files in %.1fs: %s" % (
+                len(tasks), wall, ", ".join(
+                    "%s %.2f files/s" % (stage, stats[stage]["files_per_sec"])
+                    for stage in STAGES)))
+            return stats
+
+    def _collect(self, run, tasks, write_queue, stats, started, failed):
+        """
+        Passes the results of `run` on to the writer threads until every
+        file of `tasks` has one.
+        """
+        remaining = len(tasks)
+        while remaining:
+            try:
+                message = self._result_queue.get(timeout=POLL_INTERVAL)
+            except Queue.Empty:
+                if all(process.is_alive() for process in
+                       self._decoders + self._fingerprinters):
+                    continue
+                # what the dead worker was given is lost, start afresh
+                self._terminate()
+                raise WorkerDied("A worker process exited, %d files were "
+                                 "not fingerprinted" % remaining)
+
+            message_run, index, kind, payload, counts = message
+            if message_run != run:
+                # left over from a run that was given up on
+                if kind == DONE:
+                    os.remove(payload)
+                continue
+            if kind == STARTED:
+                if started:
+                    started(tasks[index][0])
+                continue
+            remaining -= 1
+
+            for stage, stage_counts in counts.items():
+                for name, value in stage_counts.items():
+                    stats[stage][name] += value
+            if kind == ERROR:
+                logger.error("Failed fingerprinting %s: %s"
+                             % (tasks[index][1], payload))
+                stats["write"]["failed"] += 1
+                if failed:
+                    failed(tasks[index][0], payload)
+                continue
+            write_queue.put((index, payload))
+
+    def _write(self, tasks, write_queue, consume, batch_size, failed, counts):
+        """
+        Writer thread: hands the results of `write_queue` to `consume` in
+        batches of at least `batch_size` hashes.
+        """
+        batch = []
+        nhashes = 0
+        while True:
+            message = write_queue.get()
+            if message is not None:
+                index, path = message
+                try:
+                    hashes = load_hashes(path)
+                except Exception as e:
+                    logger.error("Failed reading hashes of %s: %s"
+                                 % (tasks[index][1], e))
+                    counts["failed"] += 1
+                    if failed:
+                        failed(tasks[index][0], e)
+                    continue
+                batch.append((tasks[index][0], hashes))
+                nhashes += len(hashes)
+
+            if batch and (message is None or nhashes >= batch_size):
+                t = time.time()
+                try:
+                    consume(batch)
+                except Exception as e:
+                    # keep draining the queue, the other stages would
+                    # block on it otherwise
+                    logger.exception("Failed storing %d files: %s"
+                                     % (len(batch), e))
+                    counts["failed"] += len(batch)
+                    if failed:
+                        for key, _ in batch:
+                            failed(key, e)
+                else:
+                    counts["files"] += len(batch)
+                    counts["hashes"] += nhashes
+                counts["busy_secs"] += time.time() - t
+                batch = []
+                nhashes = 0
+
+            if message is None:
+                break
+
+
+def _worker(after_fork, target, *args):
+    if after_fork:
+        after_fork()
+    target(*args)
+
+
+def _decode(task_queue, block_queues, result_queue, config, limit,
+            decoder_options, cache):
+    """
+    Decoder process: streams the blocks of each file of `task_queue` to
+    the fingerprint process the file's index picks, or passes the hashes
+    `cache` holds for the file straight on.
+    """
+    # loaded on first use otherwise
+    import pydub
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        run, index, filename, unique = task
+        block_queue = block_queues[index % len(block_queues)]
+        counts = {"files": 0, "audio_secs": 0.0, "busy_secs": 0.0}
+        result_queue.put((run, index, STARTED, None, {}))
+
+        t = time.time()
+        key = None
+        if cache is not None and unique:
+            try:
+                key = cache.key(filename, config, limit, decoder_options)
+                arrays = cache.get(key)
+            except (IOError, OSError):
+                # unreadable, decoding it reports why
+                arrays = None
+            if arrays is not None:
+                counts.update(files=1, cached=1, busy_secs=time.time() - t)
+                result_queue.put((run, index, DONE, save_hashes(*arrays),
+                                  {"decode": counts}))
+                continue
+
+        try:
+            for channels, Fs in decoder.iter_decode(filename, limit,
+                                                    fs=config.fs,
+                                                    **decoder_options):
+                if len(channels):
+                    counts["audio_secs"] += len(channels[0]) / float(Fs)
+                counts["busy_secs"] += time.time() - t
+                block_queue.put((run, index, BLOCK, (channels, Fs)))
+                t = time.time()
+        except Exception as e:
+            counts["busy_secs"] += time.time() - t
+            block_queue.put((run, index, ERROR,
+                             ("%s: %s" % (type(e).__name__, e), counts)))
+            continue
+
+        counts["busy_secs"] += time.time() - t
+        counts["files"] = 1
+        block_queue.put((run, index, DONE, (unique, key, counts)))
+
+
+def _fingerprint(block_queue, result_queue, config, cache):
+    """
+    Fingerprint process: feeds the blocks of `block_queue` to one
+    `FingerprintStream` per file and channel, and passes the hashes of
+    each file on once its last block is in, adding them to `cache` when
+    the decoder gave a key for them.
+    """
+    # fingerprint a moment of silence to load and set up what it takes
+    fingerprint.fingerprint(np.zeros(config.fs, dtype=np.int16), config)
+
+    # (run, index) -> [streams, hashes, offsets, busy seconds] of the files
+    # being decoded, with the hash and offset arrays of every block and
+    # channel so far; None once fingerprinting the file failed
+    files = {}
+    while True:
+        message = block_queue.get()
+        if message is None:
+            break
+        run, index, kind, payload = message
+        key = (run, index)
+
+        t = time.time()
+        result = None
+        try:
+            if kind == BLOCK:
+                channels, Fs = payload
+                if key not in files:
+                    files[key] = [[fingerprint.FingerprintStream(config, Fs=Fs)
+                                   for _ in channels], [], [], 0.0]
+                if files[key] is not None:
+                    streams, hashes, offsets, _ = files[key]
+                    for stream, samples in zip(streams, channels):
+                        block_hashes, block_offsets = stream.feed_arrays(samples)
+                        hashes.append(block_hashes)
+                        offsets.append(block_offsets)
+            elif kind == DONE:
+                unique, cache_key, decode_counts = payload
+                entry = files.pop(key, [[], [], [], 0.0])
+                if entry is not None:
+                    streams, hashes, offsets, busy = entry
+                    for stream in streams:
+                        block_hashes, block_offsets = stream.close_arrays()
+                        hashes.append(block_hashes)
+                        offsets.append(block_offsets)
+                    if not hashes:
+                        empty_hashes, empty_offsets = fingerprint.empty_hash_arrays(config)
+                        hashes.append(empty_hashes)
+                        offsets.append(empty_offsets)
+                    if unique:
+                        # one copy of each (hash, offset) pair of all channels
+                        hashes, offsets = fingerprint.unique_hashes(hashes, offsets)
+                    else:
+                        hashes = np.concatenate(hashes)
+                        offsets = np.concatenate(offsets)
+                    if cache_key is not None:
+                        try:
+                            cache.put(cache_key, hashes, offsets)
+                        except (IOError, OSError) as e:
+                            logger.warning("Failed caching the hashes of "
+                                           "a file: %s" % e)
+                    counts = {"decode": decode_counts,
+                              "fingerprint": {"files": 1,
+                                              "hashes": len(hashes),
+                                              "busy_secs": busy + time.time() - t}}
+                    result = (run, index, DONE, save_hashes(hashes, offsets),
+                              counts)
+            elif key not in files or files.pop(key) is not None:
+                # decoding failed, drop what was fingerprinted of the file
+                # unless fingerprinting it failed and was reported already
+                error, decode_counts = payload
+                result = (run, index, ERROR, error, {"decode": decode_counts})
+        except Exception as e:
+            # skip the rest of the file's blocks
+            files[key] = None
+            result = (run, index, ERROR, "%s: %s" % (type(e).__name__, e), {})
+
+        if files.get(key) is not None:
+            files[key][3] += time.time() - t
+        if result is not None:
+            result_queue.put(result)
+
+
+def save_hashes(hashes, offsets):
+    """
+    Writes (hashes, offsets) arrays to a new memory mapped .npy file in
+    HASHES_DIR and returns its path, for `load_hashes` to read back.
+    """
+    fd, path = tempfile.mkstemp(suffix=".npy", prefix="dejavu-hashes-",
+                                dir=HASHES_DIR)
+    os.close(fd)
+    dtype = [("hash", hashes.dtype), ("offset", np.int64)]
+    array = np.lib.format.open_memmap(path, mode="w+", dtype=dtype,
+                                      shape=(len(hashes),))
+    array["hash"] = hashes
+    array["offset"] = offsets
+    del array
+    return path
+
+
+def load_hashes(path):
+    """
+    Returns the hashes saved by `save_hashes` as a list of (hash, offset)
+    tuples, like `fingerprint.generate_hashes`, and removes the file.
+    """
+    try:
+        array = np.load(path, mmap_mode="r")
+        return zip(array["hash"].tolist(), array["offset"].tolist())
+    finally:
+        os.remove(path)
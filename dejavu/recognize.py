@@ -1,7 +1,6 @@
 import dejavu.fingerprint as fingerprint
 import dejavu.decoder as decoder
 import numpy as np
-import pyaudio
 import time
 
 
@@ -9,13 +8,12 @@ class BaseRecognizer(object):
 
     def __init__(self, dejavu):
         self.dejavu = dejavu
-        self.Fs = fingerprint.DEFAULT_FS
+        self.Fs = dejavu.fingerprint_config.fs
 
     def _recognize(self, user, bundle, admin, *data):
-        matches = []
-        for d in data:
-            matches.extend(self.dejavu.find_matches(d, user, bundle, admin, Fs=self.Fs))
-        return self.dejavu.align_matches(matches)
+        # the channels make up a single block
+        return self.dejavu.align_stream([(list(data), self.Fs)],
+                                        user, bundle, admin)
 
     def recognize(self):
         pass  # base class does nothing
@@ -26,10 +24,11 @@ class FileRecognizer(BaseRecognizer):
         super(FileRecognizer, self).__init__(dejavu)
 
     def recognize_file(self, filename, user, bundle, admin):
-        frames, self.Fs = decoder.read(filename, self.dejavu.limit)
-
+        # decoding, fingerprinting and lookups are interleaved block by
+        # block, so match_time covers all three
         t = time.time()
-        match = self._recognize(user, bundle, admin, *frames)
+        blocks = self.dejavu.iter_decode(filename)
+        match = self.dejavu.align_stream(blocks, user, bundle, admin)
         t = time.time() - t
 
         if match:
@@ -43,13 +42,15 @@ class FileRecognizer(BaseRecognizer):
 
 class MicrophoneRecognizer(BaseRecognizer):
     default_chunksize   = 8192
-    default_format      = pyaudio.paInt16
     default_channels    = 2
     default_samplerate  = 44100
 
     def __init__(self, dejavu):
         super(MicrophoneRecognizer, self).__init__(dejavu)
+        # pyaudio is only needed, and imported, to record
+        import pyaudio
         self.audio = pyaudio.PyAudio()
+        self.format = pyaudio.paInt16
         self.stream = None
         self.data = []
         self.channels = MicrophoneRecognizer.default_channels
@@ -70,7 +71,7 @@ class MicrophoneRecognizer(BaseRecognizer):
             self.stream.close()
 
         self.stream = self.audio.open(
-            format=self.default_format,
+            format=self.format,
             channels=channels,
             rate=samplerate,
             input=True,
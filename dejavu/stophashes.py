@@ -0,0 +1,407 @@
+"""
+Stop hashes: hashes so common in a bundle that they say next to nothing
+about which of its songs a query comes from, like the one SQLDatabase's
+docstring finds in 26 songs, 392 times. They make most of the rows
+`Database.return_matches` streams back and most of the work of aligning
+them, for chance matches.
+
+The number of songs and of fingerprints of each hash of a bundle is
+kept up to date as songs are stored and deleted, and a hash is a stop
+hash once it is in more than ``max(min_songs, max_share * songs)`` of
+its songs. Lookups leave the stop hashes of the bundle out, or, with a
+`weight`, keep that share of them: the ones kept are picked by hash, so
+every query keeps the same ones and their matches count about `weight`
+times as much. With `prune_stored`, songs are also stored without the
+stop hashes their bundle has at the time, but the share `weight` keeps,
+which keeps them out of the index.
+
+The counts are those of the fingerprints stored, so they always agree
+with the database. With `prune_stored`, a stop hash stops being counted
+once it is left out, and it is stored again, in about `max_share` of
+the songs, whenever the bundle grows past its count.
+
+Counts are kept like `bloom.BloomFilters` keeps its filters: the songs
+this process stores or deletes update them, and every `check_interval`
+seconds they are compared with the songs the database lists for the
+bundle, adding the songs written by other processes, see
+`Database.get_bundle_hashes`. The fingerprints of songs deleted by other
+processes are gone, so their hashes stay counted until more than
+STALE_RATIO of the songs counted are gone and the counts are built again
+from the database.
+
+Admin lookups, which search every admin bundle of a name, are left
+alone, and so are admin bundles. Counts are kept in `directory`, one
+file per bundle, and built again from the database if they were saved
+by another version or for another fingerprint format.
+"""
+from __future__ import division
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from dejavu.bloom import hash_keys, mix_keys
+from dejavu.logs import get_logger
+
+logger = get_logger('Classification_Dejavu_StopHashes', "dejavu.log")
+
+DEFAULT_MAX_SHARE = 0.05
+DEFAULT_MIN_SONGS = 10
+DEFAULT_CHECK_INTERVAL = 60
+# counts are built again once this share of their songs were deleted
+STALE_RATIO = 0.5
+# of the files counts are saved in, and of how their keys are made, see
+# `bloom.hash_keys`; files of another version are built again
+FILE_VERSION = 1
+
+
+def count_hashes(keys, sids):
+    """
+    Returns (keys, songs, rows) arrays of the distinct `keys`, ordered,
+    with the number of distinct `sids` and of fingerprints of each;
+    `sids` is the song of each key.
+    """
+    if not len(keys):
+        return (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype=np.int64))
+    order = np.lexsort((sids, keys))
+    keys, sids = keys[order], sids[order]
+    new_key = np.concatenate(([True], keys[1:] != keys[:-1]))
+    new_song = new_key | np.concatenate(([True], sids[1:] != sids[:-1]))
+    starts = np.flatnonzero(new_key)
+    rows = np.diff(np.append(starts, len(keys)))
+    songs = np.add.reduceat(new_song.astype(np.int64), starts)
+    return keys[starts], songs, rows
+
+
+class HashCounts(object):
+    """
+    Songs and fingerprints of each hash of one bundle, with the ids of
+    the songs counted and counts of the lookups it filtered.
+    """
+
+    def __init__(self, keys=None, songs=None, rows=None, sids=()):
+        super(HashCounts, self).__init__()
+        # ordered uint64 keys, see `bloom.hash_keys`
+        self.keys = np.zeros(0, dtype=np.uint64) if keys is None else keys
+        self.songs = np.zeros(0, dtype=np.int64) if songs is None else songs
+        self.rows = np.zeros(0, dtype=np.int64) if rows is None else rows
+        self.sids = set(sids)
+        self.checked = 0
+        self.dirty = False
+        self.lookups = 0
+        self.hashes = 0
+        self.dropped = 0
+        # (threshold, ordered stop keys), until the counts change
+        self._stop = None
+
+    def update(self, sids, keys, key_sids, sign=1):
+        """
+        Counts the songs `sids`, with `keys` and the song of each in
+        `key_sids`, in with a `sign` of 1, or out with -1. Songs are only
+        counted in once, whoever adds them first: the writer that stored
+        them, or a check that found them in the database.
+        """
+        if sign > 0:
+            sids = set(sids) - self.sids
+        else:
+            sids = set(sids) & self.sids
+        if not sids:
+            return
+        counted = np.in1d(key_sids, np.array(sorted(sids), dtype=np.int64))
+        keys, songs, rows = count_hashes(keys[counted], key_sids[counted])
+        unique, inverse = np.unique(np.concatenate((self.keys, keys)),
+                                    return_inverse=True)
+        songs = np.bincount(inverse, np.concatenate((self.songs, sign * songs)),
+                            len(unique)).astype(np.int64)
+        rows = np.bincount(inverse, np.concatenate((self.rows, sign * rows)),
+                           len(unique)).astype(np.int64)
+        kept = songs > 0
+        self.keys, self.songs, self.rows = unique[kept], songs[kept], rows[kept]
+        if sign > 0:
+            self.sids.update(sids)
+        else:
+            self.sids.difference_update(sids)
+        self.dirty = True
+        self._stop = None
+
+    def threshold(self, max_share, min_songs):
+        """
+        Number of songs a hash has to be in more of to be a stop hash.
+        """
+        return max(min_songs, max_share * len(self.sids))
+
+    def stop_keys(self, threshold):
+        if self._stop is None or self._stop[0] != threshold:
+            self._stop = (threshold, self.keys[self.songs > threshold])
+        return self._stop[1]
+
+    def stats(self, threshold):
+        stop = self.songs > threshold
+        rows = int(self.rows.sum())
+        stop_rows = int(self.rows[stop].sum())
+        return {
+            "songs": len(self.sids),
+            "threshold": threshold,
+            "hashes": len(self.keys),
+            "fingerprints": rows,
+            "stop_hashes": int(stop.sum()),
+            "stop_fingerprints": stop_rows,
+            "stop_share": stop_rows / rows if rows else 0.0,
+            "lookups": self.lookups,
+            "query_hashes": self.hashes,
+            "dropped": self.dropped,
+            "drop_rate": self.dropped / self.hashes if self.hashes else 0.0,
+        }
+
+    def save(self, filename, fingerprint_format):
+        meta = {"version": FILE_VERSION, "fingerprint_format": fingerprint_format,
+                "sids": sorted(self.sids)}
+        tmp_file = "%s.%d.tmp" % (filename, os.getpid())
+        with open(tmp_file, "wb") as f:
+            np.savez(f, keys=self.keys, songs=self.songs, rows=self.rows,
+                     meta=np.array(json.dumps(meta)))
+        os.rename(tmp_file, filename)
+        self.dirty = False
+
+    @classmethod
+    def load(cls, filename, fingerprint_format):
+        """
+        Raises ValueError if the counts were saved by another version, or
+        for another fingerprint format.
+        """
+        with np.load(filename) as data:
+            meta = json.loads(str(data["meta"]))
+            if (meta.get("version"), meta.get("fingerprint_format")) != \
+                    (FILE_VERSION, fingerprint_format):
+                raise ValueError("version %s counts of %s fingerprints" % (
+                    meta.get("version"), meta.get("fingerprint_format")))
+            return cls(data["keys"], data["songs"], data["rows"], meta["sids"])
+
+
+class StopHashes(object):
+    """
+    The hash counts of every bundle, kept in `directory`.
+
+    ```python
+    stop_hashes = StopHashes(fingerprint.FORMAT_SHA1)
+    stored = stop_hashes.prune(db, hashes, user, bundle, admin)
+    stop_hashes.add(key, [(sid, hashes)])
+    hashes = stop_hashes.filter(db, hashes, user, bundle, admin)
+    stop_hashes.save()
+    ```
+    """
+
+    def __init__(self, fingerprint_format, directory="stop_hashes",
+                 max_share=DEFAULT_MAX_SHARE, min_songs=DEFAULT_MIN_SONGS,
+                 weight=0.0, prune_stored=False,
+                 check_interval=DEFAULT_CHECK_INTERVAL):
+        super(StopHashes, self).__init__()
+        if not 0 <= weight <= 1:
+            raise ValueError("Stop hash weight out of [0, 1]: %s" % weight)
+        self.fingerprint_format = fingerprint_format
+        self.directory = directory
+        self.max_share = max_share
+        self.min_songs = min_songs
+        self.weight = weight
+        self.prune_stored = prune_stored
+        self.check_interval = check_interval
+        # (user, bundle, admin) -> HashCounts
+        self.counts = {}
+        # set once the database can't list the hashes of a bundle
+        self.disabled = False
+        self._lock = threading.RLock()
+
+    def _filename(self, key):
+        digest = hashlib.sha1(json.dumps(key)).hexdigest()
+        return os.path.join(self.directory, digest + ".stop")
+
+    def _counts(self, key):
+        """
+        The counts of the bundle, loaded from `directory` or new.
+        """
+        # with the lock held
+        counts = self.counts.get(key)
+        if counts is None:
+            filename = self._filename(key)
+            if os.path.exists(filename):
+                try:
+                    counts = HashCounts.load(filename,
+                                             self.fingerprint_format)
+                except Exception as e:
+                    logger.warning("Failed loading %s, rebuilding it: %s"
+                                   % (filename, e))
+            if counts is None:
+                counts = HashCounts()
+            self.counts[key] = counts
+        return counts
+
+    def _check(self, db, key):
+        """
+        Brings the counts of bundle `key` in line with the songs the
+        database lists for it, returns None if they can't be.
+        """
+        # with the lock held
+        if not db.lists_bundle_hashes:
+            logger.warning("%s databases can't list the hashes of a bundle, "
+                           "stop hashes are off" % db.type)
+            self.disabled = True
+            return None
+        counts = self._counts(key)
+        if time.time() - counts.checked < self.check_interval:
+            return counts
+
+        sids = set(song[0] for song in db.get_song_files(*key))
+        if len(counts.sids - sids) > STALE_RATIO * len(counts.sids):
+            logger.info("Counting the hashes of %s/%s again" % key[:2])
+            counts = HashCounts()
+            self.counts[key] = counts
+        missing = sids - counts.sids
+        if missing:
+            pairs = list(db.get_bundle_hashes(key[0], key[1], key[2],
+                                              sorted(missing)))
+            counts.update(missing,
+                          hash_keys([hash for hash, _ in pairs],
+                                    self.fingerprint_format),
+                          np.array([sid for _, sid in pairs], dtype=np.int64))
+        counts.checked = time.time()
+        return counts
+
+    def _stop_mask(self, counts, keys):
+        """
+        Which of `keys` are stop hashes of `counts` and not in the share
+        `weight` keeps.
+        """
+        stop = np.in1d(keys, counts.stop_keys(
+            counts.threshold(self.max_share, self.min_songs)))
+        if self.weight:
+            period = np.uint64(max(1, int(round(1 / self.weight))))
+            stop &= mix_keys(keys) % period != 0
+        return stop
+
+    def _drop(self, db, hashes, user, bundle, admin):
+        """
+        Returns the (hash, offset) pairs of `hashes` that are not stop
+        hashes, and the counts of the bundle, None if it is not filtered.
+        """
+        if admin or self.disabled:
+            return hashes, None
+        hashes = list(hashes)
+        counts = self._check(db, (user, bundle, False))
+        if counts is None or not len(hashes):
+            return hashes, counts
+        stop = self._stop_mask(counts, hash_keys(
+            [hash for hash, _ in hashes], self.fingerprint_format))
+        return [pair for pair, drop in zip(hashes, stop) if not drop], counts
+
+    def filter(self, db, hashes, user, bundle, admin):
+        """
+        Returns the (hash, offset) pairs of a query but its stop hashes.
+        """
+        hashes = list(hashes)
+        with self._lock:
+            kept, counts = self._drop(db, hashes, user, bundle, admin)
+            if counts is not None:
+                counts.lookups += 1
+                counts.hashes += len(hashes)
+                counts.dropped += len(hashes) - len(kept)
+        return kept
+
+    def prune(self, db, hashes, user, bundle, admin):
+        """
+        Returns the (hash, offset) pairs of a song to store: all of them,
+        or, with `prune_stored`, all but the stop hashes of the bundle
+        that lookups leave out.
+        """
+        if not self.prune_stored:
+            return hashes
+        with self._lock:
+            return self._drop(db, hashes, user, bundle, admin)[0]
+
+    def add(self, key, songs):
+        """
+        Counts `songs`, (sid, hashes) pairs of the bundle `key`, (user,
+        bundle, admin), once they are stored and marked fingerprinted.
+        `hashes` are the (hash, offset) pairs of a song as stored, see
+        `prune`.
+        """
+        if key[2]:
+            return
+        keys = [hash_keys([hash for hash, _ in hashes], self.fingerprint_format)
+                for _, hashes in songs]
+        key_sids = [np.repeat(np.int64(sid), len(song_keys))
+                    for (sid, _), song_keys in zip(songs, keys)]
+        with self._lock:
+            self._counts((key[0], key[1], False)).update(
+                [sid for sid, _ in songs],
+                np.concatenate(keys or [np.zeros(0, dtype=np.uint64)]),
+                np.concatenate(key_sids or [np.zeros(0, dtype=np.int64)]))
+
+    def remove(self, db, key, sids):
+        """
+        Counts the songs `sids` of the bundle `key` out, before the
+        database deletes them.
+        """
+        if key[2] or self.disabled or not db.lists_bundle_hashes:
+            return
+        with self._lock:
+            counts = self._counts((key[0], key[1], False))
+            sids = sorted(counts.sids.intersection(sids))
+            if not sids:
+                return
+            pairs = list(db.get_bundle_hashes(key[0], key[1], key[2], sids))
+            counts.update(sids,
+                          hash_keys([hash for hash, _ in pairs],
+                                    self.fingerprint_format),
+                          np.array([sid for _, sid in pairs], dtype=np.int64),
+                          sign=-1)
+
+    def drop(self, key):
+        """
+        Forgets the counts of a deleted bundle.
+        """
+        key = (key[0], key[1], bool(key[2]))
+        with self._lock:
+            self.counts.pop(key, None)
+            filename = self._filename(key)
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def clear(self):
+        """
+        Forgets every count, when the database was emptied.
+        """
+        with self._lock:
+            self.counts = {}
+            if os.path.isdir(self.directory):
+                for name in os.listdir(self.directory):
+                    if name.endswith(".stop"):
+                        os.remove(os.path.join(self.directory, name))
+
+    def save(self):
+        """
+        Writes the counts changed since they were last saved.
+        """
+        with self._lock:
+            dirty = [(key, counts) for key, counts in self.counts.items()
+                     if counts.dirty]
+            if dirty and not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            for key, counts in dirty:
+                counts.save(self._filename(key), self.fingerprint_format)
+
+    def stats(self):
+        """
+        Returns the stats of the bundles counted or filtered by this
+        process, by "user/bundle", see `HashCounts.stats`: the stop
+        hashes and the share of the fingerprints of the bundle they make,
+        which pruning keeps out of the index, and the lookups and query
+        hashes filtered and the share of them dropped.
+        """
+        with self._lock:
+            return dict(("%s/%s" % key[:2], counts.stats(
+                counts.threshold(self.max_share, self.min_songs)))
+                for key, counts in self.counts.items())
@@ -3,6 +3,8 @@ from pydub import AudioSegment
 from dejavu.decoder import path_to_songname
 from dejavu import Dejavu
 from dejavu.fingerprint import *
+import numpy as np
+import matplotlib.pyplot as plt
 import traceback
 import fnmatch
 import os, re, ast
@@ -113,11 +115,14 @@ def autolabeldoubles(rects, ax):
             '%s' % round(float(height), 3), ha='center', va='bottom')
 
 class DejavuTest(object):
-    def __init__(self, folder, seconds):
+    def __init__(self, folder, seconds, fingerprint_config=None):
         super(DejavuTest, self).__init__()
 
         self.test_folder = folder
         self.test_seconds = seconds
+        # parameters the songs were fingerprinted with, to turn offsets
+        # into seconds
+        self.fingerprint_config = fingerprint_config or FingerprintConfig.load()
         self.test_songs = []
 
         print "test_seconds", self.test_seconds
@@ -254,8 +259,9 @@ class DejavuTest(object):
                     song_start_time = re.findall("\_[^\_]+",f)
                     song_start_time = song_start_time[0].lstrip("_ ")
 
-                    result_start_time = round((result[Dejavu.OFFSET] * DEFAULT_WINDOW_SIZE * 
-                        DEFAULT_OVERLAP_RATIO) / (DEFAULT_FS), 0)
+                    config = self.fingerprint_config
+                    result_start_time = round((result[Dejavu.OFFSET] * config.window_size *
+                        config.overlap_ratio) / (config.fs), 0)
 
                     self.result_matching_times[line][col] = int(result_start_time) - int(song_start_time)
                     if (abs(self.result_matching_times[line][col]) == 1):
@@ -4,9 +4,18 @@
 # Synopsis: A Python module for reading and writing 24 bit WAV files.
 # Github: github.com/WarrenWeckesser/wavio
 
+import mmap as _mmap
+import os as _os
+import struct as _struct
 import wave as _wave
 import numpy as _np
 
+_WAVE_FORMAT_PCM = 0x0001
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# Number of frames WavReader.blocks decodes at a time
+DEFAULT_BLOCKSIZE = 2 ** 18
+
 
 def _wav2array(nchannels, sampwidth, data):
     """data must be the string containing the bytes from the wav file."""
@@ -70,6 +79,170 @@ def readwav(file):
     return rate, sampwidth, array
 
 
+class WavReader(object):
+    """
+    Read a PCM WAV file through a memory map of its data chunk.
+
+    Parameters
+    ----------
+    filename : string
+        Name of the file to read.
+
+    Attributes
+    ----------
+    rate : int
+        The sampling frequency (i.e. frame rate)
+    nchannels : int
+        The number of audio channels.
+    sampwidth : int
+        The sample width, in bytes.
+    nframes : int
+        The number of frames in the file.
+
+    Notes
+    -----
+    Nothing is read up front: frames are decoded to 16 bit samples a block
+    at a time, for the requested time range only, so a long 24 bit
+    recording is never held in memory as a whole. Wider samples keep
+    their top 16 bits and unsigned 8 bit samples are centered and scaled
+    up. Unlike the `wave` module, WAVE_FORMAT_EXTENSIBLE files are read
+    too. Raises ValueError for anything but an uncompressed PCM WAV file.
+
+    >>> with WavReader("sensor24.wav") as wav:
+    ...     for block in wav.blocks(start=60, stop=120):
+    ...         process(block)
+
+    """
+    def __init__(self, filename):
+        self._file = open(filename, 'rb')
+        self._map = None
+        try:
+            self._parse()
+            if self._data_size:
+                self._map = _mmap.mmap(self._file.fileno(), 0,
+                                       access=_mmap.ACCESS_READ)
+        except:
+            self._file.close()
+            raise
+
+    def _parse(self):
+        f = self._file
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != 'RIFF' or header[8:] != 'WAVE':
+            raise ValueError('Not a RIFF WAVE file.')
+
+        file_size = _os.fstat(f.fileno()).st_size
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                raise ValueError('WAV file has no data chunk.')
+            chunk_id, chunk_size = _struct.unpack('<4sI', chunk)
+
+            if chunk_id == 'fmt ':
+                fmt = f.read(chunk_size)
+                if len(fmt) < 16:
+                    raise ValueError('Truncated WAV fmt chunk.')
+                format_tag, nchannels, rate, _, block_align, bits = \
+                    _struct.unpack('<HHIIHH', fmt[:16])
+                if format_tag == _WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+                    # the actual format opens the subformat GUID
+                    format_tag, = _struct.unpack('<H', fmt[24:26])
+                if format_tag != _WAVE_FORMAT_PCM:
+                    raise ValueError('Unsupported WAV format: %#x.'
+                                     % format_tag)
+                sampwidth = (bits + 7) // 8
+                if not 1 <= sampwidth <= 4 or not nchannels or \
+                        block_align != sampwidth * nchannels:
+                    raise ValueError('Unsupported WAV sample layout.')
+                f.seek(chunk_size & 1, 1)
+            elif chunk_id == 'data':
+                if fmt is None:
+                    raise ValueError('WAV data chunk before fmt chunk.')
+                offset = f.tell()
+                # streamed files can leave the size unset
+                size = min(chunk_size, file_size - offset)
+                break
+            else:
+                f.seek(chunk_size + (chunk_size & 1), 1)
+
+        self.rate = rate
+        self.nchannels = nchannels
+        self.sampwidth = sampwidth
+        self.nframes = size // block_align
+        self._data_offset = offset
+        self._data_size = self.nframes * block_align
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def frame_range(self, start=0, stop=None):
+        """
+        Returns the (first, last + 1) frames of the time range from
+        `start` to `stop` seconds (the end of the file if None).
+        """
+        first = min(int(start * self.rate), self.nframes)
+        last = self.nframes
+        if stop is not None:
+            last = min(int(stop * self.rate), last)
+        return first, max(first, last)
+
+    def raw_blocks(self, start=0, stop=None, blocksize=DEFAULT_BLOCKSIZE):
+        """
+        Yields the raw bytes of the time range, `blocksize` frames at a
+        time.
+        """
+        first, last = self.frame_range(start, stop)
+        frame_bytes = self.sampwidth * self.nchannels
+        for frame in xrange(first, last, blocksize):
+            begin = self._data_offset + frame * frame_bytes
+            end = begin + min(blocksize, last - frame) * frame_bytes
+            yield self._map[begin:end]
+
+    def blocks(self, start=0, stop=None, blocksize=DEFAULT_BLOCKSIZE):
+        """
+        Yields the time range as int16 arrays of shape (frames, nchannels),
+        `blocksize` frames at a time.
+        """
+        first, last = self.frame_range(start, stop)
+        frame_bytes = self.sampwidth * self.nchannels
+        for frame in xrange(first, last, blocksize):
+            count = min(blocksize, last - frame)
+            raw = _np.frombuffer(
+                self._map, dtype=_np.uint8, count=count * frame_bytes,
+                offset=self._data_offset + frame * frame_bytes)
+            raw = raw.reshape(count, self.nchannels, self.sampwidth)
+            if self.sampwidth == 1:
+                block = (raw[:, :, 0].astype(_np.int16) - 128) << 8
+            else:
+                # the top two bytes of each little-endian sample; copied,
+                # as the map goes away on close
+                block = raw[:, :, -2:].copy().view('<i2')[:, :, 0]
+            yield block
+
+    def read(self, start=0, stop=None):
+        """
+        Returns the time range as an int16 array of shape
+        (frames, nchannels).
+        """
+        first, last = self.frame_range(start, stop)
+        data = _np.empty((last - first, self.nchannels), dtype=_np.int16)
+        frame = 0
+        for block in self.blocks(start, stop):
+            data[frame:frame + len(block)] = block
+            frame += len(block)
+        return data
+
+
 def writewav24(filename, rate, data):
     """
     Create a 24 bit wav file.
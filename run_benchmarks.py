@@ -0,0 +1,60 @@
+from dejavu.benchmark import *
+from optparse import OptionParser
+import json
+
+BENCHMARKS = {
+    "align": bench_align,
+    "databases": bench_databases,
+    "hashes": bench_generate_hashes,
+    "import": bench_import,
+    "match": bench_match,
+    "peaks": bench_peaks,
+    "spectrogram": bench_spectrogram,
+    "stop_hashes": bench_stop_hashes,
+}
+
+# benchmarks that need a database, given with --config
+DATABASE_BENCHMARKS = ("match",)
+# benchmarks that also measure the database of --config if given
+OPTIONAL_DATABASE_BENCHMARKS = ("databases",)
+
+usage = "usage: %prog [options] [BENCHMARK ...]\n\navailable benchmarks: " + \
+        ", ".join(sorted(BENCHMARKS))
+parser = OptionParser(usage=usage, version="%prog 1.0")
+parser.add_option("--repeat",
+                  action="store",
+                  dest="repeat",
+                  default=3,
+                  type=int,
+                  help='Number of runs per measurement, the best one is kept')
+parser.add_option("-c", "--config",
+                  action="store",
+                  dest="config",
+                  default=None,
+                  help='Dejavu configuration file of a scratch database, '
+                       'needed by: ' + ", ".join(DATABASE_BENCHMARKS))
+options, args = parser.parse_args()
+
+names = args or sorted(BENCHMARKS)
+for name in names:
+    if name not in BENCHMARKS:
+        parser.error("unknown benchmark: %s" % name)
+
+config = None
+if options.config:
+    with open(options.config) as f:
+        config = json.load(f)
+
+for name in names:
+    kwargs = {"repeat": options.repeat}
+    if name in DATABASE_BENCHMARKS:
+        if config is None:
+            print "%s: skipped, needs --config" % name
+            continue
+        kwargs["config"] = config
+    elif name in OPTIONAL_DATABASE_BENCHMARKS:
+        kwargs["config"] = config
+    result = BENCHMARKS[name](**kwargs)
+    print "%s:" % name
+    for key in sorted(result):
+        print "    %-20s %s" % (key, result[key])